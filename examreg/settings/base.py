@@ -37,6 +37,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'registration.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -82,16 +83,80 @@ LOGGING = {
             'level': 'DEBUG',
             'filters': ['require_debug_true'],
             'class': 'logging.StreamHandler',
-        }
+        },
+        'instrumentation': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.db.backends': {
             'level': 'INFO',
             'handlers': ['console'],
-        }
+        },
+        'registration.instrumentation': {
+            'level': 'INFO',
+            'handlers': ['instrumentation'],
+        },
     }
 }
 
+# What to do when a view goes over its query budget: 'warn' or 'raise'
+QUERY_BUDGET_ACTION = 'warn'
+
+# Cache configuration
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Cache used for exam availability (timelines, seats left). When serving
+# from several processes, point this at a shared backend, e.g. memcached.
+AVAILABILITY_CACHE = 'default'
+
+# Seconds before cached availability data expires, even if unchanged
+AVAILABILITY_CACHE_TIMEOUT = 30
+
+# Cache used to keep the courses each user is enrolled in across requests,
+# and seconds before cached memberships expire, even if unchanged. They are
+# only invalidated in the process that changes them, so leave this unset
+# (loading them once per request) unless it names a cache shared by every
+# process, e.g. memcached.
+MEMBERSHIP_CACHE = None
+MEMBERSHIP_CACHE_TIMEOUT = 300
+
+# Retrying transactions that conflict with another transaction: the most
+# attempts per transaction, the backoff before the first retry and the
+# longest backoff in seconds (jittered), and the fraction of transactions
+# that may be retried, with the most retries that can be saved up
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX_TOKENS = 100
+
+# Admission control for exams with an admission limit: the seconds each
+# registration change is expected to take, used to tell queued requests
+# when to try again, the seconds free places are held for the tickets
+# being served before skipping them, and the seconds a ticket is valid and
+# a place is held by a change that never finishes
+ADMISSION_SERVICE_TIME = 0.5
+ADMISSION_TICKET_TIMEOUT = 10
+ADMISSION_TICKET_MAX_AGE = 600
+
+# Whether history records of models that defer them are written in bulk
+# after the transaction commits, instead of with each save
+HISTORY_DEFER_WRITES = True
+
+# Directory that the history records of finished courses are archived to
+HISTORY_ARCHIVE_ROOT = os.path.join(BASE_DIR, 'archive', 'history')
+
+# Directory that finished courses are archived to, as snapshots that can
+# still be browsed
+COURSE_ARCHIVE_ROOT = os.path.join(BASE_DIR, 'archive', 'courses')
+
+
 # Custom User model
 AUTH_USER_MODEL = 'registration.User'
 
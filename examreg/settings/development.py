@@ -21,6 +21,11 @@ INTERNAL_IPS = [
 # https://django-crispy-forms.readthedocs.io/en/d-0/tags.html#make-django-crispy-forms-fail-loud
 CRISPY_FAIL_SILENTLY = False
 
+# Fail loudly when a view goes over its query budget, and only log
+# per-request instrumentation when something is wrong
+QUERY_BUDGET_ACTION = 'raise'
+LOGGING['loggers']['registration.instrumentation']['level'] = 'WARNING'
+
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
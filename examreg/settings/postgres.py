@@ -0,0 +1,20 @@
+from .development import *
+import psycopg2
+
+# Database
+# Development settings against a local Postgres server, e.g. for running
+# the benchmark_registration command the way production is set up.
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': config('POSTGRES_DB_NAME', default='examreg'),
+        'USER': config('POSTGRES_DB_USER', default=''),
+        'PASSWORD': config('POSTGRES_DB_PASSWORD', default=''),
+        'HOST': config('POSTGRES_DB_HOST', default='localhost'),
+        'PORT': '',
+        'OPTIONS': {
+            'isolation_level': psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE,
+        },
+    }
+}
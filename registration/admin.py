@@ -1,8 +1,14 @@
 from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.forms import BaseInlineFormSet
 from simple_history.admin import SimpleHistoryAdmin
 
+from . import availability
+from .forms import (
+    BaseExamSlotFormSet, BaseTimeSlotFormSet, SharedChoicesFormSetMixin,
+    SharedModelChoiceField, SharedModelMultipleChoiceField,
+)
 from .models import (
     User, Course, CourseUser, Room, Exam, TimeSlot, ExamSlot,
     ExamRegistration, GithubToken
@@ -11,49 +17,9 @@ from .models import (
 
 # Declare forms for use in inlines
 
-class ExamRegistrationsInstanceForm(forms.ModelForm):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        exam_reg = self.instance
-
-        if exam_reg.pk:
-            # Filter selectable exams by course
-            course_exams = Exam.objects.filter(
-                course=exam_reg.course_user.course)
-            self.fields['exam'].queryset = course_exams
-
-            # Filter selectable users by course
-            course_users = CourseUser.objects.filter(
-                course=exam_reg.exam.course)
-            self.fields['course_user'].queryset = course_users
-
-            # Filter selectable exam slots by exam
-            exam_slots = ExamSlot.objects.filter(exam=exam_reg.exam)
-            self.fields['exam_slot'].queryset = exam_slots
-
-
-class TimeSlotsInstanceForm(forms.ModelForm):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        time_slot = self.instance
-
-        # TODO: filter if no object (new entries)
-        if time_slot.pk:
-            # Filter selectable rooms by course
-            course_rooms = Room.objects.filter(course=time_slot.exam.course)
-            self.fields['room'].queryset = course_rooms
-
-
 class ExamSlotsInstanceForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        exam_slot = self.instance
-
-        if exam_slot.pk:
-            # Filter selectable time slots by exam
-            exam_timeslots = TimeSlot.objects.filter(exam=exam_slot.exam)
-            self.fields['start_time_slot'].queryset = exam_timeslots
-            self.fields['time_slots'].queryset = exam_timeslots
 
         # Make start_time_slot optional
         self.fields['start_time_slot'].required = False
@@ -62,37 +28,108 @@ class ExamSlotsInstanceForm(forms.ModelForm):
         super().clean()
 
         # Set start_time_slot correctly
-        self.cleaned_data['start_time_slot'] = \
-            self.cleaned_data['time_slots'] \
-                .order_by('start_time') \
-                .first()
+        self.cleaned_data['start_time_slot'] = min(
+            self.cleaned_data.get('time_slots') or [],
+            key=lambda time_slot: time_slot.start_time,
+            default=None,
+        )
+
+
+# Declare formsets for use in inlines, which load the choices of their
+# forms once, instead of once per row
+
+class ExamRegistrationsInstanceFormSet(SharedChoicesFormSetMixin,
+        BaseInlineFormSet):
+    def get_shared_objects(self):
+        course_user = self.instance
+        if course_user.pk is None:
+            return {}
+
+        course_users = list(CourseUser.objects
+            .filter(course=course_user.course_id)
+            .select_related('user', 'course'))
+        return {
+            'exam': list(Exam.objects.filter(course=course_user.course_id)),
+            'exam_slot': list(ExamSlot.objects
+                .filter(exam__course=course_user.course_id)
+                .select_related('exam', 'start_time_slot__room')
+                .prefetch_related('time_slots')
+                .order_by('exam', 'start_time_slot__start_time')),
+            'checkin_room': list(Room.objects
+                .filter(course=course_user.course_id)
+                .order_by('name')),
+            'checkin_user': course_users,
+            'checkout_user': course_users,
+        }
+
+    def get_choice_grouper(self, name):
+        # Group exam slots by exam, since they are shared between rows
+        if name == 'exam_slot':
+            return lambda exam_slot: exam_slot.exam.name
+        return None
+
+
+class ExamSlotsInstanceFormSet(BaseExamSlotFormSet):
+    def get_shared_objects(self):
+        shared_objects = super().get_shared_objects()
+        if 'time_slots' in shared_objects:
+            shared_objects['start_time_slot'] = shared_objects['time_slots']
+        return shared_objects
 
 
 # Declare inlines for later use
 
+class SharedChoicesInlineMixin:
+    """
+    Inline whose foreign key and many-to-many fields can be given shared
+    choices by its formset.
+    """
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        kwargs.setdefault('form_class', SharedModelChoiceField)
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def formfield_for_manytomany(self, db_field, request, **kwargs):
+        kwargs.setdefault('form_class', SharedModelMultipleChoiceField)
+        return super().formfield_for_manytomany(db_field, request, **kwargs)
+
+
 class ExamsInstanceInline(admin.TabularInline):
     model = Exam
     extra = 0
 
 
-class ExamRegistrationsInstanceInline(admin.TabularInline):
+class ExamRegistrationsInstanceInline(SharedChoicesInlineMixin,
+        admin.TabularInline):
     model = ExamRegistration
-    form = ExamRegistrationsInstanceForm
+    formset = ExamRegistrationsInstanceFormSet
     extra = 0
     fk_name = 'course_user'
 
+    def get_queryset(self, request):
+        return super().get_queryset(request) \
+            .select_related('course_user__user', 'exam')
+
 
-class TimeSlotsInstanceInline(admin.TabularInline):
+class TimeSlotsInstanceInline(SharedChoicesInlineMixin, admin.TabularInline):
     model = TimeSlot
-    form = TimeSlotsInstanceForm
+    formset = BaseTimeSlotFormSet
     extra = 0
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('room')
+
 
-class ExamSlotsInstanceInline(admin.TabularInline):
+class ExamSlotsInstanceInline(SharedChoicesInlineMixin, admin.TabularInline):
     model = ExamSlot
     form = ExamSlotsInstanceForm
+    formset = ExamSlotsInstanceFormSet
     extra = 0
 
+    def get_queryset(self, request):
+        return super().get_queryset(request) \
+            .select_related('start_time_slot__room') \
+            .prefetch_related('time_slots')
+
 
 class RoomsInstanceInline(admin.TabularInline):
     model = Room
@@ -140,6 +177,11 @@ class ExamAdmin(SimpleHistoryAdmin):
         ExamSlotsInstanceInline,
     ]
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        TimeSlot.repair_reg_counts(form.instance)
+        availability.invalidate_layout(form.instance.pk)
+
 
 @admin.register(GithubToken)
 class GithubTokenAdmin(SimpleHistoryAdmin):
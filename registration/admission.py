@@ -0,0 +1,228 @@
+"""
+Admission control for registration changes. When registration for an exam
+opens, the whole class tries to change their registration at once, and
+every change runs a SERIALIZABLE transaction in update_slot(). An exam with
+an admission limit only lets that many changes run at a time; requests
+over the limit are given a ticket and a place in a first-in, first-out
+queue, and are told when to try again, instead of piling onto the database.
+
+The state of each exam's queue is kept in the availability cache:
+
+- place:<n>: set while a change holds place n, for n below the limit
+- issued: number of the last ticket given out
+- serving: tickets up to this number may take a free place
+
+issued and serving are counters that are only ever changed with incr().
+Each change that finishes gives back its place and lets the next ticket
+in. Places expire after ADMISSION_TICKET_MAX_AGE seconds, so that the
+places of changes whose worker died are not lost for good. If the holders
+of the tickets being served never come back, places stay free, and after
+ADMISSION_TICKET_TIMEOUT seconds the queue skips ahead to the next tickets.
+
+Tickets are signed, so that they cannot be made up or used for another
+exam or user, and expire after ADMISSION_TICKET_MAX_AGE seconds.
+"""
+import math
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core import signing
+from django.db.models.signals import post_save
+
+from . import availability
+from .models import Exam
+
+
+# Exam fields needed to decide whether to admit a request
+ExamGate = namedtuple('ExamGate', [
+    'course_id', 'lock_before', 'lock_after', 'admission_limit',
+])
+
+# Outcome of trying to admit a request. When admitted, place is the place
+# taken. When not admitted, position is the number of tickets up to and
+# including this one that are still waiting, and retry_after is the number
+# of seconds to wait before trying again.
+Admission = namedtuple('Admission', [
+    'admitted', 'ticket', 'position', 'retry_after', 'place',
+])
+
+
+def get_exam_gate(exam_id):
+    """
+    Returns the ExamGate of an exam, or None if there is no such exam,
+    cached until the exam is saved.
+    """
+    def compute():
+        # Cache a missing exam as an empty tuple, since None is not cached
+        return Exam.objects \
+            .filter(pk=exam_id) \
+            .values_list(*ExamGate._fields) \
+            .first() or ()
+
+    values = availability.get_or_compute(exam_id, 'gate', compute,
+        layout=True)
+    return ExamGate(*values) if values else None
+
+
+def get_lock_warning(gate, request_time):
+    """
+    Returns why registration is closed at request_time, or None if it is
+    open. These are the same warnings update_slot() gives.
+    """
+    if gate.lock_before is not None and request_time < gate.lock_before:
+        return "Exam registration is not yet open"
+    if gate.lock_after is not None and request_time >= gate.lock_after:
+        return "Exam registration has closed"
+    return None
+
+
+def _key(exam_id, name):
+    return 'examreg:admission:{}:{}'.format(exam_id, name)
+
+
+def _get(exam_id, name):
+    return availability.get_cache().get(_key(exam_id, name), 0)
+
+
+def _incr(exam_id, name, delta=1):
+    cache = availability.get_cache()
+    key = _key(exam_id, name)
+    cache.add(key, 0, timeout=None)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Counter was evicted between add() and incr()
+        cache.add(key, delta, timeout=None)
+        return delta
+
+
+def _get_place_keys(exam_id, limit):
+    return [_key(exam_id, 'place:{}'.format(place)) for place in range(limit)]
+
+
+def _count_inflight(exam_id, limit):
+    """Returns the number of places taken."""
+    return len(availability.get_cache().get_many(
+        _get_place_keys(exam_id, limit)))
+
+
+def _acquire(exam_id, limit):
+    """
+    Takes one of limit places, and returns its number, or None if they are
+    all taken. The place expires after ADMISSION_TICKET_MAX_AGE seconds if
+    it is not given back.
+    """
+    cache = availability.get_cache()
+    keys = _get_place_keys(exam_id, limit)
+    taken = cache.get_many(keys)
+    timeout = getattr(settings, 'ADMISSION_TICKET_MAX_AGE', 600)
+    for place, key in enumerate(keys):
+        # add() fails if another request took the place in the meantime
+        if key not in taken and cache.add(key, True, timeout=timeout):
+            return place
+    return None
+
+
+def _serve_next(exam_id, count=1):
+    """Lets the next count tickets in, if any are waiting."""
+    if _get(exam_id, 'issued') > _get(exam_id, 'serving'):
+        _incr(exam_id, 'serving', count)
+        availability.get_cache().set(
+            _key(exam_id, 'served_at'), time.time(), timeout=None)
+
+
+def release(exam_id, place):
+    """Gives back the place taken by an admitted request."""
+    availability.get_cache().delete(_key(exam_id, 'place:{}'.format(place)))
+    _serve_next(exam_id)
+
+
+def _skip_stale_tickets(exam_id, limit):
+    """
+    Lets the next tickets in if places have been free for longer than
+    ADMISSION_TICKET_TIMEOUT, because the tickets being served were given
+    up on.
+    """
+    free = limit - _count_inflight(exam_id, limit)
+    if free <= 0:
+        return
+
+    cache = availability.get_cache()
+    key = _key(exam_id, 'served_at')
+    served_at = cache.get(key)
+    if served_at is None:
+        cache.add(key, time.time(), timeout=None)
+    elif time.time() - served_at > getattr(
+            settings, 'ADMISSION_TICKET_TIMEOUT', 10):
+        _serve_next(exam_id, free)
+
+
+def get_retry_after(position, limit):
+    """
+    Returns the number of seconds a request at the given position in the
+    queue should wait before trying again.
+    """
+    service_time = getattr(settings, 'ADMISSION_SERVICE_TIME', 0.5)
+    return max(1, math.ceil(position * service_time / limit))
+
+
+def try_admit(exam_id, limit, ticket=None):
+    """
+    Tries to admit a request to change a registration for an exam, when at
+    most limit changes may run at a time. ticket is the ticket given to the
+    request when it was last queued, if any.
+
+    If admitted, release() must be called with the place taken once the
+    change is done. Returns an Admission.
+    """
+    if ticket is None:
+        # Only take a place right away if nobody is waiting for one
+        waiting = _get(exam_id, 'issued') > _get(exam_id, 'serving')
+    else:
+        waiting = ticket > _get(exam_id, 'serving')
+
+    place = None if waiting else _acquire(exam_id, limit)
+    if place is not None:
+        return Admission(True, ticket, 0, 0, place)
+    if ticket is None:
+        ticket = _incr(exam_id, 'issued')
+
+    _skip_stale_tickets(exam_id, limit)
+    position = max(1, ticket - _get(exam_id, 'serving'))
+    return Admission(False, ticket, position,
+        get_retry_after(position, limit), None)
+
+
+def _get_signer(exam_id, user_id):
+    return signing.TimestampSigner(
+        salt='examreg.admission.{}.{}'.format(exam_id, user_id))
+
+
+def sign_ticket(exam_id, user_id, ticket):
+    """Returns a ticket signed for an exam and user."""
+    return _get_signer(exam_id, user_id).sign(str(ticket))
+
+
+def unsign_ticket(exam_id, user_id, signed_ticket):
+    """
+    Returns the ticket from a signed ticket, or None if it is missing,
+    invalid or expired.
+    """
+    if not signed_ticket:
+        return None
+    try:
+        return int(_get_signer(exam_id, user_id).unsign(signed_ticket,
+            max_age=getattr(settings, 'ADMISSION_TICKET_MAX_AGE', 600)))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def exam_changed(sender, instance, **kwargs):
+    availability.invalidate_layout(instance.pk)
+
+
+def connect_signals():
+    """Connects the signals that invalidate cached exam gates."""
+    post_save.connect(exam_changed, sender=Exam,
+        dispatch_uid='admission_exam_changed')
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class RegistrationConfig(AppConfig):
     name = 'registration'
+
+    def ready(self):
+        from . import admission, membership
+        admission.connect_signals()
+        membership.connect_signals()
@@ -0,0 +1,186 @@
+"""
+Bulk assignment of unregistered students to exam slots, for when
+registration has closed. Every student enrolled in the course (and not
+dropped) who has no exam slot is given an exam slot of their exam slot
+type that still has a seat in each of its time slots, since time slots are
+shared between overlapping exam slots.
+
+The assignment is computed in memory and written with a fixed number of
+set-based statements per exam slot, in a single transaction.
+"""
+from collections import namedtuple
+
+from django.db import models
+
+from . import availability
+from .models import CourseUser, ExamRegistration, ExamSlot, TimeSlot
+from .retry import run_in_transaction
+
+
+# A student and the exam slot they are assigned to
+Assignment = namedtuple('Assignment', ['course_user', 'exam_slot'])
+
+# Result of assigning students: the assignments made, and the students
+# for whom no exam slot had a seat left
+AssignmentPlan = namedtuple('AssignmentPlan', ['assignments', 'unassigned'])
+
+
+def get_unregistered_students(exam):
+    """
+    Returns the students enrolled in the course of an exam who are not
+    registered for an exam slot, ordered by username.
+    """
+    registered = ExamRegistration.objects \
+        .filter(exam=exam, exam_slot__isnull=False) \
+        .values('course_user')
+    return list(exam.course.course_user_set
+        .filter(user_type=CourseUser.STUDENT, dropped=False)
+        .exclude(pk__in=registered)
+        .select_related('user')
+        .order_by('user__username'))
+
+
+def plan_assignment(exam_slots, seats_left, course_users):
+    """
+    Assigns each course user to an exam slot of their exam slot type with
+    a seat left in each of its time slots. exam_slots should have their
+    time slots prefetched, and seats_left maps the pk of each time slot to
+    its number of seats left, which is updated as seats are taken.
+
+    Students of the exam slot type with the fewest exam slots are assigned
+    first, and each student is given the exam slot with the most seats
+    left, to spread students evenly. Returns an AssignmentPlan.
+    """
+    exam_slots_by_type = {}
+    for exam_slot in exam_slots:
+        exam_slots_by_type.setdefault(exam_slot.exam_slot_type, []) \
+            .append(exam_slot)
+
+    time_slot_pks = {
+        exam_slot.pk: [
+            time_slot.pk for time_slot in exam_slot.time_slots.all()
+        ]
+        for exam_slot in exam_slots
+    }
+
+    def slot_seats_left(exam_slot):
+        return min(
+            (seats_left[pk] for pk in time_slot_pks[exam_slot.pk]),
+            default=0,
+        )
+
+    assignments = []
+    unassigned = []
+    for course_user in sorted(course_users, key=lambda course_user:
+            len(exam_slots_by_type.get(course_user.exam_slot_type, []))):
+        candidates = exam_slots_by_type.get(course_user.exam_slot_type, [])
+        exam_slot = max(candidates, key=slot_seats_left, default=None)
+        if exam_slot is None or slot_seats_left(exam_slot) <= 0:
+            unassigned.append(course_user)
+            continue
+
+        for pk in time_slot_pks[exam_slot.pk]:
+            seats_left[pk] -= 1
+        assignments.append(Assignment(course_user, exam_slot))
+
+    return AssignmentPlan(assignments, unassigned)
+
+
+def apply_assignment(exam, plan):
+    """
+    Writes the assignments of a plan: one UPDATE per exam slot for
+    existing registrations, one bulk INSERT for the rest, and bulk updates
+    of the exam slot and time slot counters. Must be called inside a
+    transaction.
+    """
+    course_user_pks_by_slot = {}
+    for course_user, exam_slot in plan.assignments:
+        course_user_pks_by_slot.setdefault(exam_slot.pk, []) \
+            .append(course_user.pk)
+
+    # Fill in existing registrations without an exam slot
+    existing = set(ExamRegistration.objects
+        .filter(exam=exam, course_user__in=[
+            course_user for course_user, _ in plan.assignments
+        ])
+        .values_list('course_user', flat=True))
+    for exam_slot_pk, course_user_pks in course_user_pks_by_slot.items():
+        ExamRegistration.objects \
+            .filter(exam=exam, course_user__in=course_user_pks,
+                exam_slot__isnull=True) \
+            .update(exam_slot=exam_slot_pk)
+
+    # Create the missing registrations
+    ExamRegistration.objects.bulk_create([
+        ExamRegistration(exam=exam, course_user=course_user,
+            exam_slot=exam_slot)
+        for course_user, exam_slot in plan.assignments
+        if course_user.pk not in existing
+    ])
+
+    # Record history, since update() and bulk_create() do not
+    ExamRegistration.history.bulk_history_create(
+        ExamRegistration.objects.filter(exam=exam, course_user__in=[
+            course_user for course_user, _ in plan.assignments
+        ]))
+
+    # Count the seats taken
+    exam_slots = {}
+    time_slots = {}
+    for _, exam_slot in plan.assignments:
+        exam_slots[exam_slot.pk] = exam_slot
+        exam_slot.reg_count += 1
+        for time_slot in exam_slot.time_slots.all():
+            time_slot = time_slots.setdefault(time_slot.pk, time_slot)
+            time_slot.reg_count += 1
+    ExamSlot.objects.bulk_update(exam_slots.values(), ['reg_count'])
+    TimeSlot.objects.bulk_update(time_slots.values(), ['reg_count'])
+
+    availability.invalidate(exam.pk)
+
+
+def compute_assignment(exam, lock=False):
+    """
+    Computes the assignment of every unregistered student of an exam to an
+    exam slot, with the current seat counts. If lock is true, the slot
+    counters are locked with select_for_update(), which must be done
+    inside a transaction. Returns an AssignmentPlan.
+    """
+    exam_slots = exam.exam_slot_set.all()
+    time_slots = exam.time_slot_set.all()
+    if lock:
+        exam_slots = exam_slots.select_for_update()
+        time_slots = time_slots.select_for_update()
+
+    exam_slots = list(exam_slots
+        .select_related('start_time_slot__room')
+        .prefetch_related('time_slots')
+        .order_by('start_time_slot__start_time', 'pk'))
+    seats_left = dict(time_slots
+        .annotate(seats_left=models.F('capacity') - models.F('reg_count'))
+        .values_list('pk', 'seats_left'))
+
+    return plan_assignment(exam_slots, seats_left,
+        get_unregistered_students(exam))
+
+
+def assign_unregistered(exam, dry_run=False):
+    """
+    Assigns every unregistered student of an exam to an exam slot. The
+    slot counters are locked while the assignment is computed and written,
+    so that no registration can take a seat in between. If dry_run is
+    true, nothing is written or locked, so that previewing the assignment
+    does not hold up registrations.
+
+    Returns an AssignmentPlan.
+    """
+    if dry_run:
+        return compute_assignment(exam)
+
+    def assign():
+        plan = compute_assignment(exam, lock=True)
+        if plan.assignments:
+            apply_assignment(exam, plan)
+        return plan
+
+    return run_in_transaction(assign, name='assign_unregistered')
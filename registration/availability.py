@@ -0,0 +1,131 @@
+"""
+Versioned cache for exam availability data. Each exam has two version
+counters in the cache, and cached values are keyed by exam and one of the
+versions, so bumping a version invalidates all of its values at once:
+
+- the seat version is bumped whenever the registrations or seat counts of
+  the exam change, and keys values that depend on them;
+- the layout version is bumped only when the exam or its slots are edited,
+  and keys values that do not depend on seat counts, such as the exam gate
+  and slot times and rooms, so that they stay cached while students book.
+
+Editing the layout bumps both versions, since it may change seat counts.
+
+The local-memory cache only works within one process; if the site is served
+by several processes, point AVAILABILITY_CACHE at a shared backend.
+"""
+import contextlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+def get_cache():
+    """Returns the cache backend used for availability data."""
+    return caches[getattr(settings, 'AVAILABILITY_CACHE', 'default')]
+
+
+def _version_key(exam_id, layout=False):
+    return 'examreg:availability:{}:{}'.format(
+        exam_id, 'layout_version' if layout else 'version')
+
+
+def get_version(exam_id, layout=False):
+    """
+    Returns the current seat version of an exam, or its layout version if
+    layout is true.
+    """
+    cache = get_cache()
+    key = _version_key(exam_id, layout)
+
+    version = cache.get(key)
+    if version is None:
+        # Start from the current time, so that a version that was evicted
+        # from the cache never comes back with an earlier value
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(exam_id, layout=False):
+    """
+    Increments the seat version of an exam immediately, or its layout
+    version if layout is true.
+    """
+    cache = get_cache()
+    try:
+        return cache.incr(_version_key(exam_id, layout))
+    except ValueError:
+        # Version was never set or was evicted
+        return get_version(exam_id, layout)
+
+
+def invalidate(exam_id):
+    """
+    Invalidates cached data that depends on the seat counts of an exam once
+    the current transaction commits, so that no other request can cache
+    data from before the change under the new version.
+    """
+    transaction.on_commit(lambda: bump_version(exam_id))
+
+
+def invalidate_layout(exam_id):
+    """
+    Invalidates all cached data for an exam, including its layout, once
+    the current transaction commits. Used when the exam or its slots are
+    edited.
+    """
+    def bump():
+        bump_version(exam_id, layout=True)
+        bump_version(exam_id)
+    transaction.on_commit(bump)
+
+
+_warming = threading.local()
+
+
+@contextlib.contextmanager
+def warming(timeout):
+    """
+    Makes get_or_compute() in this thread recompute every value and cache
+    it for timeout seconds, so that values can be computed ahead of when
+    they are needed.
+    """
+    previous = getattr(_warming, 'timeout', None)
+    _warming.timeout = timeout
+    try:
+        yield
+    finally:
+        _warming.timeout = previous
+
+
+def get_or_compute(exam_id, name, compute, *key_parts, layout=False):
+    """
+    Returns the cached value called name for the current seat version of
+    an exam, or its layout version if layout is true, calling compute() to
+    fill the cache if needed. Extra key_parts distinguish variants of the
+    same value.
+    """
+    cache = get_cache()
+    key = 'examreg:availability:{}:{}:{}:{}'.format(
+        exam_id,
+        'layout' if layout else 'seats',
+        get_version(exam_id, layout),
+        ':'.join(str(part) for part in (name,) + key_parts),
+    )
+
+    warming_timeout = getattr(_warming, 'timeout', None)
+    if warming_timeout is not None:
+        value = compute()
+        cache.set(key, value, warming_timeout)
+        return value
+
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value,
+            getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 30))
+    return value
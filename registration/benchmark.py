@@ -0,0 +1,426 @@
+"""
+Load-test harness for registration day. It seeds a course with thousands of
+students and an exam with overlapping normal and extended time exam slots,
+then drives the registration views from several threads at once through
+the test client, recording the latency, query count and outcome of every
+request.
+
+Everything runs against a throwaway test database, using whichever
+database backend the current settings configure.
+"""
+import contextlib
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, setup_databases, setup_test_environment,
+    teardown_databases, teardown_test_environment,
+)
+from django.urls import reverse
+from django.utils import timezone
+
+from . import availability
+from .models import (
+    User, Course, CourseUser, Exam, Room, TimeSlot, ExamSlot,
+    ExamRegistration,
+)
+from .retry import TransactionConflict, retry_counters
+
+
+# Seeded objects used by the scenarios
+BenchmarkData = namedtuple('BenchmarkData', [
+    'course',
+    'exam',
+    'instructor',
+    'students',
+    'exam_slot_pks',
+])
+
+# A seeded student: their username, registration pk and exam slot type
+Student = namedtuple('Student', ['username', 'exam_reg_pk', 'exam_slot_type'])
+
+# Results of running one scenario at one level of concurrency
+ScenarioResult = namedtuple('ScenarioResult', [
+    'name',
+    'workers',
+    'elapsed',
+    'latencies',
+    'query_counts',
+    'outcomes',
+    'retries',
+])
+
+# Number of rows to create per query when seeding
+BATCH_SIZE = 500
+
+
+@contextlib.contextmanager
+def benchmark_database():
+    """
+    Sets up a throwaway test database and test environment for the
+    duration of the block, and destroys them afterwards. As when running
+    tests, DEBUG is turned off, so debugging aids do not skew the results.
+    """
+    # SQLite test databases live in a shared-cache in-memory database
+    # by default, which locks whole tables; use a real file instead.
+    tmpdir = tempfile.mkdtemp()
+    test_settings = connection.settings_dict['TEST']
+    old_test_name = test_settings.get('NAME')
+    if connection.vendor == 'sqlite':
+        test_settings['NAME'] = os.path.join(tmpdir, 'benchmark.sqlite3')
+
+    try:
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            yield
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+    finally:
+        test_settings['NAME'] = old_test_name
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def seed_exam(num_students=2000, num_rooms=4, num_days=2,
+        slots_per_day=16, normal_span=4, extended_span=6,
+        extended_fraction=0.1, capacity=None, seed=0):
+    """
+    Creates a course with an instructor and num_students students, of which
+    extended_fraction have extended time, and an exam whose time slots are
+    half an hour long. Every room has slots_per_day consecutive time slots
+    on each day, with a normal exam slot starting at each of them, and an
+    extended time exam slot starting at every other one, so that the exam
+    slots overlap heavily.
+
+    If capacity is None, the time slots are sized so that there are about
+    as many seats as students. Returns a BenchmarkData.
+    """
+    rng = random.Random(seed)
+    suffix = settings.ANDREW_EMAIL_SUFFIX
+
+    course = Course.objects.create(
+        code='bench-{}'.format(int(time.time())),
+        name="Benchmark course",
+    )
+    exam = Exam.objects.create(course=course, name="Benchmark exam")
+
+    if capacity is None:
+        num_time_slots = num_rooms * num_days * slots_per_day
+        capacity = max(1, num_students * normal_span // num_time_slots)
+
+    rooms = [
+        Room.objects.create(
+            course=course,
+            name="Room {}".format(i),
+            capacity=capacity,
+        )
+        for i in range(num_rooms)
+    ]
+
+    # Create time slots and overlapping exam slots
+    exam_slot_pks = {CourseUser.NORMAL: [], CourseUser.EXTENDED_TIME: []}
+    start = timezone.now().replace(minute=0, second=0, microsecond=0)
+    for day in range(num_days):
+        for room in rooms:
+            day_start = start + timedelta(days=day + 1)
+            time_slots = [
+                TimeSlot.objects.create(
+                    exam=exam,
+                    room=room,
+                    start_time=day_start + timedelta(minutes=30 * i),
+                    end_time=day_start + timedelta(minutes=30 * (i + 1)),
+                    capacity=capacity,
+                )
+                for i in range(slots_per_day)
+            ]
+
+            for exam_slot_type, span, step in [
+                (CourseUser.NORMAL, normal_span, 1),
+                (CourseUser.EXTENDED_TIME, extended_span, 2),
+            ]:
+                for i in range(0, slots_per_day - span + 1, step):
+                    exam_slot = ExamSlot.objects.create(
+                        exam=exam,
+                        start_time_slot=time_slots[i],
+                        exam_slot_type=exam_slot_type,
+                    )
+                    exam_slot.time_slots.set(time_slots[i:i + span])
+                    exam_slot_pks[exam_slot_type].append(exam_slot.pk)
+
+    # Create users in bulk
+    usernames = ['bench{:05}'.format(i) for i in range(num_students + 1)]
+    users = []
+    for username in usernames:
+        user = User(username=username, email=username + suffix)
+        user.set_unusable_password()
+        users.append(user)
+    User.objects.bulk_create(users, batch_size=BATCH_SIZE)
+    user_pks = dict(
+        User.objects
+            .filter(username__startswith='bench')
+            .values_list('username', 'pk')
+    )
+
+    # Enroll them, with the first user as the instructor
+    instructor = usernames[0]
+    exam_slot_types = {
+        username: CourseUser.EXTENDED_TIME
+            if rng.random() < extended_fraction else CourseUser.NORMAL
+        for username in usernames[1:]
+    }
+    CourseUser.objects.bulk_create([
+        CourseUser(
+            course=course,
+            user_id=user_pks[instructor],
+            user_type=CourseUser.INSTRUCTOR,
+        )
+    ] + [
+        CourseUser(
+            course=course,
+            user_id=user_pks[username],
+            exam_slot_type=exam_slot_types[username],
+        )
+        for username in usernames[1:]
+    ], batch_size=BATCH_SIZE)
+
+    # Create empty registrations
+    ExamRegistration.objects.bulk_create([
+        ExamRegistration(exam=exam, course_user_id=course_user_pk)
+        for course_user_pk in course.course_user_set
+            .values_list('pk', flat=True)
+    ], batch_size=BATCH_SIZE)
+    exam_reg_pks = dict(
+        exam.exam_registration_set
+            .values_list('course_user__user__username', 'pk')
+    )
+
+    students = [
+        Student(username, exam_reg_pks[username], exam_slot_types[username])
+        for username in usernames[1:]
+    ]
+    return BenchmarkData(
+        course=course,
+        exam=exam,
+        instructor=instructor,
+        students=students,
+        exam_slot_pks=exam_slot_pks,
+    )
+
+
+class BenchmarkClient(Client):
+    """
+    A test client for use from one thread while other threads make their
+    own requests. The test client re-raises exceptions from any request
+    handled while it waits for a response, including other threads' ones,
+    so only exceptions from its own thread are kept.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.thread_ident = threading.get_ident()
+
+    def store_exc_info(self, **kwargs):
+        if threading.get_ident() == self.thread_ident:
+            super().store_exc_info(**kwargs)
+
+
+class Worker:
+    """Per-thread state: one logged in client for each user."""
+    def __init__(self, data, rng):
+        self.data = data
+        self.rng = rng
+        self.clients = {}
+
+    def client(self, username):
+        if username not in self.clients:
+            self.clients[username] = BenchmarkClient(
+                REMOTE_USER=username + settings.ANDREW_EMAIL_SUFFIX)
+        return self.clients[username]
+
+    def exam_url(self, name):
+        return reverse(name,
+            args=[self.data.course.code, self.data.exam.pk])
+
+    def random_student(self):
+        return self.rng.choice(self.data.students)
+
+    def random_exam_slot_pk(self, student):
+        return self.rng.choice(
+            self.data.exam_slot_pks[student.exam_slot_type])
+
+
+def get_outcome(response, ok_status=200):
+    """Maps a response to 'ok', 'rejected', or 'error'."""
+    if response.status_code == ok_status:
+        return 'ok'
+    if response.status_code < 500:
+        return 'rejected'
+    return 'error'
+
+
+def exam_detail_get(worker):
+    student = worker.random_student()
+    return get_outcome(worker.client(student.username).get(
+        worker.exam_url('registration:exam-detail')))
+
+
+def exam_detail_post(worker):
+    # A successful registration redirects; a full slot re-renders the form
+    student = worker.random_student()
+    response = worker.client(student.username).post(
+        worker.exam_url('registration:exam-detail'),
+        {'exam_slot': worker.random_exam_slot_pk(student)},
+    )
+    if response.status_code == 200:
+        return 'rejected'
+    return get_outcome(response, ok_status=302)
+
+
+def update_slot(worker):
+    student = worker.random_student()
+    try:
+        ExamRegistration.update_slot(
+            student.exam_reg_pk, worker.random_exam_slot_pk(student))
+    except IntegrityError:
+        return 'rejected'
+    return 'ok'
+
+
+def exam_signups(worker):
+    return get_outcome(worker.client(worker.data.instructor).get(
+        worker.exam_url('registration:exam-signups')))
+
+
+def exam_signups_counts(worker):
+    return get_outcome(worker.client(worker.data.instructor).get(
+        worker.exam_url('registration:exam-signups-counts')))
+
+
+def exam_signups_csv(worker):
+    response = worker.client(worker.data.instructor).get(
+        worker.exam_url('registration:exam-signups-csv'))
+    for _ in response.streaming_content:
+        pass
+    return get_outcome(response)
+
+
+# Scenarios by name, in the order they are run
+SCENARIOS = {
+    'exam_detail_get': exam_detail_get,
+    'exam_detail_post': exam_detail_post,
+    'update_slot': update_slot,
+    'exam_signups': exam_signups,
+    'exam_signups_counts': exam_signups_counts,
+    'exam_signups_csv': exam_signups_csv,
+}
+
+
+def count_transaction_retries():
+    """Returns the number of transactions retried by run_in_transaction."""
+    return sum(
+        counters['retries'] for counters in retry_counters.summary().values()
+    )
+
+
+def run_scenario(name, data, num_workers, num_requests, max_retries=2,
+        seed=0):
+    """
+    Runs num_requests requests of the named scenario from num_workers
+    threads. A request that raises a database error, such as a deadlock
+    or serialization failure, is retried up to max_retries times before
+    counting as an abort. A TransactionConflict counts as an abort right
+    away, since run_in_transaction has already retried it.
+
+    The retries counted include those made by run_in_transaction. Returns
+    a ScenarioResult.
+    """
+    scenario = SCENARIOS[name]
+    lock = threading.Lock()
+    remaining = [num_requests]
+    latencies = []
+    query_counts = []
+    outcomes = {'ok': 0, 'rejected': 0, 'error': 0, 'abort': 0}
+    retries = [0]
+
+    def run_worker(worker):
+        try:
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+
+                start = time.perf_counter()
+                for attempt in range(max_retries + 1):
+                    try:
+                        with CaptureQueriesContext(connection) as queries:
+                            outcome = scenario(worker)
+                    except TransactionConflict:
+                        outcome = 'abort'
+                    except DatabaseError:
+                        outcome = 'abort'
+                        if attempt < max_retries:
+                            with lock:
+                                retries[0] += 1
+                            continue
+                    break
+                latency = time.perf_counter() - start
+
+                with lock:
+                    latencies.append(latency)
+                    query_counts.append(len(queries))
+                    outcomes[outcome] += 1
+        finally:
+            connection.close()
+
+    rng = random.Random(seed)
+    threads = [
+        threading.Thread(
+            target=run_worker,
+            args=(Worker(data, random.Random(rng.random())),),
+        )
+        for _ in range(num_workers)
+    ]
+    transaction_retries = count_transaction_retries()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    transaction_retries = count_transaction_retries() - transaction_retries
+
+    return ScenarioResult(
+        name=name,
+        workers=num_workers,
+        elapsed=elapsed,
+        latencies=sorted(latencies),
+        query_counts=query_counts,
+        outcomes=outcomes,
+        retries=retries[0] + transaction_retries,
+    )
+
+
+def percentile(sorted_values, p):
+    """Returns the pth percentile of a sorted list, by nearest rank."""
+    if not sorted_values:
+        return 0
+    index = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def reset_registrations(data):
+    """Clears every registration and seat count of the seeded exam."""
+    data.exam.exam_registration_set.update(exam_slot=None)
+    data.exam.exam_slot_set.update(reg_count=0)
+    data.exam.time_slot_set.update(reg_count=0)
+    availability.invalidate(data.exam.pk)
@@ -0,0 +1,192 @@
+from collections import Counter, namedtuple
+
+from django.db import models
+
+from .models import CourseUser, ExamRegistration
+from .timeline import get_exam_slot_infos, group_by_day
+
+
+# Number of users of one type in a course, and how many have registered
+UserTypeCounts = namedtuple('UserTypeCounts', [
+    'course_users',
+    'registered',
+    'unregistered',
+])
+
+# Signups for a time slot; registered is counted from the registrations,
+# while reg_count is the stored counter
+TimeSlotCounts = namedtuple('TimeSlotCounts', [
+    'pk',
+    'start_time',
+    'end_time',
+    'room',
+    'capacity',
+    'reg_count',
+    'registered',
+])
+
+# Signups for an exam slot, given as an ExamSlotInfo
+ExamSlotCounts = namedtuple('ExamSlotCounts', [
+    'slot',
+    'registered',
+    'registered_by_user_type',
+])
+
+SignupCounts = namedtuple('SignupCounts', [
+    'total',
+    'by_user_type',
+    'time_slots',
+    'exam_slots',
+])
+
+
+def make_user_type_counts(course_users, registered):
+    return UserTypeCounts(
+        course_users=course_users,
+        registered=registered,
+        unregistered=course_users - registered,
+    )
+
+
+def get_registration_counts(exam):
+    """
+    Counts the registrations of an exam in a single grouped query. Returns
+    a 2-tuple (exam_slot_counts, time_slot_counts) of Counters, keyed by
+    (exam_slot_pk, user_type) and time_slot_pk respectively.
+    """
+    rows = ExamRegistration.objects \
+        .filter(exam=exam, exam_slot__isnull=False) \
+        .values_list(
+            'exam_slot',
+            'exam_slot__time_slots',
+            'course_user__user_type',
+        ) \
+        .annotate(num_registered=models.Count('pk')) \
+        .order_by()
+
+    exam_slot_counts = Counter()
+    time_slot_counts = Counter()
+    seen = set()
+    for exam_slot_pk, time_slot_pk, user_type, num_registered in rows:
+        # Each exam slot appears once for every one of its time slots
+        if (exam_slot_pk, user_type) not in seen:
+            seen.add((exam_slot_pk, user_type))
+            exam_slot_counts[exam_slot_pk, user_type] = num_registered
+        if time_slot_pk is not None:
+            time_slot_counts[time_slot_pk] += num_registered
+
+    return exam_slot_counts, time_slot_counts
+
+
+def get_signup_counts(exam):
+    """
+    Computes the signup counts of an exam: the number of users of each
+    type, and the number of users registered for each time slot and exam
+    slot. Registrations are counted in one grouped query, so the number of
+    queries does not grow with the number of slots.
+    """
+    exam_slot_counts, time_slot_counts = get_registration_counts(exam)
+
+    # Count course users by type
+    course_user_counts = dict(
+        exam.course.course_user_set
+            .values_list('user_type')
+            .annotate(num_course_users=models.Count('pk'))
+            .order_by()
+    )
+
+    registered_counts = Counter()
+    for (_, user_type), num_registered in exam_slot_counts.items():
+        registered_counts[user_type] += num_registered
+
+    by_user_type = {
+        user_type: make_user_type_counts(
+            course_user_counts.get(user_type, 0),
+            registered_counts[user_type],
+        )
+        for user_type, _ in CourseUser.USER_TYPE
+    }
+    total = make_user_type_counts(
+        sum(course_user_counts.values()),
+        sum(registered_counts.values()),
+    )
+
+    time_slots = [
+        TimeSlotCounts(
+            pk=time_slot.pk,
+            start_time=time_slot.start_time,
+            end_time=time_slot.end_time,
+            room=str(time_slot.room) if time_slot.room is not None else '',
+            capacity=time_slot.capacity,
+            reg_count=time_slot.reg_count,
+            registered=time_slot_counts[time_slot.pk],
+        )
+        for time_slot in exam.time_slot_set.select_related('room')
+    ]
+
+    exam_slots = []
+    for slot in get_exam_slot_infos(exam.exam_slot_set.all()):
+        registered_by_user_type = {
+            user_type: exam_slot_counts[slot.pk, user_type]
+            for user_type, _ in CourseUser.USER_TYPE
+        }
+        exam_slots.append(ExamSlotCounts(
+            slot=slot,
+            registered=sum(registered_by_user_type.values()),
+            registered_by_user_type=registered_by_user_type,
+        ))
+    exam_slots.sort(key=lambda counts: counts.slot.start_time)
+
+    return SignupCounts(
+        total=total,
+        by_user_type=by_user_type,
+        time_slots=time_slots,
+        exam_slots=exam_slots,
+    )
+
+
+def group_counts_by_day(counts):
+    """
+    Returns the time slots and exam slots of signup counts grouped by day,
+    as a 2-tuple of tuples of ExamDay.
+    """
+    return (
+        group_by_day(counts.time_slots),
+        group_by_day(
+            counts.exam_slots,
+            get_start_time=lambda exam_slot: exam_slot.slot.start_time,
+        ),
+    )
+
+
+def signup_counts_to_json(counts):
+    """Converts signup counts to a JSON-serializable dictionary."""
+    def user_type_counts_to_json(user_type_counts):
+        return dict(user_type_counts._asdict())
+
+    return {
+        'total': user_type_counts_to_json(counts.total),
+        'by_user_type': {
+            user_type: user_type_counts_to_json(user_type_counts)
+            for user_type, user_type_counts in counts.by_user_type.items()
+        },
+        'time_slots': [
+            dict(time_slot._asdict())
+            for time_slot in counts.time_slots
+        ],
+        'exam_slots': [
+            {
+                'pk': exam_slot.slot.pk,
+                'start_time': exam_slot.slot.start_time,
+                'end_time': exam_slot.slot.end_time,
+                'room': exam_slot.slot.room,
+                'exam_slot_type': exam_slot.slot.exam_slot_type,
+                'capacity': exam_slot.slot.capacity,
+                'reg_count': exam_slot.slot.reg_count,
+                'slots_left': exam_slot.slot.slots_left,
+                'registered': exam_slot.registered,
+                'registered_by_user_type': exam_slot.registered_by_user_type,
+            }
+            for exam_slot in counts.exam_slots
+        ],
+    }
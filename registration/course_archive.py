@@ -0,0 +1,376 @@
+"""
+Archival of finished courses. Archiving a course writes a snapshot of all
+of its rows, from the course down to its exam registrations, to a single
+gzipped JSON file, and then deletes them from the live tables, so that past
+semesters do not weigh on the indexes and admin filters. A snapshot can be
+browsed read-only without the database, or restored.
+
+Snapshots are stored as <root>/<course code>.json.gz, and look like:
+
+    {
+        "version": 1,
+        "code": "15213-m18",
+        "archived_at": "2018-08-20T12:00:00+00:00",
+        "users": {"fields": ["id", "username", ...], "rows": [[...], ...]},
+        "tables": {
+            "registration.course": {"fields": [...], "rows": [...]},
+            ...
+        }
+    }
+
+Each table lists its field names once, and each row as a list of values.
+Users are shared between courses, so they are only referred to: a restore
+matches them by username, creating any that no longer exist. The GitHub
+tokens of a course are deleted, not archived, since they are secrets a
+finished course has no use for.
+
+The history of a course is archived separately, by history_archive.
+"""
+import functools
+import glob
+import gzip
+import json
+import os
+from collections import namedtuple
+
+from django.db import router, transaction
+from django.utils import dateparse, timezone
+
+from . import availability, membership
+from .history_archive import batches, encode_value
+from .models import (
+    Course, CourseUser, Exam, ExamRegistration, ExamSlot, GithubToken, Room,
+    TimeSlot, User,
+)
+
+
+# Version of the snapshot format written, and the versions that can be read
+SNAPSHOT_VERSION = 1
+READABLE_VERSIONS = (1,)
+
+# Models of a course snapshot, in the order they are restored
+COURSE_MODELS = [
+    Course, CourseUser, Room, Exam, TimeSlot, ExamSlot,
+    ExamSlot.time_slots.through, ExamRegistration,
+]
+
+# Fields of users kept in a snapshot
+USER_FIELDS = ['id', 'username', 'first_name', 'last_name', 'email']
+
+# Read-only views of an archived course, built from its snapshot
+ArchivedCourse = namedtuple('ArchivedCourse', [
+    'code', 'name', 'archived_at', 'instructors', 'exams',
+])
+ArchivedExam = namedtuple('ArchivedExam', [
+    'pk', 'name', 'exam_slots', 'registrations',
+])
+ArchivedExamSlot = namedtuple('ArchivedExamSlot', [
+    'pk', 'start_time', 'end_time', 'room', 'exam_slot_type', 'reg_count',
+])
+ArchivedRegistration = namedtuple('ArchivedRegistration', [
+    'username', 'name', 'exam_slot', 'checkin_time', 'checkout_time',
+])
+
+
+def get_course_querysets(course_pk):
+    """
+    Returns (model, queryset) pairs of the rows of a course, in the order
+    of COURSE_MODELS.
+    """
+    through = ExamSlot.time_slots.through
+    return [
+        (Course, Course.objects.filter(pk=course_pk)),
+        (CourseUser, CourseUser.objects.filter(course=course_pk)),
+        (Room, Room.objects.filter(course=course_pk)),
+        (Exam, Exam.objects.filter(course=course_pk)),
+        (TimeSlot, TimeSlot.objects.filter(exam__course=course_pk)),
+        (ExamSlot, ExamSlot.objects.filter(exam__course=course_pk)),
+        (through, through.objects.filter(examslot__exam__course=course_pk)),
+        (ExamRegistration,
+            ExamRegistration.objects.filter(exam__course=course_pk)),
+    ]
+
+
+def get_snapshot_path(root, course_code):
+    return os.path.join(root, course_code + '.json.gz')
+
+
+def list_archived_courses(root):
+    """Returns the codes of the courses archived under root, sorted."""
+    return sorted(
+        os.path.basename(path)[:-len('.json.gz')]
+        for path in glob.glob(os.path.join(root, '*.json.gz'))
+    )
+
+
+def _get_fields(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def _dump_table(queryset, fields):
+    return {
+        'fields': fields,
+        'rows': [
+            list(row) for row in
+            queryset.order_by('pk').values_list(*fields).iterator()
+        ],
+    }
+
+
+def _load_table(model, table):
+    """
+    Returns the rows of a snapshot table as dicts of field values, decoded
+    with the fields of model.
+    """
+    fields = [model._meta.get_field(name) for name in table['fields']]
+    return [
+        {
+            field.attname: field.to_python(value)
+            for field, value in zip(fields, row)
+        }
+        for row in table['rows']
+    ]
+
+
+def build_snapshot(course, now):
+    """Returns a snapshot of a course, as a dict of JSON values."""
+    users = User.objects.filter(course_user_set__course=course).distinct()
+    return {
+        'version': SNAPSHOT_VERSION,
+        'code': course.code,
+        'archived_at': now,
+        'users': _dump_table(users, USER_FIELDS),
+        'tables': {
+            model._meta.label_lower:
+                _dump_table(queryset, _get_fields(model))
+            for model, queryset in get_course_querysets(course.pk)
+        },
+    }
+
+
+def write_snapshot(snapshot, path):
+    """Writes a snapshot to path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(snapshot, f, default=encode_value, separators=(',', ':'))
+
+
+def read_snapshot(path):
+    """
+    Reads a snapshot. Raises ValueError if there is none at path, or it is
+    of a version that cannot be read.
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        raise ValueError("No archived course at {}".format(path))
+    if snapshot.get('version') not in READABLE_VERSIONS:
+        raise ValueError("Unsupported snapshot version {!r}".format(
+            snapshot.get('version')))
+    return snapshot
+
+
+def _invalidate_caches(exam_pks):
+    # Rows are bulk created and deleted without sending signals
+    membership.invalidate_all()
+    for exam_pk in exam_pks:
+        availability.invalidate_layout(exam_pk)
+
+
+def archive_course(course, root, batch_size=500):
+    """
+    Writes a snapshot of a course under root, then deletes the course from
+    the live tables, in batches of batch_size rows, in a single
+    transaction. The snapshot is only put in place once the transaction
+    commits. Raises ValueError if a course with the same code is already
+    archived.
+
+    Returns a dict mapping the label of each model to the number of rows
+    archived.
+    """
+    path = get_snapshot_path(root, course.code)
+    if os.path.exists(path):
+        # Course codes are only unique among live courses, and the snapshot
+        # may be the only copy of a course archived before
+        raise ValueError("Course {} is already archived at {}".format(
+            course.code, path))
+
+    tmp_path = path + '.tmp'
+    try:
+        with transaction.atomic():
+            write_snapshot(build_snapshot(course, timezone.now()), tmp_path)
+
+            # Check that the snapshot reads back before deleting anything
+            tables = read_snapshot(tmp_path)['tables']
+            counts = {}
+            pks_by_model = {}
+            for model in COURSE_MODELS:
+                table = tables[model._meta.label_lower]
+                pks_by_model[model] = [
+                    row[table['fields'].index('id')] for row in table['rows']
+                ]
+
+            # GitHub tokens are not archived, but refer to the course users
+            for batch in batches(pks_by_model[CourseUser], batch_size):
+                GithubToken._base_manager.filter(course_user__in=batch) \
+                    ._raw_delete(router.db_for_write(GithubToken))
+
+            for model in reversed(COURSE_MODELS):
+                pks = pks_by_model[model]
+                # Deleted without loading the rows, so that no deletion
+                # history is recorded and no cascades are collected: every
+                # table that refers to them is deleted first
+                for batch in batches(pks, batch_size):
+                    model._base_manager.filter(pk__in=batch) \
+                        ._raw_delete(router.db_for_write(model))
+                counts[model._meta.label_lower] = len(pks)
+
+            transaction.on_commit(lambda: os.replace(tmp_path, path))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    exam_table = tables[Exam._meta.label_lower]
+    _invalidate_caches(
+        row[exam_table['fields'].index('id')] for row in exam_table['rows'])
+    return counts
+
+
+def restore_course(course_code, root, batch_size=500):
+    """
+    Restores an archived course from its snapshot under root, keeping the
+    original primary keys, in a single transaction, and then removes the
+    snapshot. History is not recorded for the restored rows. Raises
+    ValueError if there is no snapshot, or the course exists.
+
+    Returns a dict mapping the label of each model to the number of rows
+    restored.
+    """
+    path = get_snapshot_path(root, course_code)
+    snapshot = read_snapshot(path)
+    if Course.objects.filter(code=snapshot['code']).exists():
+        raise ValueError("Course {} already exists".format(snapshot['code']))
+
+    counts = {}
+    with transaction.atomic():
+        # Match users by username, since their ids may have changed
+        users = _load_table(User, snapshot['users'])
+        existing = dict(User.objects
+            .filter(username__in=[user['username'] for user in users])
+            .values_list('username', 'pk'))
+        user_pks = {}
+        for user in users:
+            if user['username'] not in existing:
+                new_user = User(**{
+                    name: value for name, value in user.items()
+                    if name != 'id'
+                })
+                new_user.set_unusable_password()
+                new_user.save()
+                existing[user['username']] = new_user.pk
+            user_pks[user['id']] = existing[user['username']]
+
+        for model in COURSE_MODELS:
+            label = model._meta.label_lower
+            rows = _load_table(model, snapshot['tables'][label])
+            if model is CourseUser:
+                for row in rows:
+                    row['user_id'] = user_pks[row['user_id']]
+            model._base_manager.bulk_create(
+                [model(**row) for row in rows], batch_size=batch_size)
+            counts[label] = len(rows)
+
+    os.remove(path)
+    exam_table = snapshot['tables'][Exam._meta.label_lower]
+    _invalidate_caches(
+        row[exam_table['fields'].index('id')] for row in exam_table['rows'])
+    return counts
+
+
+@functools.lru_cache(maxsize=16)
+def _load_archived_course(path, mtime):
+    snapshot = read_snapshot(path)
+
+    def load(model):
+        return _load_table(model,
+            snapshot['tables'][model._meta.label_lower])
+
+    users = {row['id']: row for row in _load_table(User, snapshot['users'])}
+    course_users = {row['id']: row for row in load(CourseUser)}
+    rooms = {row['id']: row['name'] for row in load(Room)}
+    time_slots = {row['id']: row for row in load(TimeSlot)}
+
+    end_times = {}
+    for row in load(ExamSlot.time_slots.through):
+        end_times.setdefault(row['examslot_id'], []).append(
+            time_slots[row['timeslot_id']]['end_time'])
+
+    exam_slot_types = dict(CourseUser.EXAM_SLOT_TYPE)
+    exam_slots = {}
+    exam_slots_by_exam = {}
+    for row in load(ExamSlot):
+        start_time_slot = time_slots[row['start_time_slot_id']]
+        exam_slot = exam_slots[row['id']] = ArchivedExamSlot(
+            pk=row['id'],
+            start_time=start_time_slot['start_time'],
+            end_time=max(end_times.get(row['id'], []), default=None),
+            room=rooms.get(start_time_slot['room_id']),
+            exam_slot_type=exam_slot_types.get(
+                row['exam_slot_type'], row['exam_slot_type']),
+            reg_count=row['reg_count'],
+        )
+        exam_slots_by_exam.setdefault(row['exam_id'], []).append(exam_slot)
+
+    registrations_by_exam = {}
+    for row in load(ExamRegistration):
+        user = users[course_users[row['course_user_id']]['user_id']]
+        registrations_by_exam.setdefault(row['exam_id'], []).append(
+            ArchivedRegistration(
+                username=user['username'],
+                name='{} {}'.format(
+                    user['first_name'], user['last_name']).strip(),
+                exam_slot=exam_slots.get(row['exam_slot_id']),
+                checkin_time=row['checkin_time'],
+                checkout_time=row['checkout_time'],
+            ))
+
+    [course] = load(Course)
+    return ArchivedCourse(
+        code=course['code'],
+        name=course['name'],
+        archived_at=dateparse.parse_datetime(snapshot['archived_at']),
+        instructors=frozenset(
+            users[row['user_id']]['username']
+            for row in course_users.values()
+            if row['user_type'] == CourseUser.INSTRUCTOR
+        ),
+        exams=[
+            ArchivedExam(
+                pk=exam['id'],
+                name=exam['name'],
+                exam_slots=sorted(exam_slots_by_exam.get(exam['id'], []),
+                    key=lambda exam_slot: (exam_slot.start_time,
+                        exam_slot.pk)),
+                registrations=sorted(
+                    registrations_by_exam.get(exam['id'], []),
+                    key=lambda registration: registration.username),
+            )
+            for exam in sorted(load(Exam), key=lambda exam: exam['id'])
+        ],
+    )
+
+
+def load_archived_course(course_code, root):
+    """
+    Returns an ArchivedCourse read from the snapshot of a course under
+    root, without the database. Snapshots are cached until they change.
+    Raises ValueError if the course is not archived.
+    """
+    path = get_snapshot_path(root, course_code)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        raise ValueError("Course {} is not archived".format(course_code))
+    return _load_archived_course(path, mtime)
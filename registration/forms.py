@@ -1,46 +1,18 @@
-import pytz
-
 from django import forms
 from django.core.exceptions import ValidationError
 
 from .models import (
-    User, Exam, ExamRegistration, TimeSlot, ExamSlot, Course, CourseUser
+    User, Exam, ExamRegistration, Room, TimeSlot, ExamSlot, Course, CourseUser
 )
+from .timezones import get_timezone_choices
 
 
 class ProfileForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # Hardcode list of CMU timezones
-        cmu_timezones = [('CMU Campuses', [
-            ('America/New_York', 'Pittsburgh (America/New_York)'),
-            ('Asia/Qatar', 'Qatar (Asia/Qatar)'),
-            ('America/Los_Angeles', 'Silicon Valley (America/Los_Angeles)'),
-        ])]
-
-        # Get timezones by country
-        tz_timezones = [
-            (
-                "{} ({})".format(pytz.country_names[code], code),
-                [(tz, tz) for tz in tzlist],
-            )
-            for (code, tzlist) in pytz.country_timezones.items()
-        ]
-        tz_timezones.sort()
-
-        # Get all other timezones (ex. UTC)
-        other_timezone_set = pytz.common_timezones_set
-        for (code, tzlist) in pytz.country_timezones.items():
-            other_timezone_set -= set(tzlist)
-        other_timezones = [('Other timezones', [
-            (tz, tz) for tz in sorted(other_timezone_set)
-        ])]
-
         # Apply to select field
-        self.fields['timezone'].widget.choices = (
-            cmu_timezones + tz_timezones + other_timezones
-        )
+        self.fields['timezone'].widget.choices = get_timezone_choices()
 
 
     class Meta:
@@ -130,19 +102,226 @@ class CourseSudoForm(forms.Form):
 class ExamEditForm(forms.ModelForm):
     class Meta:
         model = Exam
-        fields = ['name', 'details', 'lock_before', 'lock_after']
+        fields = [
+            'name', 'details', 'lock_before', 'lock_after', 'admission_limit',
+        ]
+
+
+class SharedModelChoiceField(forms.ModelChoiceField):
+    """
+    ModelChoiceField that can be given objects loaded once and shared with
+    the same field of other forms, which it renders and validates against
+    instead of querying its queryset.
+    """
+    shared_objects = None
+
+    def get_shared_choices(self, objects, get_group=None):
+        """
+        Returns the choices for a list of objects, grouped by the label
+        returned by get_group(obj), if given.
+        """
+        choices = []
+        if getattr(self, 'empty_label', None) is not None:
+            choices.append(('', self.empty_label))
+
+        groups = {}
+        for obj in objects:
+            choice = (self.prepare_value(obj), self.label_from_instance(obj))
+            if get_group is None:
+                choices.append(choice)
+                continue
+            group = get_group(obj)
+            if group not in groups:
+                groups[group] = []
+                choices.append((group, groups[group]))
+            groups[group].append(choice)
+        return choices
+
+    def share(self, objects_by_pk, choices):
+        """
+        Uses objects_by_pk, a dict mapping the pk of each object as a string
+        to the object, and their choices, instead of the queryset.
+        """
+        self.shared_objects = objects_by_pk
+        self.choices = choices
+        # Admin widgets wrap the select widget that renders the choices
+        if hasattr(self.widget, 'widget'):
+            self.widget.widget.choices = self.widget.choices
+
+    def get_shared_object(self, value):
+        try:
+            return self.shared_objects[str(value)]
+        except KeyError:
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+
+    def to_python(self, value):
+        if self.shared_objects is None or value in self.empty_values:
+            return super().to_python(value)
+        return self.get_shared_object(value)
+
+
+class SharedModelMultipleChoiceField(SharedModelChoiceField,
+        forms.ModelMultipleChoiceField):
+    """
+    ModelMultipleChoiceField that can be given shared objects, like
+    SharedModelChoiceField. Cleans to a list of objects instead of a
+    queryset when it has them.
+    """
+    def _check_values(self, value):
+        if self.shared_objects is None:
+            return super()._check_values(value)
+        return [self.get_shared_object(pk) for pk in dict.fromkeys(value)]
+
+
+class SharedChoicesFormSetMixin:
+    """
+    Formset mixin that loads the choices of model choice fields once, and
+    shares them with every form, instead of each form querying and
+    rendering its own choices. The fields must be SharedModelChoiceField or
+    SharedModelMultipleChoiceField.
+    """
+    def get_shared_objects(self):
+        """
+        Returns a dict mapping field names to lists of objects to choose
+        from, or an empty dict to leave the fields as they are.
+        """
+        return {}
+
+    def get_choice_grouper(self, name):
+        """
+        Returns a function that gives the label of the group of choices an
+        object belongs to for a field, or None to not group its choices.
+        """
+        return None
+
+    def share_choices(self, form):
+        """Gives the fields of a form the shared objects and choices."""
+        if not hasattr(self, '_shared_choices'):
+            self._shared_objects = self.get_shared_objects()
+            self._shared_choices = {}
+
+        for name, objects in self._shared_objects.items():
+            field = form.fields.get(name)
+            if not isinstance(field, SharedModelChoiceField):
+                continue
+            if name not in self._shared_choices:
+                self._shared_choices[name] = (
+                    {str(obj.pk): obj for obj in objects},
+                    field.get_shared_choices(objects,
+                        self.get_choice_grouper(name)),
+                )
+            field.share(*self._shared_choices[name])
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        self.share_choices(form)
+        return form
+
+    @property
+    def empty_form(self):
+        form = super().empty_form
+        self.share_choices(form)
+        return form
 
 
 class TimeSlotForm(forms.ModelForm):
     class Meta:
         model = TimeSlot
         fields = ['start_time', 'end_time', 'room', 'capacity']
+        field_classes = {
+            'room': SharedModelChoiceField,
+        }
+
+
+def find_overlaps(intervals):
+    """
+    Finds overlapping intervals, given an iterable of (key, start, end),
+    in O(n log n) time. Intervals that only touch do not overlap. Returns
+    a list of (key, other_key) pairs, with one pair for each interval that
+    overlaps an interval starting before it, or at the same time.
+    """
+    overlaps = []
+    last_key = last_end = None
+    for key, start, end in sorted(intervals,
+            key=lambda interval: (interval[1], interval[2])):
+        if last_end is not None and start < last_end:
+            overlaps.append((key, last_key))
+        if last_end is None or end > last_end:
+            last_key, last_end = key, end
+    return overlaps
+
+
+class BaseTimeSlotFormSet(SharedChoicesFormSetMixin,
+        forms.BaseInlineFormSet):
+    """
+    Formset of the time slots of an exam, which checks for overlapping
+    time slots in the same room all at once: among the submitted time
+    slots, and against the stored time slots not in the formset, using a
+    single query. Its forms share the rooms of the course as choices.
+    """
+    def get_shared_objects(self):
+        exam = self.instance
+        if exam.pk is None:
+            return {}
+        return {
+            'room': list(Room.objects
+                .filter(course=exam.course_id)
+                .order_by('name')),
+        }
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        form.instance.check_overlaps = False
+        return form
+
+    def clean(self):
+        super().clean()
+
+        intervals_by_room = {}
+        submitted_pks = set()
+        for form in self.forms:
+            if form.instance.pk is not None:
+                submitted_pks.add(form.instance.pk)
+            if not hasattr(form, 'cleaned_data') or \
+                    self._should_delete_form(form):
+                continue
+            start_time = form.cleaned_data.get('start_time')
+            end_time = form.cleaned_data.get('end_time')
+            if start_time is None or end_time is None:
+                continue
+            room = form.cleaned_data.get('room')
+            intervals_by_room.setdefault(room and room.pk, []).append(
+                (form, start_time, end_time))
+
+        stored_time_slots = TimeSlot.objects \
+            .filter(exam=self.instance) \
+            .exclude(pk__in=submitted_pks) \
+            .values_list('pk', 'room', 'start_time', 'end_time')
+        for pk, room_pk, start_time, end_time in stored_time_slots:
+            if room_pk in intervals_by_room:
+                intervals_by_room[room_pk].append(
+                    (None, start_time, end_time))
+
+        for intervals in intervals_by_room.values():
+            for form, other_form in find_overlaps(intervals):
+                for overlapping_form in [form, other_form]:
+                    if overlapping_form is not None and \
+                            'start_time' not in overlapping_form.errors:
+                        overlapping_form.add_error('start_time', (
+                            "The selected start and end times overlap with "
+                            "one or more other time slots for this exam."
+                        ))
 
 
 TimeSlotFormSet = forms.inlineformset_factory(
     Exam,
     TimeSlot,
     form=TimeSlotForm,
+    formset=BaseTimeSlotFormSet,
     extra=0,
 )
 
@@ -151,12 +330,37 @@ class ExamSlotForm(forms.ModelForm):
     class Meta:
         model = ExamSlot
         fields = ['time_slots', 'exam_slot_type']
+        field_classes = {
+            'time_slots': SharedModelMultipleChoiceField,
+        }
+
+
+class BaseExamSlotFormSet(SharedChoicesFormSetMixin,
+        forms.BaseInlineFormSet):
+    """
+    Formset of the exam slots of an exam, whose forms share the time slots
+    of the exam as choices.
+    """
+    def __init__(self, *args, queryset=None, **kwargs):
+        if queryset is None:
+            # Prefetch the time slots each form starts with
+            queryset = ExamSlot.objects.prefetch_related('time_slots')
+        super().__init__(*args, queryset=queryset, **kwargs)
+
+    def get_shared_objects(self):
+        exam = self.instance
+        if exam.pk is None:
+            return {}
+        return {
+            'time_slots': list(exam.time_slot_set.select_related('room')),
+        }
 
 
 ExamSlotFormSet = forms.inlineformset_factory(
     Exam,
     ExamSlot,
     form=ExamSlotForm,
+    formset=BaseExamSlotFormSet,
     extra=0,
 )
 
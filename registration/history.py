@@ -0,0 +1,128 @@
+"""
+History policies for models tracked with django-simple-history. By default
+every save writes a full historical copy of the row, in the same
+transaction as the save. SlimHistoricalRecords can be told per model:
+
+- counter_fields: fields that are only derived counters, such as reg_count.
+  Saves that only update counter fields (with update_fields) are not
+  recorded, since the counters can be recomputed at any time.
+- defer: history records of saves made in a transaction are kept in memory,
+  and written with one bulk insert per model after the transaction
+  commits, instead of one insert per save inside the transaction. Nothing
+  is written if the transaction rolls back.
+
+Saves made inside a savepoint, or outside a transaction, are recorded right
+away as usual, since a savepoint may be rolled back on its own. Deferring
+can be turned off everywhere with the HISTORY_DEFER_WRITES setting.
+
+Deferred records are bulk inserted, so the pre_create_historical_record and
+post_create_historical_record signals are not sent for them.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections, router
+from django.utils import timezone
+from simple_history.models import HistoricalRecords
+from simple_history.utils import get_change_reason_from_object
+
+
+logger = logging.getLogger(__name__)
+
+# Buffers of deferred history records, by database alias
+_buffers = threading.local()
+
+
+class HistoryBuffer:
+    """
+    History records waiting for the transaction they were made in to
+    commit, grouped by historical model.
+    """
+    def __init__(self, using):
+        self.using = using
+        self.records = {}
+
+    def add(self, history_instance):
+        self.records.setdefault(type(history_instance), []) \
+            .append(history_instance)
+
+    def flush(self):
+        """Writes the records, with one bulk insert per historical model."""
+        if getattr(_buffers, self.using, None) is self:
+            delattr(_buffers, self.using)
+        for model, records in self.records.items():
+            try:
+                model.objects.using(self.using).bulk_create(records)
+            except Exception:
+                # The transaction has committed, so only the history is lost
+                logger.exception("Failed to write %d %s records",
+                    len(records), model.__name__)
+
+
+def get_history_buffer(using):
+    """
+    Returns the buffer of deferred history records for the transaction
+    running on a database, or None if records cannot be deferred because
+    there is no transaction, or a savepoint is open.
+    """
+    connection = connections[using]
+    if not connection.in_atomic_block or connection.savepoint_ids:
+        return None
+
+    # A buffer whose flush is no longer registered belongs to a transaction
+    # that was rolled back
+    buffer = getattr(_buffers, using, None)
+    if buffer is None or not any(
+            func == buffer.flush for _, func in connection.run_on_commit):
+        buffer = HistoryBuffer(using)
+        setattr(_buffers, using, buffer)
+        connection.on_commit(buffer.flush)
+    return buffer
+
+
+class SlimHistoricalRecords(HistoricalRecords):
+    """
+    HistoricalRecords that skips saves of counter fields, and can defer
+    writing history records until the transaction commits.
+    """
+    def __init__(self, *args, counter_fields=(), defer=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter_fields = frozenset(counter_fields)
+        self.defer = defer
+
+    def create_history_model(self, model, inherited):
+        history_model = super().create_history_model(model, inherited)
+        # Tools working on history records, like compaction, need these too
+        history_model.counter_fields = self.counter_fields
+        return history_model
+
+    def post_save(self, instance, created, using=None, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if (not created and update_fields and
+                update_fields <= self.counter_fields):
+            return
+        super().post_save(instance, created, using=using, **kwargs)
+
+    def create_historical_record(self, instance, history_type, using=None):
+        manager = getattr(instance, self.manager_name)
+        buffer = None
+        if self.defer and getattr(settings, 'HISTORY_DEFER_WRITES', True):
+            buffer = get_history_buffer(
+                using if self.use_base_model_db and using else
+                router.db_for_write(manager.model, instance=instance))
+        if buffer is None:
+            return super().create_historical_record(
+                instance, history_type, using=using)
+
+        attrs = {
+            field.attname: getattr(instance, field.attname)
+            for field in self.fields_included(instance)
+        }
+        buffer.add(manager.model(
+            history_date=getattr(instance, '_history_date', timezone.now()),
+            history_type=history_type,
+            history_user=self.get_history_user(instance),
+            history_change_reason=get_change_reason_from_object(instance),
+            **attrs
+        ))
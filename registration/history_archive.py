@@ -0,0 +1,311 @@
+"""
+Archival of the history records of finished courses. The historical tables
+of django-simple-history keep every version of every row of every course,
+so they are moved out of the database once a course is over, to gzipped
+JSON lines files partitioned by month of history_date:
+
+    <root>/<course code>/<historical model>/<YYYY-MM>.jsonl.gz
+
+Records are read with a streaming query, written to their files, and only
+then deleted, in batches. Archiving a course again appends any newer
+records to the same files. A course's records can be restored from its
+files at any time; records already in the database are skipped, so
+restoring twice is harmless.
+
+Records of objects deleted since are archived too, since they are found by
+course through the history of the exams and course users, not the live
+tables. Secret fields, such as GitHub access tokens, are left out of the
+files, and are blank in restored records.
+"""
+import datetime
+import glob
+import gzip
+import json
+import os
+
+from django.db import transaction
+
+from .models import (
+    Course, CourseUser, Exam, ExamRegistration, ExamSlot, GithubToken, Room,
+    TimeSlot,
+)
+
+
+# Models whose history is archived by course, in the order it is restored
+ARCHIVED_MODELS = [
+    Course, CourseUser, GithubToken, Room, Exam, TimeSlot, ExamSlot,
+    ExamRegistration,
+]
+
+# Fields that are never written to the archive, by model
+SECRET_FIELDS = {
+    GithubToken: frozenset(['access_token']),
+}
+
+# Fields of historical models describing the change, not the object
+HISTORY_FIELDS = frozenset([
+    'history_id', 'history_date', 'history_change_reason', 'history_type',
+    'history_user_id',
+])
+
+
+def get_history_models():
+    """Returns the historical models that are archived, in order."""
+    return [model.history.model for model in ARCHIVED_MODELS]
+
+
+def get_course_history(course_pk):
+    """
+    Returns (historical model, queryset) pairs of the history records of a
+    course, including those of objects that have since been deleted.
+    """
+    # Looked up front, since the records they come from may be deleted
+    # before the records that refer to them
+    exam_pks = set(Exam.history
+        .filter(course_id=course_pk)
+        .values_list('id', flat=True))
+    course_user_pks = set(CourseUser.history
+        .filter(course_id=course_pk)
+        .values_list('id', flat=True))
+
+    return [
+        (Course.history.model, Course.history.filter(id=course_pk)),
+        (CourseUser.history.model,
+            CourseUser.history.filter(course_id=course_pk)),
+        (GithubToken.history.model,
+            GithubToken.history.filter(course_user_id__in=course_user_pks)),
+        (Room.history.model, Room.history.filter(course_id=course_pk)),
+        (Exam.history.model, Exam.history.filter(course_id=course_pk)),
+        (TimeSlot.history.model,
+            TimeSlot.history.filter(exam_id__in=exam_pks)),
+        (ExamSlot.history.model,
+            ExamSlot.history.filter(exam_id__in=exam_pks)),
+        (ExamRegistration.history.model,
+            ExamRegistration.history.filter(exam_id__in=exam_pks)),
+    ]
+
+
+def get_archived_fields(history_model):
+    """Returns the names of the fields of a historical model archived."""
+    secret_fields = SECRET_FIELDS.get(history_model.instance_type, ())
+    return [
+        field.attname for field in history_model._meta.concrete_fields
+        if field.attname not in secret_fields
+    ]
+
+
+def is_course_finished(course, now):
+    """Returns whether every time slot of a course has ended by now."""
+    return not TimeSlot.objects \
+        .filter(exam__course=course, end_time__gt=now) \
+        .exists()
+
+
+def batches(iterable, size):
+    """Yields lists of up to size items of an iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _delete(history_model, history_pks, batch_size):
+    for batch in batches(history_pks, batch_size):
+        history_model._default_manager \
+            .filter(history_id__in=batch) \
+            .delete()
+
+
+def encode_value(value):
+    """
+    Encodes a field value that JSON has no type for. Unlike
+    DjangoJSONEncoder, keeps every digit of the microseconds.
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+class PartitionWriter:
+    """
+    Writes history records to gzipped JSON lines files in a directory, one
+    per month of history_date. Records should be written in order of
+    history_date, so that each file is only opened once.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.partition = None
+        self.file = None
+
+    def write(self, record):
+        partition = record['history_date'] \
+            .astimezone(datetime.timezone.utc) \
+            .strftime('%Y-%m')
+        if partition != self.partition:
+            self.close()
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = gzip.open(
+                os.path.join(self.directory, partition + '.jsonl.gz'),
+                'at', encoding='utf-8')
+            self.partition = partition
+        self.file.write(json.dumps(record, default=encode_value) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.partition = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_records(directory):
+    """
+    Yields the history records in the files of a directory written by
+    PartitionWriter, as dicts of JSON values.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, '*.jsonl.gz'))):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def find_compactable(records, pk_name, counter_fields):
+    """
+    Yields the history_id of each record in a run of changes to only
+    counter fields, other than the last record of the run. records are
+    dicts ordered by object, then history_date.
+    """
+    previous = None
+    previous_counter_only = False
+    for record in records:
+        tracked = {
+            name: value for name, value in record.items()
+            if name not in HISTORY_FIELDS and name not in counter_fields
+        }
+        counter_only = (
+            previous is not None and
+            previous[0][pk_name] == record[pk_name] and
+            record['history_type'] == '~' and
+            previous[1] == tracked
+        )
+        if counter_only and previous_counter_only:
+            yield previous[0]['history_id']
+        previous = (record, tracked)
+        previous_counter_only = counter_only
+
+
+def compact_history(course, batch_size=500, dry_run=False):
+    """
+    Deletes the history records of a course that only changed counter
+    fields, such as reg_count, keeping the last record of each run of such
+    changes to an object. If dry_run is true, nothing is deleted.
+
+    Returns a dict mapping the label of each historical model with counter
+    fields to the number of records deleted.
+    """
+    counts = {}
+    for history_model, records in get_course_history(course.pk):
+        counter_fields = getattr(history_model, 'counter_fields', ())
+        if not counter_fields:
+            continue
+
+        pk_name = history_model.instance_type._meta.pk.attname
+        fields = [
+            field.attname for field in history_model._meta.concrete_fields
+        ]
+        history_pks = list(find_compactable(
+            records
+                .order_by(pk_name, 'history_date', 'history_id')
+                .values(*fields)
+                .iterator(chunk_size=batch_size),
+            pk_name, counter_fields))
+        if not dry_run:
+            _delete(history_model, history_pks, batch_size)
+        counts[history_model._meta.label_lower] = len(history_pks)
+    return counts
+
+
+def archive_history(course, root, batch_size=500, dry_run=False):
+    """
+    Moves the history records of a course to files under root, deleting
+    them in batches of batch_size once they are written. If dry_run is
+    true, records are only counted.
+
+    Returns a dict mapping the label of each historical model to the number
+    of records archived.
+    """
+    directory = os.path.join(root, course.code)
+    counts = {}
+    for history_model, records in get_course_history(course.pk):
+        label = history_model._meta.label_lower
+        if dry_run:
+            counts[label] = records.count()
+            continue
+
+        fields = get_archived_fields(history_model)
+        history_pks = []
+        with PartitionWriter(os.path.join(directory, label)) as writer:
+            for record in records \
+                    .order_by('history_date', 'history_id') \
+                    .values(*fields) \
+                    .iterator(chunk_size=batch_size):
+                writer.write(record)
+                history_pks.append(record['history_id'])
+
+        _delete(history_model, history_pks, batch_size)
+        counts[label] = len(history_pks)
+    return counts
+
+
+def restore_history(course_code, root, batch_size=500):
+    """
+    Restores the archived history records of a course from the files under
+    root, in a single transaction, skipping records already in the
+    database. Raises ValueError if the course has no archive.
+
+    Returns a dict mapping the label of each historical model to the number
+    of records restored.
+    """
+    directory = os.path.join(root, course_code)
+    if not os.path.isdir(directory):
+        raise ValueError("No archived history for {}".format(course_code))
+
+    counts = {}
+    with transaction.atomic():
+        for history_model in get_history_models():
+            label = history_model._meta.label_lower
+            fields = {
+                field.attname: field
+                for field in history_model._meta.concrete_fields
+            }
+            manager = history_model._default_manager
+
+            restored = 0
+            for batch in batches(
+                    read_records(os.path.join(directory, label)), batch_size):
+                records = {record['history_id']: record for record in batch}
+                existing = set(manager
+                    .filter(history_id__in=list(records))
+                    .values_list('history_id', flat=True))
+                new_records = [
+                    history_model(**{
+                        name: fields[name].to_python(value)
+                        for name, value in record.items()
+                    })
+                    for history_pk, record in records.items()
+                    if history_pk not in existing
+                ]
+                manager.bulk_create(new_records)
+                restored += len(new_records)
+            counts[label] = restored
+    return counts
@@ -0,0 +1,174 @@
+"""
+Per-view instrumentation. InstrumentationMiddleware (in middleware.py)
+uses this to record the number of SQL queries, SQL time, total time and
+response size of every request, to keep a rolling summary of recent
+requests for each view, and to log each request to the
+'registration.instrumentation' logger.
+
+Views can declare a query budget with the query_budget decorator. What
+happens when a request goes over budget is set by QUERY_BUDGET_ACTION:
+'warn' logs a warning, and 'raise' raises QueryBudgetExceeded, which
+makes the request (and any test making it) fail.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Number of recent requests to summarize for each view
+SUMMARY_SIZE = 200
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a view makes more queries than its budget allows."""
+
+
+def query_budget(max_queries):
+    """
+    Decorator that declares the maximum number of SQL queries a request to
+    a view may make, from the time the view is called until the response
+    has been through all middleware.
+    """
+    def decorator(view_func):
+        view_func.query_budget = max_queries
+        return view_func
+    return decorator
+
+
+class QueryRecorder:
+    """Database execute wrapper counting queries and the time they take."""
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        # Number of queries made before the view was called
+        self.view_start = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+
+
+class ViewStats:
+    """Rolling summary of the most recent requests to each view."""
+    def __init__(self, size=SUMMARY_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, view_name, sample):
+        with self.lock:
+            if view_name not in self.samples:
+                self.samples[view_name] = deque(maxlen=self.size)
+            self.samples[view_name].append(sample)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        """
+        Returns a dict mapping each view name to statistics over its recent
+        requests. Times are in milliseconds, and sizes in bytes.
+        """
+        with self.lock:
+            samples = {
+                view_name: list(view_samples)
+                for view_name, view_samples in self.samples.items()
+            }
+
+        def percentile(values, p):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+        summary = {}
+        for view_name, view_samples in samples.items():
+            total_times = [sample['total_ms'] for sample in view_samples]
+            queries = [sample['queries'] for sample in view_samples]
+            view_queries = [
+                sample['view_queries'] for sample in view_samples
+            ]
+            sizes = [
+                sample['size'] for sample in view_samples
+                if sample['size'] is not None
+            ]
+            summary[view_name] = {
+                'requests': len(view_samples),
+                'queries_mean': sum(queries) / len(queries),
+                'queries_max': max(queries),
+                'view_queries_max': max(view_queries),
+                'sql_ms_mean': sum(
+                    sample['sql_ms'] for sample in view_samples
+                ) / len(view_samples),
+                'total_ms_p50': percentile(total_times, 50),
+                'total_ms_p95': percentile(total_times, 95),
+                'size_mean': sum(sizes) / len(sizes) if sizes else None,
+                'over_budget': sum(
+                    1 for sample in view_samples if sample['over_budget']
+                ),
+            }
+        return summary
+
+
+# Summary of the requests handled by this process
+view_stats = ViewStats()
+
+
+def get_view_name(request):
+    """Returns the URL name of the view that handled a request."""
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return None
+    return resolver_match.url_name or resolver_match.view_name
+
+
+def get_query_budget(request):
+    """Returns the query budget of the view that handled a request."""
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return None
+    return getattr(resolver_match.func, 'query_budget', None)
+
+
+def record_request(request, response, recorder, total_time):
+    """
+    Records a request in the summary and the log, and enforces the query
+    budget of its view.
+    """
+    view_name = get_view_name(request)
+    if view_name is None:
+        return
+
+    view_queries = recorder.count - recorder.view_start
+    budget = get_query_budget(request)
+    over_budget = budget is not None and view_queries > budget
+    sample = {
+        'view': view_name,
+        'method': request.method,
+        'status': response.status_code,
+        'queries': recorder.count,
+        'view_queries': view_queries,
+        'query_budget': budget,
+        'over_budget': over_budget,
+        'sql_ms': round(recorder.time * 1000, 3),
+        'total_ms': round(total_time * 1000, 3),
+        'size': None if response.streaming else len(response.content),
+    }
+    view_stats.add(view_name, sample)
+    logger.info(json.dumps(sample), extra={'instrumentation': sample})
+
+    if over_budget:
+        message = "View {} made {} queries, over its budget of {}".format(
+            view_name, view_queries, budget)
+        if getattr(settings, 'QUERY_BUDGET_ACTION', 'warn') == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
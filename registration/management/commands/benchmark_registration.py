@@ -0,0 +1,102 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from registration.benchmark import (
+    SCENARIOS, benchmark_database, percentile, reset_registrations,
+    run_scenario, seed_exam,
+)
+from registration.models import CourseUser
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the registration views as on registration day, running "
+        "each scenario at increasing concurrency and reporting latency "
+        "percentiles, query counts, and abort and retry rates. Runs against "
+        "a throwaway test database, so no existing data is touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,4,16',
+            help="Comma-separated numbers of simultaneous workers.")
+        parser.add_argument('--requests', type=int, default=200,
+            help="Number of requests made at each concurrency level.")
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+            help="Comma-separated scenarios to run, out of: {}.".format(
+                ', '.join(SCENARIOS)))
+        parser.add_argument('--students', type=int, default=2000,
+            help="Number of students enrolled in the course.")
+        parser.add_argument('--rooms', type=int, default=4,
+            help="Number of rooms the exam takes place in.")
+        parser.add_argument('--days', type=int, default=2,
+            help="Number of days the exam takes place on.")
+        parser.add_argument('--max-retries', type=int, default=2,
+            help="Number of times to retry a request that aborts.")
+        parser.add_argument('--seed', type=int, default=0,
+            help="Random seed used to seed data and pick requests.")
+
+    def handle(self, *args, **options):
+        levels = [int(n) for n in options['workers'].split(',')]
+        scenarios = options['scenarios'].split(',')
+        for name in scenarios:
+            if name not in SCENARIOS:
+                raise CommandError("Unknown scenario {}".format(name))
+
+        with benchmark_database():
+            data = seed_exam(
+                num_students=options['students'],
+                num_rooms=options['rooms'],
+                num_days=options['days'],
+                seed=options['seed'],
+            )
+            self.stdout.write(
+                "{} database; {} students; {} normal and {} extended time "
+                "exam slots".format(
+                    connection.vendor,
+                    len(data.students),
+                    len(data.exam_slot_pks[CourseUser.NORMAL]),
+                    len(data.exam_slot_pks[CourseUser.EXTENDED_TIME]),
+                )
+            )
+
+            self.stdout.write(
+                "{:<20} {:>7} {:>8} {:>8} {:>8} {:>8} {:>10} {:>8} {:>8} "
+                "{:>8} {:>7}".format(
+                    'scenario', 'workers', 'p50 ms', 'p90 ms', 'p99 ms',
+                    'queries', 'requests/s', 'ok', 'rejected', 'aborts',
+                    'retries',
+                )
+            )
+            for name in scenarios:
+                for num_workers in levels:
+                    reset_registrations(data)
+                    result = run_scenario(
+                        name, data, num_workers, options['requests'],
+                        max_retries=options['max_retries'],
+                        seed=options['seed'],
+                    )
+                    self.write_result(result)
+
+    def write_result(self, result):
+        num_requests = len(result.latencies)
+        outcomes = result.outcomes
+
+        def rate(count):
+            return "{:.1%}".format(count / num_requests)
+
+        self.stdout.write(
+            "{:<20} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>10.1f} "
+            "{:>8} {:>8} {:>8} {:>7}".format(
+                result.name,
+                result.workers,
+                percentile(result.latencies, 50) * 1000,
+                percentile(result.latencies, 90) * 1000,
+                percentile(result.latencies, 99) * 1000,
+                sum(result.query_counts) / num_requests,
+                num_requests / result.elapsed,
+                outcomes['ok'],
+                outcomes['rejected'],
+                rate(outcomes['abort'] + outcomes['error']),
+                rate(result.retries),
+            )
+        )
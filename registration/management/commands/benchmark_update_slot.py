@@ -0,0 +1,161 @@
+import random
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from registration.benchmark import benchmark_database
+from registration.models import (
+    User, Course, CourseUser, Exam, TimeSlot, ExamSlot, ExamRegistration,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the throughput of ExamRegistration.update_slot() as the "
+        "number of simultaneous bookers grows. Runs against a throwaway "
+        "test database, so no existing data is touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookers', default='1,2,4,8,16',
+            help="Comma-separated numbers of simultaneous bookers.")
+        parser.add_argument('--bookings', type=int, default=400,
+            help="Number of bookings made at each concurrency level.")
+        parser.add_argument('--time-slots', type=int, default=24,
+            help="Number of consecutive time slots in the exam.")
+        parser.add_argument('--span', type=int, default=4,
+            help="Number of time slots covered by each exam slot.")
+        parser.add_argument('--seed', type=int, default=0,
+            help="Random seed used to pick exam slots.")
+
+    def handle(self, *args, **options):
+        levels = [int(n) for n in options['bookers'].split(',')]
+
+        with benchmark_database():
+            self.run_benchmark(levels, options)
+
+    def run_benchmark(self, levels, options):
+        num_bookings = options['bookings']
+        exam_slot_pks = self.make_exam(
+            num_time_slots=options['time_slots'],
+            span=options['span'],
+            capacity=num_bookings * len(levels),
+        )
+
+        # Show that a booking costs a fixed number of statements
+        exam_reg_pks = self.make_registrations(1)
+        with CaptureQueriesContext(connection) as queries:
+            ExamRegistration.update_slot(exam_reg_pks[0], exam_slot_pks[0])
+        self.stdout.write(
+            "{} exam slots sharing {} time slots; {} statements per "
+            "booking".format(
+                len(exam_slot_pks), options['time_slots'], len(queries),
+            )
+        )
+
+        rng = random.Random(options['seed'])
+        self.stdout.write("{:>8} {:>9} {:>7} {:>9} {:>11}".format(
+            'bookers', 'bookings', 'aborts', 'seconds', 'bookings/s'))
+
+        for num_bookers in levels:
+            exam_reg_pks = self.make_registrations(num_bookings)
+            jobs = [
+                (exam_reg_pk, rng.choice(exam_slot_pks))
+                for exam_reg_pk in exam_reg_pks
+            ]
+            booked, aborts, elapsed = self.run_level(jobs, num_bookers)
+            self.stdout.write("{:>8} {:>9} {:>7} {:>9.3f} {:>11.1f}".format(
+                num_bookers, booked, aborts, elapsed, booked / elapsed))
+
+    def make_exam(self, num_time_slots, span, capacity):
+        """Creates an exam with overlapping exam slots; returns their pks."""
+        self.course = Course.objects.create(
+            code='bench-{}'.format(time.time()),
+            name="Benchmark course",
+        )
+        exam = Exam.objects.create(course=self.course, name="Benchmark exam")
+
+        start = timezone.now()
+        time_slots = [
+            TimeSlot.objects.create(
+                exam=exam,
+                start_time=start + timedelta(minutes=30 * i),
+                end_time=start + timedelta(minutes=30 * (i + 1)),
+                capacity=capacity,
+            )
+            for i in range(num_time_slots)
+        ]
+
+        exam_slot_pks = []
+        for i in range(num_time_slots - span + 1):
+            exam_slot = ExamSlot.objects.create(
+                exam=exam,
+                start_time_slot=time_slots[i],
+            )
+            exam_slot.time_slots.set(time_slots[i:i + span])
+            exam_slot_pks.append(exam_slot.pk)
+
+        self.exam = exam
+        return exam_slot_pks
+
+    def make_registrations(self, n):
+        """Enrolls n new students in the exam; returns registration pks."""
+        exam_reg_pks = []
+        for _ in range(n):
+            user = User.objects.create(
+                username='bench{}'.format(User.objects.count()),
+            )
+            course_user = CourseUser.objects.create(
+                user=user,
+                course=self.course,
+            )
+            exam_reg = ExamRegistration.objects.create(
+                exam=self.exam,
+                course_user=course_user,
+            )
+            exam_reg_pks.append(exam_reg.pk)
+        return exam_reg_pks
+
+    def run_level(self, jobs, num_bookers):
+        """
+        Runs the given (exam_reg_pk, exam_slot_pk) bookings using the given
+        number of threads. Returns (booked, aborts, elapsed seconds).
+        """
+        lock = threading.Lock()
+        results = {'booked': 0, 'aborts': 0}
+        jobs = list(jobs)
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if not jobs:
+                            return
+                        exam_reg_pk, exam_slot_pk = jobs.pop()
+                    try:
+                        ExamRegistration.update_slot(exam_reg_pk, exam_slot_pk)
+                    except IntegrityError:
+                        outcome = 'aborts'
+                    except DatabaseError:
+                        outcome = 'aborts'
+                    else:
+                        outcome = 'booked'
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(num_bookers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        return results['booked'], results['aborts'], elapsed
@@ -0,0 +1,97 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from django.utils import timezone
+
+from registration.course_archive import (
+    archive_course, get_snapshot_path, list_archived_courses, restore_course,
+)
+from registration.history_archive import archive_history, is_course_finished
+from registration.models import Course
+
+
+class Command(BaseCommand):
+    help = (
+        "Archives a finished course to a snapshot file and removes it from "
+        "the database, restores an archived course, or lists archived "
+        "courses."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action',
+            choices=['archive', 'restore', 'list'],
+            help="What to do.")
+        parser.add_argument('course_code', nargs='?',
+            help="Code of the course, e.g. 15213-m18.")
+        parser.add_argument('--root',
+            default=getattr(settings, 'COURSE_ARCHIVE_ROOT', None),
+            help="Directory of the snapshots. Defaults to the "
+                 "COURSE_ARCHIVE_ROOT setting.")
+        parser.add_argument('--with-history', action='store_true',
+            help="Also archive the history of the course, to the "
+                 "HISTORY_ARCHIVE_ROOT directory.")
+        parser.add_argument('--batch-size', type=int, default=500,
+            help="Number of rows to delete or restore per statement.")
+        parser.add_argument('--force', action='store_true',
+            help="Archive the course even if it has time slots that have "
+                 "not ended.")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        root = options['root']
+        if not root:
+            raise CommandError("No archive directory given")
+        if action == 'list':
+            for course_code in list_archived_courses(root):
+                self.stdout.write(course_code)
+            return
+        if not options['course_code']:
+            raise CommandError("No course code given")
+        if options['batch_size'] <= 0:
+            raise CommandError("--batch-size must be positive")
+
+        if action == 'restore':
+            try:
+                counts = restore_course(options['course_code'], root,
+                    batch_size=options['batch_size'])
+            except (ValueError, IntegrityError) as e:
+                raise CommandError(
+                    "Failed to restore {}: {}".format(
+                        options['course_code'], e))
+            self.write_counts("Restored", counts)
+            return
+
+        try:
+            course = Course.objects.get(code=options['course_code'])
+        except Course.DoesNotExist:
+            raise CommandError("Course {} does not exist".format(
+                options['course_code']))
+        if not options['force'] and \
+                not is_course_finished(course, timezone.now()):
+            raise CommandError(
+                "Course {} has time slots that have not ended; use --force "
+                "to archive it anyway".format(course.code))
+        if os.path.exists(get_snapshot_path(root, course.code)):
+            raise CommandError(
+                "A course {} is already archived".format(course.code))
+
+        if options['with_history']:
+            history_root = getattr(settings, 'HISTORY_ARCHIVE_ROOT', None)
+            if not history_root:
+                raise CommandError("HISTORY_ARCHIVE_ROOT is not set")
+            self.write_counts("Archived",
+                archive_history(course, history_root,
+                    batch_size=options['batch_size']))
+
+        try:
+            counts = archive_course(course, root,
+                batch_size=options['batch_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.write_counts("Archived", counts)
+
+    def write_counts(self, verb, counts):
+        for label, count in counts.items():
+            self.stdout.write("{} {} {} rows".format(verb, count, label))
@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from registration.models import Exam
+from registration.retry import TransactionConflict
+from registration.slot_generator import create_schedule, parse_schedule_spec
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates the time slots and exam slots of an exam from a JSON "
+        "schedule spec (see registration/slot_generator.py)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('exam_id', type=int,
+            help="ID of the exam to add time slots and exam slots to.")
+        parser.add_argument('spec_file',
+            help="Path to the JSON schedule spec.")
+        parser.add_argument('--dry-run', action='store_true',
+            help="Report what would be created without creating it.")
+
+    def handle(self, *args, **options):
+        try:
+            exam = Exam.objects.get(pk=options['exam_id'])
+        except Exam.DoesNotExist:
+            raise CommandError(
+                "Exam {} does not exist".format(options['exam_id']))
+
+        try:
+            with open(options['spec_file']) as f:
+                spec = parse_schedule_spec(json.load(f))
+            schedule = create_schedule(exam, spec,
+                dry_run=options['dry_run'])
+        except (ValueError, IntegrityError, TransactionConflict) as e:
+            raise CommandError("Failed to generate slots: {}".format(e))
+
+        self.stdout.write(
+            "{} {} time slots and {} exam slots.".format(
+                "Would create" if options['dry_run'] else "Created",
+                len(schedule.time_slots), len(schedule.exam_slots))
+        )
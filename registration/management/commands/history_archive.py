@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from registration.history_archive import (
+    archive_history, compact_history, is_course_finished, restore_history,
+)
+from registration.models import Course
+
+
+class Command(BaseCommand):
+    help = (
+        "Archives the history records of a finished course to compressed "
+        "files and deletes them from the database, compacts runs of "
+        "counter-only changes, or restores archived records."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action',
+            choices=['archive', 'compact', 'restore'],
+            help="What to do with the history of the course.")
+        parser.add_argument('course_code',
+            help="Code of the course, e.g. 15213-m18.")
+        parser.add_argument('--root',
+            default=getattr(settings, 'HISTORY_ARCHIVE_ROOT', None),
+            help="Directory of the archive. Defaults to the "
+                 "HISTORY_ARCHIVE_ROOT setting.")
+        parser.add_argument('--compact', action='store_true',
+            help="Compact the history before archiving it.")
+        parser.add_argument('--batch-size', type=int, default=500,
+            help="Number of records to delete or restore per statement.")
+        parser.add_argument('--force', action='store_true',
+            help="Archive the history even if the course has time slots "
+                 "that have not ended.")
+        parser.add_argument('--dry-run', action='store_true',
+            help="Only report the number of records that would be archived "
+                 "or compacted.")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action != 'compact' and not options['root']:
+            raise CommandError("No archive directory given")
+        if options['batch_size'] <= 0:
+            raise CommandError("--batch-size must be positive")
+
+        if action == 'restore':
+            try:
+                counts = restore_history(options['course_code'],
+                    options['root'], batch_size=options['batch_size'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.write_counts("Restored", counts)
+            return
+
+        try:
+            course = Course.objects.get(code=options['course_code'])
+        except Course.DoesNotExist:
+            raise CommandError("Course {} does not exist".format(
+                options['course_code']))
+
+        if action == 'archive' and not options['force'] and \
+                not is_course_finished(course, timezone.now()):
+            raise CommandError(
+                "Course {} has time slots that have not ended; use --force "
+                "to archive its history anyway".format(course.code))
+
+        if action == 'compact' or options['compact']:
+            counts = compact_history(course,
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'])
+            self.write_counts(
+                "Would compact" if options['dry_run'] else "Compacted",
+                counts)
+
+        if action == 'archive':
+            counts = archive_history(course, options['root'],
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'])
+            self.write_counts(
+                "Would archive" if options['dry_run'] else "Archived",
+                counts)
+
+    def write_counts(self, verb, counts):
+        for label, count in counts.items():
+            self.stdout.write("{} {} {} records".format(verb, count, label))
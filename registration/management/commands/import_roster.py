@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from registration.models import Course
+from registration.retry import TransactionConflict
+from registration.roster import import_roster_from_csv_file
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports a course roster from a CSV file in the Autolab format, "
+        "creating users and course users that do not exist yet."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_code',
+            help="Code of the course to import into, e.g. 15213-m18.")
+        parser.add_argument('roster_file',
+            help="Path to the CSV roster file.")
+
+    def handle(self, *args, **options):
+        try:
+            course = Course.objects.get(code=options['course_code'])
+        except Course.DoesNotExist:
+            raise CommandError(
+                "Course {} does not exist".format(options['course_code']))
+
+        try:
+            with open(options['roster_file'], 'rb') as f:
+                created_count, skipped_count = \
+                    import_roster_from_csv_file(course, f)
+        except (ValueError, IntegrityError, TransactionConflict) as e:
+            raise CommandError("Failed to import roster: {}".format(e))
+
+        self.stdout.write(
+            "{} users were created, and {} users were skipped.".format(
+                created_count, skipped_count)
+        )
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from registration.models import CourseUser, ExamSlot
+from registration.retry import TransactionConflict
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the registrations of an exam slot to other exam slots of the "
+        "same exam, e.g. when its room becomes unavailable."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('exam_slot_id', type=int,
+            help="ID of the exam slot to move registrations out of.")
+        parser.add_argument('--to', type=int, action='append',
+            dest='target_ids', metavar='EXAM_SLOT_ID', required=True,
+            help="Exam slot to move registrations to (may be repeated). "
+                 "Targets are filled in the order given.")
+        parser.add_argument('--user', action='append', dest='usernames',
+            metavar='USERNAME',
+            help="Only move this user's registration (may be repeated). "
+                 "Defaults to every registration.")
+        parser.add_argument('--force', action='store_true',
+            help="Overbook the targets if they do not have enough seats.")
+
+    def handle(self, *args, **options):
+        try:
+            exam_slot = ExamSlot.objects \
+                .select_related('exam') \
+                .get(pk=options['exam_slot_id'])
+        except ExamSlot.DoesNotExist:
+            raise CommandError("Exam slot {} does not exist".format(
+                options['exam_slot_id']))
+
+        course_user_pks = None
+        if options['usernames']:
+            course_users = dict(CourseUser.objects
+                .filter(course=exam_slot.exam.course_id,
+                    user__username__in=options['usernames'])
+                .values_list('user__username', 'pk'))
+            missing = set(options['usernames']) - set(course_users)
+            if missing:
+                raise CommandError("Users {} are not in the course".format(
+                    ', '.join(sorted(missing))))
+            course_user_pks = list(course_users.values())
+
+        try:
+            moved = ExamSlot.move_registrations(
+                exam_slot.pk, options['target_ids'],
+                course_user_pks=course_user_pks, force=options['force'])
+        except (IntegrityError, TransactionConflict) as e:
+            raise CommandError(
+                "Failed to move registrations: {}".format(e))
+
+        for target_pk, count in moved.items():
+            self.stdout.write("Moved {} registrations to exam slot {}".format(
+                count, target_pk))
@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from registration.models import Exam
+from registration.reconcile import reconcile_exam
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the registrations of exams and fixes any exam slot or "
+        "time slot reg_count that has drifted from them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--exam', type=int, action='append',
+            dest='exam_ids', metavar='EXAM_ID',
+            help="Only reconcile this exam (may be repeated). "
+                 "Defaults to every exam.")
+        parser.add_argument('--dry-run', action='store_true',
+            help="Report drifted counts without fixing them.")
+        parser.add_argument('--interval', type=float,
+            help="Keep running, reconciling every INTERVAL seconds.")
+
+    def handle(self, *args, **options):
+        exams = Exam.objects.select_related('course')
+        if options['exam_ids']:
+            exams = exams.filter(pk__in=options['exam_ids'])
+            missing = set(options['exam_ids']) - \
+                set(exams.values_list('pk', flat=True))
+            if missing:
+                raise CommandError("Exams {} do not exist".format(
+                    ', '.join(str(pk) for pk in sorted(missing))))
+
+        while True:
+            for exam in exams.all():
+                self.reconcile(exam, options['dry_run'])
+
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def reconcile(self, exam, dry_run):
+        exam_slot_diffs, time_slot_diffs = reconcile_exam(exam, dry_run)
+        num_diffs = len(exam_slot_diffs) + len(time_slot_diffs)
+        if not num_diffs:
+            return
+
+        self.stdout.write("{} {} (exam {}): {} {} drifted counts".format(
+            exam.course.code, exam, exam.pk,
+            "found" if dry_run else "fixed", num_diffs,
+        ))
+        for kind, diffs in [
+            ('Exam slot', exam_slot_diffs),
+            ('Time slot', time_slot_diffs),
+        ]:
+            for slot, old_reg_count, new_reg_count in diffs:
+                self.stdout.write("  {} {}: reg count {} -> {}".format(
+                    kind, slot, old_reg_count, new_reg_count))
@@ -0,0 +1,88 @@
+import datetime
+import time
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from registration import availability, membership
+from registration.models import Exam
+from registration.warmup import get_exams_to_warm, warm_exam
+
+
+class Command(BaseCommand):
+    help = (
+        "Warms the caches used by the exam page shortly before registration "
+        "for an exam opens (its lock_before), and reports how long it took. "
+        "The exam gate and exam slots stay warm after registration opens; "
+        "seat counts are reloaded with one query after the first booking."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--exam', type=int, action='append',
+            dest='exam_ids', metavar='EXAM_ID',
+            help="Warm this exam now, whenever its registration opens "
+                 "(may be repeated).")
+        parser.add_argument('--lead', type=float, default=300,
+            help="Warm exams whose registration opens within this many "
+                 "seconds.")
+        parser.add_argument('--ttl', type=float, default=600,
+            help="Seconds to keep warmed data after registration opens.")
+        parser.add_argument('--interval', type=float,
+            help="Keep running, checking for exams to warm every INTERVAL "
+                 "seconds.")
+
+    def handle(self, *args, **options):
+        for cache in [availability.get_cache(), membership.get_cache()]:
+            if isinstance(cache, LocMemCache):
+                self.stderr.write(
+                    "Warning: a local-memory cache is only seen by this "
+                    "process, so the web server will not see warmed data. "
+                    "Point AVAILABILITY_CACHE and MEMBERSHIP_CACHE at a "
+                    "shared cache."
+                )
+                break
+        if membership.get_cache() is None:
+            self.stderr.write(
+                "Note: MEMBERSHIP_CACHE is not set, so memberships are "
+                "loaded per request and are not warmed.")
+
+        if options['exam_ids']:
+            exams = Exam.objects \
+                .filter(pk__in=options['exam_ids']) \
+                .select_related('course')
+            missing = set(options['exam_ids']) - {exam.pk for exam in exams}
+            if missing:
+                raise CommandError("Exams {} do not exist".format(
+                    ', '.join(str(pk) for pk in sorted(missing))))
+            for exam in exams:
+                self.warm(exam, options['ttl'])
+            return
+
+        lead_time = datetime.timedelta(seconds=options['lead'])
+        warmed = set()
+        while True:
+            for exam in get_exams_to_warm(timezone.now(), lead_time):
+                # Warm each exam once, unless its opening time changes
+                if (exam.pk, exam.lock_before) not in warmed:
+                    self.warm(exam, options['ttl'])
+                    warmed.add((exam.pk, exam.lock_before))
+
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def warm(self, exam, ttl):
+        timeout = ttl
+        if exam.lock_before is not None:
+            timeout += max(0,
+                (exam.lock_before - timezone.now()).total_seconds())
+
+        result = warm_exam(exam, timeout)
+        self.stdout.write(
+            "{} {} (exam {}): warmed {} timelines and {} users' memberships "
+            "in {:.1f} ms".format(
+                exam.course.code, exam, exam.pk, result.timelines,
+                result.users, result.elapsed * 1000,
+            )
+        )
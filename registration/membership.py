@@ -0,0 +1,184 @@
+"""
+Resolves the courses a user is enrolled in. All of a user's course users
+are loaded at most once per request, in a single query.
+
+If MEMBERSHIP_CACHE names a cache, memberships are also cached across
+requests, keyed by a per-user version and a global version, which are
+bumped when a course user or course is saved or deleted. Code that changes
+course users without sending signals, such as bulk_create(), must call
+invalidate_all() itself.
+
+Memberships decide who is an instructor, and versions are only bumped in
+the cache of the process that made the change, so a local-memory cache
+would let other processes authorize users from stale memberships for up
+to MEMBERSHIP_CACHE_TIMEOUT seconds. Only point MEMBERSHIP_CACHE at a
+backend shared by every process serving the site, e.g. memcached.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Course, CourseUser
+
+
+def get_cache():
+    """
+    Returns the cache backend used for memberships, or None if they are
+    not cached across requests.
+    """
+    name = getattr(settings, 'MEMBERSHIP_CACHE', None)
+    return caches[name] if name is not None else None
+
+
+def _version_key(name):
+    return 'examreg:membership:{}:version'.format(name)
+
+
+def get_version(name):
+    """Returns the current version of the given membership key."""
+    cache = get_cache()
+    key = _version_key(name)
+
+    version = cache.get(key)
+    if version is None:
+        # Start from the current time, so that a version that was evicted
+        # from the cache never comes back with an earlier value
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name):
+    """Increments the version of the given membership key."""
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(name))
+    except ValueError:
+        # Version was never set or was evicted
+        get_version(name)
+
+
+def _invalidate(name):
+    if get_cache() is None:
+        return
+    # Bump immediately so this process sees the change, and again once the
+    # transaction commits, so that no other request can cache memberships
+    # from before the change under the new version
+    bump_version(name)
+    transaction.on_commit(lambda: bump_version(name))
+
+
+def invalidate_user(user_id):
+    """Invalidates the cached memberships of a user."""
+    _invalidate('user:{}'.format(user_id))
+
+
+def invalidate_all():
+    """Invalidates the cached memberships of every user."""
+    _invalidate('all')
+
+
+def load_memberships(user_id):
+    """
+    Returns a dict mapping course codes to the course users of a user,
+    with their courses selected, using a single query.
+    """
+    course_users = CourseUser.objects \
+        .filter(user=user_id) \
+        .select_related('course')
+    return {
+        course_user.course.code: course_user
+        for course_user in course_users
+    }
+
+
+def _memberships_key(user_id):
+    return 'examreg:membership:{}:{}:{}'.format(
+        user_id,
+        get_version('all'),
+        get_version('user:{}'.format(user_id)),
+    )
+
+
+def get_cached_memberships(user_id):
+    """
+    Returns load_memberships(user_id), cached until the memberships of the
+    user change if MEMBERSHIP_CACHE is set.
+    """
+    cache = get_cache()
+    if cache is None:
+        return load_memberships(user_id)
+    key = _memberships_key(user_id)
+
+    memberships = cache.get(key)
+    if memberships is None:
+        memberships = load_memberships(user_id)
+        cache.set(key, memberships,
+            getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 300))
+    return memberships
+
+
+def warm_memberships(course, timeout):
+    """
+    Loads the memberships of every user enrolled in a course with one
+    query, and caches them for timeout seconds. Returns the number of
+    users, which is 0 if MEMBERSHIP_CACHE is not set.
+    """
+    cache = get_cache()
+    if cache is None:
+        return 0
+
+    memberships = {}
+    course_users = CourseUser.objects \
+        .filter(user__in=course.course_user_set.values('user')) \
+        .select_related('course')
+    for course_user in course_users:
+        memberships.setdefault(course_user.user_id, {})[
+            course_user.course.code] = course_user
+
+    cache.set_many({
+        _memberships_key(user_id): user_memberships
+        for user_id, user_memberships in memberships.items()
+    }, timeout)
+    return len(memberships)
+
+
+def get_memberships(request):
+    """
+    Returns a dict mapping course codes to the course users of the request
+    user, loading them at most once per request.
+    """
+    if not hasattr(request, '_memberships'):
+        if request.user.is_authenticated:
+            request._memberships = get_cached_memberships(request.user.id)
+        else:
+            request._memberships = {}
+    return request._memberships
+
+
+def get_membership(request, course_code):
+    """
+    Returns the course user of the request user in the course with the
+    given code, or None if they are not enrolled in it.
+    """
+    return get_memberships(request).get(course_code)
+
+
+def course_user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+def course_changed(sender, instance, **kwargs):
+    invalidate_all()
+
+
+def connect_signals():
+    """Connects the signals that invalidate cached memberships."""
+    for signal in [post_save, post_delete]:
+        signal.connect(course_user_changed, sender=CourseUser,
+            dispatch_uid='membership_course_user_changed')
+        signal.connect(course_changed, sender=Course,
+            dispatch_uid='membership_course_changed')
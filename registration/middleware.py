@@ -1,13 +1,44 @@
-import pytz
+import time
 
+from django.db import connection
 from django.utils import timezone
 from django.utils.deprecation import MiddlewareMixin
 
+from .instrumentation import QueryRecorder, record_request
+from .timezones import DEFAULT_TIMEZONE, get_timezone
+
 
 class TimezoneMiddleware(MiddlewareMixin):
     def process_request(self, request):
+        tz = None
         if request.user.is_authenticated and request.user.timezone:
-            timezone.activate(pytz.timezone(request.user.timezone))
-        else:
-            # TODO: move to config file
-            timezone.activate('America/New_York')
+            tz = get_timezone(request.user.timezone)
+
+        # TODO: move to config file
+        timezone.activate(tz or get_timezone(DEFAULT_TIMEZONE))
+
+
+class InstrumentationMiddleware:
+    """
+    Records the queries, SQL time, total time and response size of each
+    request per view, and enforces query budgets. The time and size of
+    streaming responses only cover the view, not the streamed content.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        request.query_recorder = recorder
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        total_time = time.perf_counter() - start
+
+        record_request(request, response, recorder, total_time)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Queries made before the view runs (e.g. logging in) do not count
+        # towards its budget
+        request.query_recorder.view_start = request.query_recorder.count
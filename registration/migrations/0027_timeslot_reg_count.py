@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:31
+
+from django.db import migrations, models
+
+
+def set_reg_count(apps, schema_editor):
+    TimeSlot = apps.get_model('registration', 'TimeSlot')
+    for time_slot in TimeSlot.objects.all():
+        time_slot.reg_count = sum(
+            exam_slot.reg_count
+            for exam_slot in time_slot.exam_slot_set.all()
+        )
+        time_slot.save(update_fields=['reg_count'])
+
+
+def reverse_set_reg_count(apps, schema_editor):
+    # reg_count will be deleted when reversing
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0026_auto_20200622_0814'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timeslot',
+            name='reg_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(set_reg_count, reverse_set_reg_count),
+        migrations.AddField(
+            model_name='historicaltimeslot',
+            name='reg_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0027_timeslot_reg_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exam',
+            name='admission_limit',
+            field=models.PositiveIntegerField(blank=True, help_text='Most registration changes to process at once; others wait in a queue. Leave blank for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalexam',
+            name='admission_limit',
+            field=models.PositiveIntegerField(blank=True, help_text='Most registration changes to process at once; others wait in a queue. Leave blank for no limit.', null=True),
+        ),
+    ]
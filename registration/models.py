@@ -1,5 +1,3 @@
-import pytz
-
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
@@ -7,6 +5,11 @@ from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 from simple_history.models import HistoricalRecords
 
+from . import availability
+from .history import SlimHistoricalRecords
+from .retry import run_in_transaction
+from .timezones import is_valid_timezone
+
 
 class User(AbstractUser):
     """
@@ -26,9 +29,7 @@ class User(AbstractUser):
 
     def clean(self, *args, **kwargs):
         """Validates custom attributes in the User model."""
-        try:
-            pytz.timezone(self.timezone)
-        except pytz.exceptions.UnknownTimeZoneError:
+        if not is_valid_timezone(self.timezone):
             raise ValidationError(dict(timezone="Timezone is invalid."))
 
     def configure_new(self):
@@ -204,6 +205,12 @@ class Exam(models.Model):
     details = models.TextField(blank=True)
     lock_before = models.DateTimeField(null=True, blank=True)
     lock_after = models.DateTimeField(null=True, blank=True)
+    admission_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Most registration changes to process at once; others "
+            "wait in a queue. Leave blank for no limit.",
+    )
     history = HistoricalRecords()
 
     def __str__(self):
@@ -229,7 +236,19 @@ class TimeSlot(models.Model):
         blank=True,
     )
     capacity = models.PositiveIntegerField()
-    history = HistoricalRecords()
+    # Number of seats taken in this time slot, i.e. the sum of reg_count
+    # over every exam slot containing it. This field should ONLY BE
+    # CHANGED by the update_slot() function, using conditional updates,
+    # or fixed up by repair_reg_counts().
+    reg_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+    )
+    history = SlimHistoricalRecords(counter_fields=['reg_count'])
+
+    # Whether clean() queries for overlapping time slots. Set to False when
+    # overlaps are checked for many time slots at once, as by TimeSlotFormSet.
+    check_overlaps = True
 
     def count_num_registered(self):
         """
@@ -237,14 +256,51 @@ class TimeSlot(models.Model):
         during this slot. The value of this field should not be greater
         than the capacity of this time slot, unless overridden manually.
         """
-        # The aggregate performs worse due to prefetching!
-        #q = self.exam_slot_set \
-        #    .aggregate(overlap_count=models.Sum('reg_count'))
-        #return q['overlap_count']
-        return sum(
-            exam_slot.reg_count
-            for exam_slot in self.exam_slot_set.all()
-        )
+        return self.reg_count
+
+    def update_reg_count(self):
+        """Recounts the number of seats taken in this time slot."""
+        with transaction.atomic():
+            old_reg_count = self.reg_count
+            new_reg_count = self.exam_slot_set \
+                .aggregate(overlap_count=models.Sum('reg_count')) \
+                ['overlap_count'] or 0
+
+            self.reg_count = new_reg_count
+            self.save(update_fields=['reg_count'])
+
+        return 'Updated invalid reg count from {} to {}'.format(
+                old_reg_count, new_reg_count)
+
+    @classmethod
+    def repair_reg_counts(cls, exam):
+        """
+        Recounts the number of seats taken in every time slot of an exam,
+        fixing any counters that have drifted from the exam slot counts,
+        e.g. after the time slots of an exam slot were edited. Returns a
+        list of (time_slot, message) pairs for the time slots fixed.
+        """
+        time_slots = exam.time_slot_set \
+            .annotate(overlap_count=models.Sum('exam_slot_set__reg_count')) \
+            .order_by()
+
+        fixed = []
+        with transaction.atomic():
+            for time_slot in time_slots:
+                new_reg_count = time_slot.overlap_count or 0
+                if time_slot.reg_count == new_reg_count:
+                    continue
+
+                message = 'Updated invalid reg count from {} to {}'.format(
+                        time_slot.reg_count, new_reg_count)
+                cls.objects.filter(pk=time_slot.pk) \
+                    .update(reg_count=new_reg_count)
+                fixed.append((time_slot, message))
+
+            if fixed:
+                availability.invalidate(exam.pk)
+
+        return fixed
 
     def clean(self, *args, **kwargs):
         """Validates consistency of TimeSlot objects."""
@@ -262,6 +318,8 @@ class TimeSlot(models.Model):
             )))
 
         # Ensure no overlapping time slots
+        if not self.check_overlaps:
+            return
         q = TimeSlot.objects.exclude(pk=self.pk).filter(
             exam=self.exam,
             room=self.room,
@@ -307,7 +365,7 @@ class ExamSlot(models.Model):
         default=0,
         editable=False,
     )
-    history = HistoricalRecords()
+    history = SlimHistoricalRecords(counter_fields=['reg_count'])
 
     # Type of exam slot this is
     exam_slot_type = models.CharField(
@@ -352,13 +410,185 @@ class ExamSlot(models.Model):
             self.reg_count = new_reg_count
             self.save(update_fields=['reg_count'])
 
+            # Keep the time slot counters in sync
+            TimeSlot.objects.filter(exam_slot_set=self).update(
+                reg_count=models.F('reg_count') +
+                    (new_reg_count - old_reg_count))
+
+            availability.invalidate(self.exam_id)
+
         return 'Updated invalid reg count from {} to {}'.format(
                 old_reg_count, new_reg_count)
 
+    @classmethod
+    def reserve_seat(cls, exam_slot_pk, force=False):
+        """
+        Takes one seat in each time slot of an exam slot, and counts one
+        more registration for the exam slot. Must be called inside a
+        transaction.
+
+        Seats are taken with a conditional UPDATE on the time slot counters
+        rather than by locking and counting, so this costs a fixed number
+        of statements no matter how many exam slots share the time slots.
+
+        Returns whether every time slot had a seat left. If not, the caller
+        should roll back the transaction, unless force is True, in which
+        case the time slots are overbooked.
+        """
+        time_slots = TimeSlot.objects.filter(exam_slot_set=exam_slot_pk)
+
+        if force:
+            time_slots.update(reg_count=models.F('reg_count') + 1)
+            has_seats = not time_slots \
+                    .filter(reg_count__gt=models.F('capacity')) \
+                    .exists()
+        else:
+            num_time_slots = time_slots.count()
+            num_reserved = time_slots \
+                    .filter(reg_count__lt=models.F('capacity')) \
+                    .update(reg_count=models.F('reg_count') + 1)
+            has_seats = (num_reserved == num_time_slots)
+
+        cls.objects.filter(pk=exam_slot_pk) \
+                .update(reg_count=models.F('reg_count') + 1)
+
+        return has_seats
+
+    @classmethod
+    def release_seat(cls, exam_slot_pk):
+        """
+        Gives back the seats taken by reserve_seat(). Must be called inside
+        a transaction. Counters are never decremented below zero.
+        """
+        TimeSlot.objects \
+                .filter(exam_slot_set=exam_slot_pk, reg_count__gt=0) \
+                .update(reg_count=models.F('reg_count') - 1)
+        cls.objects \
+                .filter(pk=exam_slot_pk, reg_count__gt=0) \
+                .update(reg_count=models.F('reg_count') - 1)
+
+    @classmethod
+    def move_registrations(cls, exam_slot_pk, target_pks,
+            course_user_pks=None, force=False):
+        """
+        Moves the registrations of an exam slot to one or more target exam
+        slots of the same exam, e.g. when its room becomes unavailable.
+        Only the registrations of the given course users are moved, if
+        course_user_pks is given. Checked-in registrations are never moved.
+
+        Each registration goes to the first target of its course user's
+        exam slot type with a seat left, counting the seats given back by
+        the moved registrations. Capacity is checked once up front, and
+        the registrations, counters and history are written with a fixed
+        number of bulk statements per target, in one transaction.
+
+        Raises IntegrityError if there are no targets other than the exam
+        slot itself, or if a registration has no target to go to, unless
+        force is True, in which case targets are overbooked and exam slot
+        types are ignored as a last resort. Returns a dict mapping the pk
+        of each target to the number of registrations moved to it.
+        """
+        target_pks = [pk for pk in target_pks if pk != exam_slot_pk]
+        if not target_pks:
+            raise IntegrityError(
+                "No target exam slots other than the source exam slot")
+
+        def move():
+            exam_slot = cls.objects.select_for_update().get(pk=exam_slot_pk)
+            targets = {
+                target.pk: target
+                for target in cls.objects
+                    .select_for_update()
+                    .filter(pk__in=target_pks, exam=exam_slot.exam_id)
+            }
+            if len(targets) != len(set(target_pks)):
+                raise IntegrityError(
+                    "Target exam slots must belong to the same exam")
+
+            # Lock the time slots involved
+            slot_time_slot_pks = {pk: [] for pk in targets}
+            slot_time_slot_pks[exam_slot.pk] = []
+            for slot_pk, time_slot_pk in cls.time_slots.through.objects \
+                    .filter(examslot__in=slot_time_slot_pks) \
+                    .values_list('examslot', 'timeslot'):
+                slot_time_slot_pks[slot_pk].append(time_slot_pk)
+            time_slots = TimeSlot.objects.select_for_update().in_bulk({
+                pk for pks in slot_time_slot_pks.values() for pk in pks
+            })
+
+            exam_regs = ExamRegistration.objects \
+                .filter(exam_slot=exam_slot, checkin_time__isnull=True)
+            if course_user_pks is not None:
+                exam_regs = exam_regs.filter(course_user__in=course_user_pks)
+            exam_regs = list(exam_regs.select_related('course_user'))
+
+            # Count seats left as if every registration had been moved out
+            seats_left = {
+                pk: time_slot.capacity - time_slot.reg_count
+                for pk, time_slot in time_slots.items()
+            }
+            for pk in slot_time_slot_pks[exam_slot.pk]:
+                seats_left[pk] += len(exam_regs)
+
+            def has_seat(target):
+                return all(seats_left[pk] > 0
+                    for pk in slot_time_slot_pks[target.pk])
+
+            ordered_targets = [targets[pk] for pk in target_pks]
+            moves = {pk: [] for pk in target_pks}
+            for exam_reg in exam_regs:
+                same_type = [
+                    target for target in ordered_targets
+                    if target.exam_slot_type ==
+                        exam_reg.course_user.exam_slot_type
+                ]
+                target = next(filter(has_seat, same_type), None)
+                if target is None and force:
+                    target = next(iter(same_type or ordered_targets), None)
+                if target is None:
+                    raise IntegrityError(
+                        "Not enough seats left in the target exam slots "
+                        "for {}".format(exam_reg.course_user.user))
+
+                for pk in slot_time_slot_pks[target.pk]:
+                    seats_left[pk] -= 1
+                moves[target.pk].append(exam_reg.pk)
+
+            # Move the registrations
+            for target_pk, exam_reg_pks in moves.items():
+                if exam_reg_pks:
+                    ExamRegistration.objects \
+                        .filter(pk__in=exam_reg_pks) \
+                        .update(exam_slot=target_pk)
+            ExamRegistration.history.bulk_history_create(
+                ExamRegistration.objects.filter(
+                    pk__in=[exam_reg.pk for exam_reg in exam_regs]))
+
+            # Update the counters
+            exam_slot.reg_count = max(0, exam_slot.reg_count - len(exam_regs))
+            for pk in slot_time_slot_pks[exam_slot.pk]:
+                time_slots[pk].reg_count = max(0,
+                    time_slots[pk].reg_count - len(exam_regs))
+            for target_pk, exam_reg_pks in moves.items():
+                targets[target_pk].reg_count += len(exam_reg_pks)
+                for pk in slot_time_slot_pks[target_pk]:
+                    time_slots[pk].reg_count += len(exam_reg_pks)
+            cls.objects.bulk_update(
+                [exam_slot] + list(targets.values()), ['reg_count'])
+            TimeSlot.objects.bulk_update(time_slots.values(), ['reg_count'])
+
+            availability.invalidate(exam_slot.exam_id)
+            return {
+                target_pk: len(exam_reg_pks)
+                for target_pk, exam_reg_pks in moves.items()
+            }
+
+        return run_in_transaction(move, name='ExamSlot.move_registrations')
+
     def count_slots_left(self):
         """Counts the number of remaining slots for this exam slot."""
         return min(
-            time_slot.capacity - time_slot.count_num_registered()
+            time_slot.capacity - time_slot.reg_count
             for time_slot in self.time_slots.all()
         )
 
@@ -423,7 +653,7 @@ class ExamRegistration(models.Model):
         null=True,
         blank=True,
     )
-    history = HistoricalRecords()
+    history = SlimHistoricalRecords(defer=True)
 
     # Check-in fields
     checkin_room = models.ForeignKey(Room,
@@ -499,56 +729,58 @@ class ExamRegistration(models.Model):
 
 
         # Begin atomic section
+        # This is retried if it conflicts with another transaction, so it
+        # collects its own warnings rather than adding to the ones above
+        def update():
+            new_warnings = set()
+            exam_reg = ExamRegistration.objects \
+                    .select_related('course_user') \
+                    .get(pk=exam_reg_pk)
+
+            # Don't allow checked-in users to change.
+            if exam_reg.checkin_time:
+                new_warnings.add(
+                    "You have already been checked in for this exam"
+                )
+
+            # Clear exam slot (in transaction)
+            # This is so when reserving seats in time slots below,
+            # we don't include ourselves in the count
+            if exam_reg.exam_slot_id is not None:
+                ExamSlot.release_seat(exam_reg.exam_slot_id)
+
+
+            # Try to update the slot
+            if exam_slot_pk is not None:
+
+                # Get new exam slot
+                exam_slot = ExamSlot.objects.get(pk=exam_slot_pk)
+
+                # Check that exam slot type is correct
+                if (exam_slot.exam_slot_type !=
+                        exam_reg.course_user.exam_slot_type):
+                    new_warnings.add("Wrong exam slot type")
+
+                # Take a seat in all time slots
+                if not ExamSlot.reserve_seat(exam_slot_pk, force=force):
+                    new_warnings.add("Not enough seats left")
+
+                # Update the exam registration
+                exam_reg.exam_slot = exam_slot
+                exam_reg.save(update_fields=['exam_slot'])
+
+            else:
+                exam_reg.exam_slot = None
+                exam_reg.save(update_fields=['exam_slot'])
+
+            availability.invalidate(exam_reg.exam_id)
+
+            if new_warnings and not force:
+                raise IntegrityError('; '.join(new_warnings))
+            return new_warnings
+
         if not warnings or force:
-            with transaction.atomic():
-                exam_reg = ExamRegistration.objects.get(pk=exam_reg_pk)
-
-                # Don't allow checked-in users to change.
-                if exam_reg.checkin_time:
-                    warnings.add(
-                        "You have already been checked in for this exam"
-                    )
-
-                # Clear exam slot (in transaction)
-                # This is so when counting registered in time slots below,
-                # we don't include ourselves in the count
-                if exam_reg.exam_slot is not None:
-                    old_exam_slot = exam_reg.exam_slot
-                    old_exam_slot.reg_count -= 1
-                    old_exam_slot.save(update_fields=['reg_count'])
-
-
-                # Try to update the slot
-                if exam_slot_pk is not None:
-
-                    # Get new exam slot, time slot list
-                    exam_slot = ExamSlot.objects \
-                            .select_for_update() \
-                            .get(pk=exam_slot_pk)
-
-                    # Check that exam slot type is correct
-                    if (exam_slot.exam_slot_type !=
-                            exam_reg.course_user.exam_slot_type):
-                        warnings.add("Wrong exam slot type")
-
-                    # Check that all time slots have seats
-                    for time_slot in exam_slot.time_slots.all():
-                        if (time_slot.count_num_registered() >=
-                                time_slot.capacity):
-                            warnings.add("Not enough seats left")
-
-                    # Update the exam registration
-                    exam_slot.reg_count += 1
-                    exam_slot.save(update_fields=['reg_count'])
-
-                    exam_reg.exam_slot = exam_slot
-                    exam_reg.save(update_fields=['exam_slot'])
-
-                else:
-                    exam_reg.exam_slot = None
-                    exam_reg.save(update_fields=['exam_slot'])
-
-                if warnings and not force:
-                    raise IntegrityError('; '.join(warnings))
+            warnings |= run_in_transaction(update,
+                name='ExamRegistration.update_slot')
 
         return warnings
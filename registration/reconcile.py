@@ -0,0 +1,69 @@
+from collections import Counter, namedtuple
+
+from django.db import transaction
+
+from . import availability
+from .counts import get_registration_counts
+from .models import ExamSlot, TimeSlot
+
+
+# A reg_count that differed from the registrations
+RegCountDiff = namedtuple('RegCountDiff', [
+    'slot',
+    'old_reg_count',
+    'new_reg_count',
+])
+
+
+def get_diffs(slots, reg_counts):
+    """
+    Returns a RegCountDiff for each slot whose reg_count differs from its
+    count in reg_counts, setting the new reg_count on the slot.
+    """
+    diffs = []
+    for slot in slots:
+        new_reg_count = reg_counts[slot.pk]
+        if slot.reg_count != new_reg_count:
+            diffs.append(RegCountDiff(slot, slot.reg_count, new_reg_count))
+            slot.reg_count = new_reg_count
+    return diffs
+
+
+def reconcile_exam(exam, dry_run=False):
+    """
+    Recounts the registrations of an exam and fixes every exam slot and
+    time slot reg_count that has drifted from them. The registrations are
+    counted in one grouped query, and the drifted rows are written with
+    one bulk update per model. If dry_run is true, nothing is written.
+
+    Returns a 2-tuple (exam_slot_diffs, time_slot_diffs) of lists of
+    RegCountDiff.
+    """
+    with transaction.atomic():
+        # Lock the counters, so that no registration can change them
+        # between counting and writing
+        exam_slots = list(exam.exam_slot_set
+            .select_for_update()
+            .select_related('start_time_slot__room'))
+        time_slots = list(exam.time_slot_set
+            .select_for_update()
+            .select_related('room'))
+
+        exam_slot_user_type_counts, time_slot_counts = \
+            get_registration_counts(exam)
+        exam_slot_counts = Counter()
+        for (exam_slot_pk, _), num_registered in \
+                exam_slot_user_type_counts.items():
+            exam_slot_counts[exam_slot_pk] += num_registered
+
+        exam_slot_diffs = get_diffs(exam_slots, exam_slot_counts)
+        time_slot_diffs = get_diffs(time_slots, time_slot_counts)
+
+        if not dry_run and (exam_slot_diffs or time_slot_diffs):
+            ExamSlot.objects.bulk_update(
+                [diff.slot for diff in exam_slot_diffs], ['reg_count'])
+            TimeSlot.objects.bulk_update(
+                [diff.slot for diff in time_slot_diffs], ['reg_count'])
+            availability.invalidate(exam.pk)
+
+    return exam_slot_diffs, time_slot_diffs
@@ -0,0 +1,187 @@
+"""
+Retries write transactions that fail because they conflicted with another
+transaction. Under PostgreSQL's SERIALIZABLE isolation, concurrent writes
+to the same rows (such as two students taking the last seat of a time
+slot) make one of the transactions fail with a serialization failure or a
+deadlock; the failed transaction can simply be run again from the start.
+
+run_in_transaction() runs a function in a transaction, and reruns it after
+a short jittered backoff when it conflicts, up to RETRY_MAX_ATTEMPTS
+attempts. Retries are also limited by a budget shared by the whole
+process, so that under heavy contention retries cannot multiply the load
+on the database. If the transaction still fails, TransactionConflict is
+raised.
+
+Counters of attempts, retries and failures of each named transaction are
+kept for the instrumentation summary.
+"""
+import functools
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL error codes of serialization failures and deadlocks
+CONFLICT_PGCODES = ('40001', '40P01')
+
+
+class TransactionConflict(OperationalError):
+    """Raised when a transaction still conflicts after being retried."""
+
+
+def is_conflict(exc):
+    """
+    Returns whether a database error was caused by a conflict with another
+    transaction, so that the transaction can be retried.
+    """
+    if not isinstance(exc, OperationalError):
+        return False
+    if getattr(exc.__cause__, 'pgcode', None) in CONFLICT_PGCODES:
+        return True
+    # SQLite reports a conflicting writer as a locked database
+    return 'database is locked' in str(exc)
+
+
+def get_backoff(attempt):
+    """
+    Returns the number of seconds to wait before the given retry (starting
+    from 1), with full jitter, so that conflicting transactions do not
+    retry in lockstep.
+    """
+    base_delay = getattr(settings, 'RETRY_BASE_DELAY', 0.01)
+    max_delay = getattr(settings, 'RETRY_MAX_DELAY', 0.5)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    """
+    Limits retries to a fraction of transactions. Each transaction adds
+    ratio tokens to the budget, up to a maximum, and each retry spends one
+    token.
+    """
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Spends a token, returning False if there are none left."""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryCounters:
+    """Counts attempts, retries and failures of each named transaction."""
+    FIELDS = ('calls', 'attempts', 'conflicts', 'retries', 'failures',
+        'budget_exhausted')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def add(self, name, field):
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = dict.fromkeys(self.FIELDS, 0)
+            self.counters[name][field] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+
+    def summary(self):
+        with self.lock:
+            return {
+                name: dict(counters)
+                for name, counters in self.counters.items()
+            }
+
+
+# Retry budget and counters of the transactions run by this process
+retry_budget = RetryBudget(
+    ratio=getattr(settings, 'RETRY_BUDGET_RATIO', 0.2),
+    max_tokens=getattr(settings, 'RETRY_BUDGET_MAX_TOKENS', 100),
+)
+retry_counters = RetryCounters()
+
+
+def run_in_transaction(func, *args, name=None, using=None, **kwargs):
+    """
+    Runs func(*args, **kwargs) in a transaction, retrying it if it
+    conflicts with another transaction, and returns its result.
+
+    func may be run several times, so it must not have side effects outside
+    the database, other than through transaction.on_commit(). Errors other
+    than conflicts, such as IntegrityError, are never retried.
+
+    Only a whole transaction can be retried, so when called inside an
+    atomic block, func is run once in a savepoint instead.
+    """
+    name = name or func.__qualname__
+    retry_counters.add(name, 'calls')
+    retry_budget.deposit()
+
+    if transaction.get_connection(using).in_atomic_block:
+        retry_counters.add(name, 'attempts')
+        with transaction.atomic(using=using):
+            return func(*args, **kwargs)
+
+    max_attempts = getattr(settings, 'RETRY_MAX_ATTEMPTS', 4)
+    attempt = 1
+    while True:
+        retry_counters.add(name, 'attempts')
+        try:
+            with transaction.atomic(using=using):
+                return func(*args, **kwargs)
+        except OperationalError as e:
+            if not is_conflict(e):
+                raise
+            retry_counters.add(name, 'conflicts')
+
+            if attempt >= max_attempts:
+                give_up = "after {} attempts".format(attempt)
+            elif not retry_budget.withdraw():
+                retry_counters.add(name, 'budget_exhausted')
+                give_up = "as the retry budget is exhausted"
+            else:
+                give_up = None
+
+            if give_up is not None:
+                retry_counters.add(name, 'failures')
+                logger.warning("Transaction %s conflicted; giving up %s",
+                    name, give_up)
+                raise TransactionConflict(
+                    "The database is busy; please try again."
+                ) from e
+
+        retry_counters.add(name, 'retries')
+        time.sleep(get_backoff(attempt))
+        attempt += 1
+
+
+def retry_transaction(name=None, using=None):
+    """
+    Decorator that makes a function run in a transaction with
+    run_in_transaction().
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return run_in_transaction(func, *args,
+                name=name or func.__qualname__, using=using, **kwargs)
+        return wrapper
+    return decorator
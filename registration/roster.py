@@ -0,0 +1,166 @@
+import codecs
+import csv
+
+from django.conf import settings
+
+from . import membership
+from .models import User, CourseUser
+from .retry import run_in_transaction
+
+
+# Column headers for Autolab CSV roster import
+AUTOLAB_FIELDNAMES = [
+    'semester', 'email', 'last_name', 'first_name', 'school', 'major',
+    'year', 'grading_policy', 'lecture', 'section',
+]
+
+# Number of rows to look up or create per query
+BATCH_SIZE = 500
+
+
+def chunks(seq, size):
+    """Splits a list into lists of at most size elements."""
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+
+def parse_roster_row(row):
+    """
+    Parses a CSV row from a roster. The row should be represented as a
+    dictionary, with the columns having been already mapped to the
+    appropriate keys by a DictReader. A ValueError will be raised if
+    invalid data is encountered.
+
+    Returns a 3-tuple (username, user_fields, course_user_fields), where
+    the latter two are dictionaries of extra fields present in the row.
+    """
+    # Parse username
+    if 'username' in row and row['username']:
+        username = row['username']
+
+    elif 'email' in row and row['email']:
+        if not row['email'].endswith(settings.ANDREW_EMAIL_SUFFIX):
+            raise ValueError("Invalid email: " + row['email'])
+        username = row['email'][:-len(settings.ANDREW_EMAIL_SUFFIX)]
+
+    else:
+        raise ValueError("Neither username nor email present in row")
+
+    extra_keys = ['first_name', 'last_name']
+    user_fields = {k: row[k] for k in extra_keys if k in row and row[k]}
+
+    extra_keys = ['section', 'lecture']
+    course_user_fields = {k: row[k] for k in extra_keys if k in row and row[k]}
+
+    return username, user_fields, course_user_fields
+
+
+def get_user_pks(usernames):
+    """Returns a dict mapping each existing username to its user's pk."""
+    user_pks = {}
+    for batch in chunks(usernames, BATCH_SIZE):
+        user_pks.update(
+            User.objects
+                .filter(username__in=batch)
+                .values_list('username', 'pk')
+        )
+    return user_pks
+
+
+def import_roster_rows(course, rows):
+    """
+    Imports rows of a course roster, creating a User and CourseUser for
+    each row. When dealing with users that already exist, the current
+    behavior is to preserve rather than overwrite any existing data.
+
+    All rows are parsed before anything is written, and users are looked
+    up and created in batches, so the number of queries does not grow with
+    each row. History records are created in bulk as well.
+
+    Returns a 2-tuple (created_count, skipped_count). A ValueError will be
+    raised if invalid data is encountered, and an IntegrityError may be
+    raised by the database (though this is not expected). The import is
+    retried if it conflicts with another transaction, and
+    TransactionConflict is raised if it keeps conflicting.
+    """
+    parsed_rows = [parse_roster_row(row) for row in rows]
+
+    # Keep the first row for each username, like get_or_create() would
+    roster = {}
+    for username, user_fields, course_user_fields in parsed_rows:
+        roster.setdefault(username, (user_fields, course_user_fields))
+    usernames = list(roster)
+
+    # This is retried if it conflicts with another transaction
+    def import_rows():
+        # Create missing users
+        user_pks = get_user_pks(usernames)
+        new_users = []
+        for username in usernames:
+            if username in user_pks:
+                continue
+            user_fields, _ = roster[username]
+            user = User(
+                username=username,
+                email=username + settings.ANDREW_EMAIL_SUFFIX,
+                **user_fields
+            )
+            user.set_unusable_password()
+            new_users.append(user)
+
+        if new_users:
+            User.objects.bulk_create(new_users, batch_size=BATCH_SIZE)
+            new_user_pks = get_user_pks([user.username for user in new_users])
+            user_pks.update(new_user_pks)
+            for batch in chunks(list(new_user_pks.values()), BATCH_SIZE):
+                User.history.bulk_history_create(
+                    User.objects.filter(pk__in=batch))
+
+        # Create missing course users
+        enrolled_user_pks = set()
+        for batch in chunks(list(user_pks.values()), BATCH_SIZE):
+            enrolled_user_pks.update(
+                CourseUser.objects
+                    .filter(course=course, user__in=batch)
+                    .values_list('user', flat=True)
+            )
+
+        new_course_users = [
+            CourseUser(
+                course=course,
+                user_id=user_pks[username],
+                **roster[username][1]
+            )
+            for username in usernames
+            if user_pks[username] not in enrolled_user_pks
+        ]
+
+        if new_course_users:
+            CourseUser.objects.bulk_create(
+                new_course_users, batch_size=BATCH_SIZE)
+            membership.invalidate_all()
+            new_user_pks = [cu.user_id for cu in new_course_users]
+            for batch in chunks(new_user_pks, BATCH_SIZE):
+                CourseUser.history.bulk_history_create(
+                    CourseUser.objects.filter(course=course, user__in=batch))
+
+        return len(new_course_users)
+
+    created_count = run_in_transaction(import_rows,
+        name='import_roster_rows')
+    return (created_count, len(parsed_rows) - created_count)
+
+
+def import_roster_from_csv_file(course, f):
+    """
+    Imports an entire course roster from a file. The roster is parsed as
+    a CSV file in the Autolab format. The import is processed as a
+    transaction for speed, and so that any errors will cause the entire
+    import to fail.
+    """
+    with f:
+        text_file = codecs.iterdecode(f, 'utf-8')
+        reader = csv.DictReader(
+            text_file,
+            fieldnames=AUTOLAB_FIELDNAMES,
+        )
+        return import_roster_rows(course, reader)
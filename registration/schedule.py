@@ -0,0 +1,53 @@
+from collections import namedtuple
+
+from .models import Exam, ExamRegistration
+
+
+# An exam of a course, and when the course user is registered to take it;
+# start_time is None if they are not registered for an exam slot
+ScheduleEntry = namedtuple('ScheduleEntry', ['exam', 'start_time'])
+
+
+def load_schedule(course_users):
+    """
+    Loads the exams of the courses of the given course users, along with
+    the start time of each course user's registered exam slot, using two
+    queries no matter how many courses and exams there are.
+
+    Returns a dict mapping the pk of each course user to a list of
+    ScheduleEntry, one for each exam of their course.
+    """
+    course_users = list(course_users)
+    courses = {
+        course_user.course_id: course_user.course
+        for course_user in course_users
+    }
+
+    # Get exams of all courses
+    exams_by_course = {course_id: [] for course_id in courses}
+    for exam in Exam.objects.filter(course__in=courses).order_by('pk'):
+        exam.course = courses[exam.course_id]
+        exams_by_course[exam.course_id].append(exam)
+
+    # Get registered start times of all course users
+    start_times = {
+        (course_user_id, exam_id): start_time
+        for course_user_id, exam_id, start_time in ExamRegistration.objects
+            .filter(course_user__in=course_users)
+            .values_list(
+                'course_user',
+                'exam',
+                'exam_slot__start_time_slot__start_time',
+            )
+    }
+
+    return {
+        course_user.pk: [
+            ScheduleEntry(
+                exam=exam,
+                start_time=start_times.get((course_user.pk, exam.pk)),
+            )
+            for exam in exams_by_course[course_user.course_id]
+        ]
+        for course_user in course_users
+    }
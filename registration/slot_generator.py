@@ -0,0 +1,267 @@
+"""
+Generates the time slots and exam slots of an exam from a declarative
+spec, instead of entering them one by one. For example:
+
+    {
+        "days": ["2018-07-04", "2018-07-05"],
+        "day_start": "09:00",
+        "day_end": "21:00",
+        "time_zone": "America/New_York",
+        "rooms": [
+            {"name": "GHC 5205", "capacity": 30},
+            {"name": "GHC 5208", "capacity": 40}
+        ],
+        "slot_minutes": 60,
+        "exam_slots": 2,
+        "extended_time_multiplier": 1.5
+    }
+
+Each room is split into consecutive time slots of slot_minutes on each day,
+from day_start to day_end. A normal exam slot of exam_slots time slots
+starts at every time slot it fits after, and likewise an extended time
+exam slot of exam_slots * extended_time_multiplier time slots (rounded up),
+unless the multiplier is 0.
+
+The whole schedule is validated in memory against the exam's existing
+time slots, and written with bulk inserts in a single transaction.
+"""
+import datetime
+import math
+from collections import namedtuple
+
+from django.utils import dateparse
+
+from . import availability
+from .forms import find_overlaps
+from .models import CourseUser, ExamSlot, Room, TimeSlot
+from .retry import run_in_transaction
+from .timezones import DEFAULT_TIMEZONE, get_timezone
+
+
+ScheduleSpec = namedtuple('ScheduleSpec', [
+    'days', 'day_start', 'day_end', 'tz', 'rooms', 'slot_length',
+    'exam_slots', 'extended_time_multiplier',
+])
+
+# A room of a spec, and the capacity of its time slots
+RoomSpec = namedtuple('RoomSpec', ['name', 'capacity'])
+
+# Generated time slots, and exam slots as (exam slot, time slots) pairs
+GeneratedSchedule = namedtuple('GeneratedSchedule', [
+    'time_slots', 'exam_slots',
+])
+
+
+def parse_schedule_spec(data):
+    """
+    Parses a schedule spec from a dict, as loaded from JSON. Raises
+    ValueError if it is invalid.
+    """
+    def parse(key, parse_value, default=None):
+        value = data.get(key, default)
+        if value is None:
+            raise ValueError("Missing {}".format(key))
+        try:
+            parsed = parse_value(value)
+        except (TypeError, ValueError):
+            parsed = None
+        if parsed is None:
+            raise ValueError("Invalid {}: {!r}".format(key, value))
+        return parsed
+
+    def positive_int(value):
+        if not isinstance(value, int) or value <= 0:
+            return None
+        return value
+
+    def parse_days(days):
+        days = [dateparse.parse_date(day) for day in days]
+        if not days or None in days:
+            return None
+        return sorted(days)
+
+    days = parse('days', parse_days)
+    if len(set(days)) != len(days):
+        raise ValueError("Days must be unique")
+    day_start = parse('day_start', dateparse.parse_time)
+    day_end = parse('day_end', dateparse.parse_time)
+    if day_end <= day_start:
+        raise ValueError("day_end must be after day_start")
+
+    rooms = parse('rooms', lambda rooms: [
+        RoomSpec(str(room['name']), positive_int(room['capacity']))
+        for room in rooms
+    ] or None)
+    if any(room.capacity is None for room in rooms):
+        raise ValueError("Room capacities must be positive integers")
+    if len({room.name for room in rooms}) != len(rooms):
+        raise ValueError("Room names must be unique")
+
+    multiplier = parse('extended_time_multiplier',
+        lambda value: float(value) if value >= 0 else None, default=1.5)
+    if 0 < multiplier < 1:
+        raise ValueError("extended_time_multiplier must be 0 or at least 1")
+
+    return ScheduleSpec(
+        days=days,
+        day_start=day_start,
+        day_end=day_end,
+        tz=parse('time_zone', get_timezone, default=DEFAULT_TIMEZONE),
+        rooms=rooms,
+        slot_length=datetime.timedelta(
+            minutes=parse('slot_minutes', positive_int)),
+        exam_slots=parse('exam_slots', positive_int),
+        extended_time_multiplier=multiplier,
+    )
+
+
+def generate_schedule(exam, spec, rooms):
+    """
+    Builds the time slots and exam slots of a spec for an exam, without
+    saving them. rooms maps the name of each room in the spec to a Room.
+    Returns a GeneratedSchedule.
+    """
+    exam_slot_lengths = [(CourseUser.NORMAL, spec.exam_slots)]
+    if spec.extended_time_multiplier:
+        exam_slot_lengths.append((CourseUser.EXTENDED_TIME, math.ceil(
+            spec.exam_slots * spec.extended_time_multiplier)))
+
+    time_slots = []
+    exam_slots = []
+    for day in spec.days:
+        day_end = spec.tz.localize(
+            datetime.datetime.combine(day, spec.day_end))
+        for room_spec in spec.rooms:
+            # Consecutive time slots in this room on this day
+            room_time_slots = []
+            start_time = spec.tz.localize(
+                datetime.datetime.combine(day, spec.day_start))
+            while start_time + spec.slot_length <= day_end:
+                room_time_slots.append(TimeSlot(
+                    exam=exam,
+                    start_time=start_time,
+                    end_time=start_time + spec.slot_length,
+                    room=rooms[room_spec.name],
+                    capacity=room_spec.capacity,
+                ))
+                start_time += spec.slot_length
+            time_slots.extend(room_time_slots)
+
+            for exam_slot_type, length in exam_slot_lengths:
+                for i in range(len(room_time_slots) - length + 1):
+                    exam_slots.append((
+                        ExamSlot(
+                            exam=exam,
+                            start_time_slot=room_time_slots[i],
+                            exam_slot_type=exam_slot_type,
+                        ),
+                        room_time_slots[i:i + length],
+                    ))
+
+    return GeneratedSchedule(time_slots, exam_slots)
+
+
+def check_overlaps(exam, time_slots):
+    """
+    Raises ValueError if any of the given time slots overlap an existing
+    time slot of the exam in the same room, using a single query.
+    """
+    intervals_by_room = {}
+    for time_slot in time_slots:
+        # Time slots in rooms that are not created yet cannot overlap
+        if time_slot.room_id is None:
+            continue
+        intervals_by_room.setdefault(time_slot.room_id, []).append(
+            (time_slot, time_slot.start_time, time_slot.end_time))
+    for pk, room_pk, start_time, end_time in exam.time_slot_set \
+            .filter(room__in=list(intervals_by_room)) \
+            .values_list('pk', 'room', 'start_time', 'end_time'):
+        intervals_by_room[room_pk].append((None, start_time, end_time))
+
+    for intervals in intervals_by_room.values():
+        for time_slot, other in find_overlaps(intervals):
+            raise ValueError(
+                "Time slot {} overlaps an existing time slot".format(
+                    time_slot or other))
+
+
+def create_schedule(exam, spec, dry_run=False):
+    """
+    Creates the time slots and exam slots of a spec for an exam, along
+    with any rooms of the course that do not exist yet, using a fixed
+    number of bulk statements. If dry_run is true, nothing is written.
+
+    Returns a GeneratedSchedule. A ValueError is raised if the new time
+    slots overlap existing ones.
+    """
+    def create():
+        # Find or create the rooms
+        rooms = {
+            room.name: room
+            for room in Room.objects.filter(course=exam.course_id,
+                name__in=[room.name for room in spec.rooms])
+        }
+        new_rooms = [
+            Room(course_id=exam.course_id, name=room.name,
+                capacity=room.capacity)
+            for room in spec.rooms
+            if room.name not in rooms
+        ]
+        if new_rooms and not dry_run:
+            Room.objects.bulk_create(new_rooms)
+            new_rooms = list(Room.objects.filter(course=exam.course_id,
+                name__in=[room.name for room in new_rooms]))
+            Room.history.bulk_history_create(new_rooms)
+        rooms.update((room.name, room) for room in new_rooms)
+
+        schedule = generate_schedule(exam, spec, rooms)
+        check_overlaps(exam, schedule.time_slots)
+        if dry_run:
+            return schedule
+
+        # Create the time slots, and look up their pks, since bulk_create()
+        # does not set them on every database
+        TimeSlot.objects.bulk_create(schedule.time_slots)
+        time_slot_pks = {
+            (room_pk, start_time): pk
+            for pk, room_pk, start_time in exam.time_slot_set
+                .filter(room__in=rooms.values())
+                .values_list('pk', 'room', 'start_time')
+        }
+        for time_slot in schedule.time_slots:
+            time_slot.pk = time_slot_pks[
+                (time_slot.room_id, time_slot.start_time)]
+
+        # Create the exam slots, and look up their pks. start_time_slot is
+        # set again, since its time slot had no pk when it was first set.
+        for exam_slot, _ in schedule.exam_slots:
+            exam_slot.start_time_slot = exam_slot.start_time_slot
+        ExamSlot.objects.bulk_create(
+            [exam_slot for exam_slot, _ in schedule.exam_slots])
+        exam_slot_pks = {
+            (start_time_slot_pk, exam_slot_type): pk
+            for pk, start_time_slot_pk, exam_slot_type in ExamSlot.objects
+                .filter(start_time_slot__in=[
+                    time_slot.pk for time_slot in schedule.time_slots
+                ])
+                .values_list('pk', 'start_time_slot', 'exam_slot_type')
+        }
+        for exam_slot, _ in schedule.exam_slots:
+            exam_slot.pk = exam_slot_pks[
+                (exam_slot.start_time_slot_id, exam_slot.exam_slot_type)]
+
+        ExamSlot.time_slots.through.objects.bulk_create([
+            ExamSlot.time_slots.through(
+                examslot_id=exam_slot.pk, timeslot_id=time_slot.pk)
+            for exam_slot, exam_time_slots in schedule.exam_slots
+            for time_slot in exam_time_slots
+        ])
+
+        TimeSlot.history.bulk_history_create(schedule.time_slots)
+        ExamSlot.history.bulk_history_create(
+            [exam_slot for exam_slot, _ in schedule.exam_slots])
+
+        availability.invalidate_layout(exam.pk)
+        return schedule
+
+    return run_in_transaction(create, name='create_schedule')
@@ -0,0 +1,97 @@
+from unittest import mock
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from . import availability
+from .benchmark import (
+    SCENARIOS, benchmark_database, percentile, run_scenario, seed_exam,
+)
+from .models import CourseUser, ExamRegistration, ExamSlot
+from .retry import TransactionConflict, retry_counters
+
+
+class BenchmarkTests(TransactionTestCase):
+    def setUp(self):
+        availability.get_cache().clear()
+        self.data = seed_exam(
+            num_students=20,
+            num_rooms=1,
+            num_days=1,
+            slots_per_day=8,
+            extended_fraction=0.5,
+        )
+
+    def test_seed_exam(self):
+        """
+        Checks that seeded exams have overlapping normal and extended time
+        exam slots, and a registration for every course user.
+        """
+        self.assertEqual(len(self.data.students), 20)
+        self.assertEqual(len(self.data.exam_slot_pks[CourseUser.NORMAL]), 5)
+        self.assertEqual(
+            len(self.data.exam_slot_pks[CourseUser.EXTENDED_TIME]), 2)
+        self.assertEqual(self.data.exam.exam_registration_set.count(), 21)
+
+    def test_run_scenarios(self):
+        """
+        Checks that every scenario runs without errors, and that bookings
+        are counted.
+        """
+        for name in SCENARIOS:
+            result = run_scenario(name, self.data, 1, 5)
+            self.assertEqual(len(result.latencies), 5, name)
+            self.assertEqual(len(result.query_counts), 5, name)
+            self.assertEqual(result.outcomes['error'], 0, name)
+            self.assertEqual(result.outcomes['abort'], 0, name)
+
+        reg_count = sum(ExamSlot.objects.values_list('reg_count', flat=True))
+        self.assertEqual(
+            reg_count,
+            self.data.exam.exam_registration_set
+                .filter(exam_slot__isnull=False).count(),
+        )
+        self.assertGreater(reg_count, 0)
+
+    def test_transaction_conflicts_are_not_retried_again(self):
+        """
+        Checks that a TransactionConflict counts as an abort without being
+        retried by the harness, and that the retries made by
+        run_in_transaction are counted.
+        """
+        def update_slot(*args, **kwargs):
+            retry_counters.add('ExamRegistration.update_slot', 'retries')
+            raise TransactionConflict("could not serialize access")
+
+        with mock.patch.object(ExamRegistration, 'update_slot',
+                side_effect=update_slot) as mocked:
+            result = run_scenario('update_slot', self.data, 1, 3)
+        self.assertEqual(mocked.call_count, 3)
+        self.assertEqual(result.outcomes['abort'], 3)
+        self.assertEqual(result.retries, 3)
+
+    def test_benchmark_database_restores_settings(self):
+        """
+        Checks that the test database name is put back after the benchmark
+        database is torn down.
+        """
+        test_name = connection.settings_dict['TEST'].get('NAME')
+        with mock.patch('registration.benchmark.setup_databases'), \
+                mock.patch('registration.benchmark.teardown_databases'), \
+                mock.patch('registration.benchmark.setup_test_environment'), \
+                mock.patch(
+                    'registration.benchmark.teardown_test_environment'):
+            with benchmark_database():
+                pass
+        self.assertEqual(connection.settings_dict['TEST'].get('NAME'),
+            test_name)
+
+    def test_percentile(self):
+        """
+        Checks that percentiles use the nearest rank.
+        """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([], 50), 0)
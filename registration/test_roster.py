@@ -0,0 +1,88 @@
+import io
+import tempfile
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from .models import User, Course, CourseUser
+from .retry import TransactionConflict
+from .roster import import_roster_from_csv_file, import_roster_rows
+
+
+class RosterImportTests(TestCase):
+    def setUp(self):
+        self.course = Course.objects.create(
+            code='15101-m18',
+            name="Introduction to Computer Systems (Summer 2018)",
+        )
+
+    def test_import_creates_users_and_course_users(self):
+        """
+        Checks that importing a roster creates configured users and course
+        users, along with their history.
+        """
+        roster = (
+            b'M18,aaa@andrew.cmu.edu,Aaron,Alice,SCS,CS,2,Standard,1,A\n'
+            b'M18,bbb@andrew.cmu.edu,Baker,Bob,SCS,CS,2,Standard,1,B\n'
+        )
+        created_count, skipped_count = import_roster_from_csv_file(
+            self.course, io.BytesIO(roster))
+
+        self.assertEqual((created_count, skipped_count), (2, 0))
+
+        user = User.objects.get(username='aaa')
+        self.assertEqual(user.email, 'aaa@andrew.cmu.edu')
+        self.assertEqual(user.first_name, 'Alice')
+        self.assertFalse(user.has_usable_password())
+
+        course_user = CourseUser.objects.get(
+            user__username='bbb', course=self.course)
+        self.assertEqual(course_user.section, 'B')
+
+        self.assertEqual(User.history.count(), 2)
+        self.assertEqual(CourseUser.history.count(), 2)
+
+    def test_import_skips_existing_course_users(self):
+        """
+        Checks that existing users and course users are preserved and
+        counted as skipped, including duplicate rows.
+        """
+        user = User.objects.create(username='aaa', first_name='Existing')
+        CourseUser.objects.create(user=user, course=self.course)
+
+        created_count, skipped_count = import_roster_rows(self.course, [
+            {'username': 'aaa', 'first_name': 'Alice'},
+            {'username': 'bbb'},
+            {'username': 'bbb'},
+        ])
+
+        self.assertEqual((created_count, skipped_count), (1, 2))
+        self.assertEqual(User.objects.get(username='aaa').first_name,
+            'Existing')
+        self.assertEqual(self.course.course_user_set.count(), 2)
+
+    def test_import_rejects_invalid_rows(self):
+        """
+        Checks that an invalid row fails the import before anything is
+        written.
+        """
+        with self.assertRaises(ValueError):
+            import_roster_rows(self.course, [
+                {'username': 'aaa'},
+                {'email': 'bbb@cs.cmu.edu'},
+            ])
+
+        self.assertFalse(User.objects.exists())
+
+    def test_import_roster_command_reports_conflicts(self):
+        """
+        Checks that the import_roster command reports a transaction that
+        still conflicts after its retries as an error.
+        """
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f, \
+                mock.patch('registration.management.commands.import_roster'
+                    '.import_roster_from_csv_file',
+                    side_effect=TransactionConflict("could not serialize")):
+            with self.assertRaises(CommandError):
+                call_command('import_roster', self.course.code, f.name)
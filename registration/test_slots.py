@@ -1,17 +1,45 @@
 import datetime
+import gzip
+import os
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
 
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.db import (
+    IntegrityError, OperationalError, connection, transaction,
+)
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from django.utils import dateparse
+from django.utils import dateparse, timezone
 
 from .models import (
     User, Course, CourseUser, Exam, TimeSlot, ExamSlot, ExamRegistration,
+    GithubToken, Room,
+)
+from . import admission, availability, membership
+from .assignment import assign_unregistered
+from .counts import get_signup_counts
+from .course_archive import build_snapshot
+from .forms import ExamSlotFormSet, TimeSlotFormSet, find_overlaps
+from .history_archive import compact_history, get_course_history
+from .reconcile import reconcile_exam
+from .retry import TransactionConflict, retry_counters
+from .schedule import load_schedule
+from .slot_generator import create_schedule, parse_schedule_spec
+from .timeline import (
+    build_exam_timeline, get_cached_exam_timeline, get_cached_seats_left,
 )
+from .warmup import get_exams_to_warm, warm_exam
 
 
 def make_exam(self):
+    # Start from an empty availability cache
+    availability.get_cache().clear()
+
     # Create course / exam
     self.course = Course.objects.create(
         code='15101-m18',
@@ -423,3 +451,1777 @@ class SlotCountingTests(TestCase):
         self.assertEqual(self.exam_slots[0].count_slots_left(), 0)
         self.assertEqual(self.exam_slots[1].count_slots_left(), 0)
         self.assertEqual(self.exam_slots[2].count_slots_left(), 0)
+
+    def test_time_slot_counters_with_registrations(self):
+        """
+        Tests that the seat counters on time slots are kept in sync by
+        update_slot() when registering and changing registrations.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[1].pk,
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[2].pk,
+        )
+
+        self.refresh_objects()
+
+        self.assertEqual(self.time_slots[0].reg_count, 0)
+        self.assertEqual(self.time_slots[1].reg_count, 1)
+        self.assertEqual(self.time_slots[2].reg_count, 2)
+
+        self.assertEqual(self.exam_slots[0].reg_count, 0)
+        self.assertEqual(self.exam_slots[1].reg_count, 1)
+        self.assertEqual(self.exam_slots[2].reg_count, 1)
+
+    def test_update_slot_rejects_full_time_slot(self):
+        """
+        Tests that update_slot() rejects an exam slot containing a full
+        time slot, and that no seats are taken when it does.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[0].pk,
+        )
+        with self.assertRaises(IntegrityError):
+            ExamRegistration.update_slot(
+                self.exam_registrations[2].pk,
+                self.exam_slots[1].pk,
+            )
+
+        self.refresh_objects()
+
+        self.assertIsNone(self.exam_registrations[2].exam_slot)
+        self.assertEqual(self.time_slots[1].reg_count, 2)
+        self.assertEqual(self.time_slots[2].reg_count, 0)
+        self.assertEqual(self.exam_slots[1].reg_count, 0)
+
+    def test_forced_update_slot_overbooks_full_time_slot(self):
+        """
+        Tests that a forced update_slot() takes a seat in a full time slot
+        anyway, and reports a warning.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[0].pk,
+        )
+        warnings = ExamRegistration.update_slot(
+            self.exam_registrations[2].pk,
+            self.exam_slots[1].pk,
+            force=True,
+        )
+
+        self.refresh_objects()
+
+        self.assertEqual(warnings, {"Not enough seats left"})
+        self.assertEqual(self.time_slots[1].reg_count, 3)
+        self.assertEqual(self.time_slots[2].reg_count, 1)
+        self.assertEqual(self.exam_slots[1].reg_count, 1)
+
+    def test_repair_reg_counts_after_editing_exam_slot(self):
+        """
+        Tests that repair_reg_counts() fixes the time slot counters after
+        the time slots of an exam slot with registrations are edited.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        self.exam_slots[0].time_slots.remove(self.time_slots[1])
+
+        fixed = TimeSlot.repair_reg_counts(self.exam)
+
+        self.refresh_objects()
+
+        self.assertEqual([time_slot for time_slot, _ in fixed],
+            [self.time_slots[1]])
+        self.assertEqual(self.time_slots[0].reg_count, 1)
+        self.assertEqual(self.time_slots[1].reg_count, 0)
+        self.assertEqual(self.exam_slots[1].count_slots_left(), 2)
+
+
+class ExamTimelineTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+    def test_timeline_slot_values(self):
+        """
+        Checks that the timeline computes the same values as the accessor
+        methods in ExamSlot.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+
+        timeline = build_exam_timeline(self.exam)
+        self.assertEqual(len(timeline), 1)
+        self.assertEqual(timeline[0].day, datetime.date(2018, 7, 4))
+
+        for slot, exam_slot in zip(timeline[0].slots, self.exam_slots):
+            exam_slot.refresh_from_db()
+            self.assertEqual(slot.pk, exam_slot.pk)
+            self.assertEqual(slot.start_time, exam_slot.get_start_time())
+            self.assertEqual(slot.end_time, exam_slot.get_end_time())
+            self.assertEqual(slot.capacity, exam_slot.count_capacity())
+            self.assertEqual(slot.reg_count, exam_slot.reg_count)
+            self.assertEqual(slot.slots_left, exam_slot.count_slots_left())
+
+    def test_timeline_filters_exam_slot_type(self):
+        """
+        Checks that only exam slots of the requested type are included.
+        """
+        self.exam_slots[1].exam_slot_type = CourseUser.EXTENDED_TIME
+        self.exam_slots[1].save()
+
+        timeline = build_exam_timeline(self.exam, CourseUser.EXTENDED_TIME)
+        self.assertEqual(
+            [slot.pk for day in timeline for slot in day.slots],
+            [self.exam_slots[1].pk],
+        )
+
+    def test_exam_detail_renders_timeline(self):
+        """
+        Checks that the exam page lists the exam slots and the current
+        reservation.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[1].pk,
+        )
+
+        response = self.client.get(
+            reverse('registration:exam-detail',
+                args=[self.course.code, self.exam.pk]),
+            REMOTE_USER='aaa@andrew.cmu.edu',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['current_slot'].pk,
+            self.exam_slots[1].pk)
+        self.assertContains(response, "You are registered for the exam.")
+        for exam_slot in self.exam_slots:
+            self.assertContains(response,
+                'id="id_exam_slot_{}"'.format(exam_slot.pk))
+
+    def test_exam_detail_seats(self):
+        """
+        Checks that the seats endpoint returns the seats left in each exam
+        slot, and a 304 response when nothing has changed.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+
+        url = reverse('registration:exam-detail-seats',
+            args=[self.course.code, self.exam.pk])
+        response = self.client.get(url, REMOTE_USER='aaa@andrew.cmu.edu')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'exam_slots': {
+            str(self.exam_slots[0].pk): 1,
+            str(self.exam_slots[1].pk): 1,
+            str(self.exam_slots[2].pk): 2,
+        }})
+
+        response = self.client.get(url,
+            REMOTE_USER='aaa@andrew.cmu.edu',
+            HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(response.status_code, 304)
+
+
+class AvailabilityCacheTests(TransactionTestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+    def test_bump_version_invalidates_cached_values(self):
+        """
+        Checks that cached values are reused until the availability version
+        of the exam is bumped.
+        """
+        values = iter(range(3))
+        compute = lambda: next(values)
+
+        self.assertEqual(
+            availability.get_or_compute(self.exam.pk, 'test', compute), 0)
+        self.assertEqual(
+            availability.get_or_compute(self.exam.pk, 'test', compute), 0)
+
+        availability.bump_version(self.exam.pk)
+        self.assertEqual(
+            availability.get_or_compute(self.exam.pk, 'test', compute), 1)
+
+    def test_layout_is_only_invalidated_by_edits(self):
+        """
+        Checks that values cached by layout survive bookings, and are
+        invalidated when the exam is edited.
+        """
+        values = iter(range(3))
+        compute = lambda: next(values)
+        get = lambda: availability.get_or_compute(
+            self.exam.pk, 'test', compute, layout=True)
+
+        self.assertEqual(get(), 0)
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        self.assertEqual(get(), 0)
+
+        self.exam.name = "Midterm"
+        self.exam.save()
+        self.assertEqual(get(), 1)
+
+    def test_update_slot_invalidates_seats_left(self):
+        """
+        Checks that update_slot() invalidates the cached seats left once
+        its transaction commits.
+        """
+        self.assertEqual(
+            get_cached_seats_left(self.exam)[self.exam_slots[0].pk], 2)
+
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+
+        self.assertEqual(
+            get_cached_seats_left(self.exam)[self.exam_slots[0].pk], 1)
+
+
+class ExamSignupsViewTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        self.course_users[0].user_type = CourseUser.INSTRUCTOR
+        self.course_users[0].save()
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+
+    def test_exam_signups_csv(self):
+        """
+        Checks that the CSV export streams a row for every registered and
+        unregistered user.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[1].pk,
+        )
+
+        response = self.client.get(reverse('registration:exam-signups-csv',
+            args=[self.course.code, self.exam.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, [
+            'user.username,user.first_name,user.last_name,user.slot_type,'
+            'exam_slot.slot_type,exam_slot.start_time,exam_slot.end_time,'
+            'exam_slot.room',
+            'bbb,,,Normal,Normal,2018-07-04 18:00:00 UTC+0000,'
+            '2018-07-04 20:00:00 UTC+0000,',
+            'aaa,,,Normal,,,,',
+            'ccc,,,Normal,,,,',
+        ])
+
+    def test_signup_counts(self):
+        """
+        Checks that signup counts are computed with a fixed number of
+        queries, and match the registrations.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[1].pk,
+        )
+
+        with self.assertNumQueries(5):
+            counts = get_signup_counts(self.exam)
+
+        self.assertEqual(tuple(counts.total), (3, 2, 1))
+        self.assertEqual(
+            tuple(counts.by_user_type[CourseUser.STUDENT]), (2, 1, 1))
+        self.assertEqual(
+            tuple(counts.by_user_type[CourseUser.INSTRUCTOR]), (1, 1, 0))
+        self.assertEqual(
+            [time_slot.registered for time_slot in counts.time_slots],
+            [1, 2, 1],
+        )
+        self.assertEqual(
+            [exam_slot.registered for exam_slot in counts.exam_slots],
+            [1, 1, 0],
+        )
+        self.assertEqual(
+            counts.exam_slots[1].registered_by_user_type,
+            {CourseUser.INSTRUCTOR: 0, CourseUser.STUDENT: 1},
+        )
+
+    def test_exam_signups_counts_json(self):
+        """
+        Checks that signup counts are served as JSON.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[1].pk,
+        )
+
+        response = self.client.get(reverse(
+            'registration:exam-signups-counts-json',
+            args=[self.course.code, self.exam.pk]))
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()
+        self.assertEqual(data['total'], {
+            'course_users': 3, 'registered': 1, 'unregistered': 2,
+        })
+        self.assertEqual(
+            [exam_slot['registered'] for exam_slot in data['exam_slots']],
+            [0, 1, 0],
+        )
+
+        response = self.client.get(reverse(
+            'registration:exam-signups-counts',
+            args=[self.course.code, self.exam.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.context['counts'], get_signup_counts(self.exam))
+
+
+class ReconcileTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[1].pk,
+            self.exam_slots[1].pk,
+        )
+
+        # Make the counters drift
+        ExamSlot.objects.filter(pk=self.exam_slots[0].pk).update(reg_count=3)
+        TimeSlot.objects.filter(pk=self.time_slots[2].pk).update(reg_count=0)
+
+    def get_reg_counts(self):
+        return (
+            list(ExamSlot.objects.order_by('pk')
+                .values_list('reg_count', flat=True)),
+            list(TimeSlot.objects.order_by('pk')
+                .values_list('reg_count', flat=True)),
+        )
+
+    def test_reconcile_exam(self):
+        """
+        Checks that drifted counters are reported, and fixed unless this is
+        a dry run.
+        """
+        exam_slot_diffs, time_slot_diffs = \
+            reconcile_exam(self.exam, dry_run=True)
+        self.assertEqual(
+            [(diff.slot.pk, diff.old_reg_count, diff.new_reg_count)
+                for diff in exam_slot_diffs],
+            [(self.exam_slots[0].pk, 3, 1)],
+        )
+        self.assertEqual(
+            [(diff.slot.pk, diff.old_reg_count, diff.new_reg_count)
+                for diff in time_slot_diffs],
+            [(self.time_slots[2].pk, 0, 1)],
+        )
+        self.assertEqual(self.get_reg_counts(), ([3, 1, 0], [1, 2, 0]))
+
+        reconcile_exam(self.exam)
+        self.assertEqual(self.get_reg_counts(), ([1, 1, 0], [1, 2, 1]))
+        self.assertEqual(reconcile_exam(self.exam), ([], []))
+
+    def test_reconcile_counts_command(self):
+        """
+        Checks that the reconcile_counts command fixes and reports drifted
+        counters.
+        """
+        out = StringIO()
+        call_command('reconcile_counts', '--exam', str(self.exam.pk),
+            stdout=out)
+        self.assertIn('fixed 2 drifted counts', out.getvalue())
+        self.assertEqual(self.get_reg_counts(), ([1, 1, 0], [1, 2, 1]))
+
+    def test_signups_counts_does_not_write(self):
+        """
+        Checks that the signup counts page reports drifted counters without
+        fixing them.
+        """
+        self.course_users[0].user_type = CourseUser.INSTRUCTOR
+        self.course_users[0].save()
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+
+        response = self.client.get(reverse('registration:exam-signups-counts',
+            args=[self.course.code, self.exam.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['drifted_exam_slots']), 1)
+        self.assertEqual(len(response.context['drifted_time_slots']), 1)
+        self.assertEqual(self.get_reg_counts(), ([3, 1, 0], [1, 2, 0]))
+
+
+class ScheduleTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        self.other_exam = Exam.objects.create(
+            course=self.course,
+            name="Midterm Exam",
+        )
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[1].pk,
+        )
+
+    def test_load_schedule(self):
+        """
+        Checks that the exams and registered start times of course users
+        are loaded with a fixed number of queries.
+        """
+        course_users = CourseUser.objects \
+            .filter(pk__in=[cu.pk for cu in self.course_users[:2]]) \
+            .select_related('course')
+
+        with self.assertNumQueries(3):
+            schedule = load_schedule(course_users)
+
+        self.assertEqual(schedule[self.course_users[0].pk], [
+            (self.exam, self.times[1]),
+            (self.other_exam, None),
+        ])
+        self.assertEqual(schedule[self.course_users[1].pk], [
+            (self.exam, None),
+            (self.other_exam, None),
+        ])
+
+    def test_course_detail(self):
+        """
+        Checks that the course page shows the registered start time of
+        each exam.
+        """
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+        response = self.client.get(reverse('registration:course-detail',
+            args=[self.course.code]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['exam_list'], [
+            (self.exam, self.times[1]),
+            (self.other_exam, None),
+        ])
+        self.assertContains(response, 'Not registered')
+
+
+class SerializationFailure(Exception):
+    pgcode = '40001'
+
+
+def make_conflict():
+    """Returns an error like the one raised on a serialization failure."""
+    exc = OperationalError("could not serialize access")
+    exc.__cause__ = SerializationFailure()
+    return exc
+
+
+@override_settings(RETRY_BASE_DELAY=0, RETRY_MAX_ATTEMPTS=3)
+class RetryTests(TransactionTestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+        retry_counters.clear()
+
+    def patch_reserve_seat(self, conflicts):
+        """
+        Makes ExamSlot.reserve_seat() raise a serialization failure the
+        given number of times before succeeding.
+        """
+        reserve_seat = ExamSlot.reserve_seat
+        remaining = [conflicts]
+
+        def side_effect(*args, **kwargs):
+            if remaining[0]:
+                remaining[0] -= 1
+                raise make_conflict()
+            return reserve_seat(*args, **kwargs)
+
+        return mock.patch.object(ExamSlot, 'reserve_seat',
+            side_effect=side_effect)
+
+    def test_update_slot_retries_conflict(self):
+        """
+        Checks that update_slot() is rerun from the start after a
+        serialization failure, without keeping any of its earlier writes.
+        """
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk,
+            self.exam_slots[0].pk,
+        )
+        with self.patch_reserve_seat(conflicts=2):
+            ExamRegistration.update_slot(
+                self.exam_registrations[0].pk,
+                self.exam_slots[1].pk,
+            )
+
+        exam_reg = ExamRegistration.objects.get(
+            pk=self.exam_registrations[0].pk)
+        self.assertEqual(exam_reg.exam_slot_id, self.exam_slots[1].pk)
+        self.assertEqual(
+            [ts.reg_count for ts in TimeSlot.objects.order_by('pk')],
+            [0, 1, 1],
+        )
+        counters = retry_counters.summary()['ExamRegistration.update_slot']
+        self.assertEqual(counters['attempts'], 4)
+        self.assertEqual(counters['retries'], 2)
+        self.assertEqual(counters['failures'], 0)
+
+    def test_update_slot_gives_up_after_max_attempts(self):
+        """
+        Checks that TransactionConflict is raised once a transaction has
+        conflicted RETRY_MAX_ATTEMPTS times.
+        """
+        with self.patch_reserve_seat(conflicts=3):
+            with self.assertRaises(TransactionConflict):
+                ExamRegistration.update_slot(
+                    self.exam_registrations[0].pk,
+                    self.exam_slots[0].pk,
+                )
+
+        exam_reg = ExamRegistration.objects.get(
+            pk=self.exam_registrations[0].pk)
+        self.assertIsNone(exam_reg.exam_slot_id)
+        counters = retry_counters.summary()['ExamRegistration.update_slot']
+        self.assertEqual(counters['attempts'], 3)
+        self.assertEqual(counters['failures'], 1)
+
+    def test_update_slot_does_not_retry_integrity_error(self):
+        """
+        Checks that a rejected update is not retried.
+        """
+        for exam_reg in self.exam_registrations[:2]:
+            ExamRegistration.update_slot(exam_reg.pk, self.exam_slots[2].pk)
+        retry_counters.clear()
+
+        with self.assertRaises(IntegrityError):
+            ExamRegistration.update_slot(
+                self.exam_registrations[2].pk,
+                self.exam_slots[2].pk,
+            )
+        counters = retry_counters.summary()['ExamRegistration.update_slot']
+        self.assertEqual(counters['attempts'], 1)
+        self.assertEqual(counters['retries'], 0)
+
+    def test_update_slot_in_atomic_block_is_not_retried(self):
+        """
+        Checks that a conflict inside an outer transaction is passed on,
+        since only the outer transaction could be retried.
+        """
+        with self.patch_reserve_seat(conflicts=1):
+            with self.assertRaises(OperationalError) as cm:
+                with transaction.atomic():
+                    ExamRegistration.update_slot(
+                        self.exam_registrations[0].pk,
+                        self.exam_slots[0].pk,
+                    )
+        self.assertNotIsInstance(cm.exception, TransactionConflict)
+
+    def test_exam_detail_reports_conflict(self):
+        """
+        Checks that a student whose registration keeps conflicting is shown
+        an error instead of a server error.
+        """
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+        with self.patch_reserve_seat(conflicts=3):
+            response = self.client.post(
+                reverse('registration:exam-detail',
+                    args=[self.course.code, self.exam.pk]),
+                {'exam_slot': self.exam_slots[0].pk},
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "The database is busy")
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        self.exam.admission_limit = 1
+        self.exam.save()
+        self.url = reverse('registration:exam-detail',
+            args=[self.course.code, self.exam.pk])
+
+    def post(self, username, exam_slot, ticket=None):
+        self.client.defaults['REMOTE_USER'] = username + '@andrew.cmu.edu'
+        data = {'exam_slot': exam_slot.pk}
+        if ticket is not None:
+            data['admission_ticket'] = ticket
+        return self.client.post(self.url, data)
+
+    def test_rejects_closed_registration_without_loading_exam(self):
+        """
+        Checks that changes made before registration opens are turned away
+        before the exam registration is loaded.
+        """
+        self.exam.lock_before = timezone.now() + datetime.timedelta(hours=1)
+        self.exam.save()
+
+        with mock.patch.object(ExamRegistration.objects, 'get_or_create') \
+                as get_or_create:
+            response = self.post('aaa', self.exam_slots[0])
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        get_or_create.assert_not_called()
+
+        response = self.client.get(self.url)
+        self.assertContains(response, "Exam registration is not yet open")
+
+    def test_queues_requests_over_limit(self):
+        """
+        Checks that changes over the admission limit are queued in order,
+        and are made once their ticket is served.
+        """
+        # Take the only place
+        taken = admission.try_admit(self.exam.pk, 1)
+        self.assertTrue(taken.admitted)
+
+        response = self.post('aaa', self.exam_slots[0])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.context['admission'].position, 1)
+        aaa_ticket = response.context['signed_ticket']
+
+        response = self.post('bbb', self.exam_slots[0])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.context['admission'].position, 2)
+        bbb_ticket = response.context['signed_ticket']
+
+        # Tickets only work for the user they were given to
+        response = self.post('bbb', self.exam_slots[0], ticket=aaa_ticket)
+        self.assertEqual(response.context['admission'].position, 3)
+
+        # Give back the place, which serves the first ticket only
+        admission.release(self.exam.pk, taken.place)
+        response = self.post('bbb', self.exam_slots[0], ticket=bbb_ticket)
+        self.assertEqual(response.status_code, 503)
+        response = self.post('aaa', self.exam_slots[0], ticket=aaa_ticket)
+        self.assertEqual(response.status_code, 302)
+        response = self.post('bbb', self.exam_slots[0], ticket=bbb_ticket)
+        self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(
+            ExamRegistration.objects
+                .filter(exam_slot=self.exam_slots[0])
+                .count(),
+            2,
+        )
+
+    def test_instructors_skip_queue(self):
+        """
+        Checks that instructors are never queued.
+        """
+        self.course_users[0].user_type = CourseUser.INSTRUCTOR
+        self.course_users[0].save()
+        self.assertTrue(admission.try_admit(self.exam.pk, 1).admitted)
+
+        response = self.post('aaa', self.exam_slots[0])
+        self.assertEqual(response.status_code, 302)
+
+    def test_instructors_force_update_under_sudo(self):
+        """
+        Checks that instructors acting as a student can still force an
+        update while registration is closed.
+        """
+        self.course_users[0].user_type = CourseUser.INSTRUCTOR
+        self.course_users[0].save()
+        self.exam.lock_before = timezone.now() + datetime.timedelta(hours=1)
+        self.exam.save()
+
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+        self.client.get(self.url)
+        session = self.client.session
+        session['sudo_user'] = {
+            'username': 'bbb',
+            'pk': self.course_users[1].pk,
+            'user_pk': self.users[1].pk,
+            'course_code': self.course.code,
+        }
+        session.save()
+
+        response = self.client.post(self.url, {
+            'exam_slot': self.exam_slots[0].pk,
+            'force_field': 'on',
+        })
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        self.exam_registrations[1].refresh_from_db()
+        self.assertEqual(
+            self.exam_registrations[1].exam_slot, self.exam_slots[0])
+
+    @override_settings(ADMISSION_TICKET_TIMEOUT=0)
+    def test_skips_stale_tickets(self):
+        """
+        Checks that places held for tickets that are never used are given
+        to the next tickets after ADMISSION_TICKET_TIMEOUT.
+        """
+        taken = admission.try_admit(self.exam.pk, 1)
+        self.assertTrue(taken.admitted)
+        first = admission.try_admit(self.exam.pk, 1)
+        second = admission.try_admit(self.exam.pk, 1)
+        self.assertEqual((first.position, second.position), (1, 2))
+
+        # The first ticket is served, but never used
+        admission.release(self.exam.pk, taken.place)
+        self.assertFalse(
+            admission.try_admit(self.exam.pk, 1, second.ticket).admitted)
+        self.assertTrue(
+            admission.try_admit(self.exam.pk, 1, second.ticket).admitted)
+
+    @override_settings(ADMISSION_TICKET_MAX_AGE=600,
+        ADMISSION_TICKET_TIMEOUT=10)
+    def test_places_of_lost_requests_expire(self):
+        """
+        Checks that places that are never given back, because the requests
+        holding them died, expire after ADMISSION_TICKET_MAX_AGE, and then
+        go to the tickets waiting for them.
+        """
+        now = time.time()
+        self.assertTrue(admission.try_admit(self.exam.pk, 2).admitted)
+        self.assertTrue(admission.try_admit(self.exam.pk, 2).admitted)
+        queued = admission.try_admit(self.exam.pk, 2)
+        self.assertFalse(queued.admitted)
+
+        with mock.patch('time.time', return_value=now + 601):
+            self.assertFalse(
+                admission.try_admit(self.exam.pk, 2, queued.ticket).admitted)
+        with mock.patch('time.time', return_value=now + 612):
+            self.assertFalse(
+                admission.try_admit(self.exam.pk, 2, queued.ticket).admitted)
+            self.assertTrue(
+                admission.try_admit(self.exam.pk, 2, queued.ticket).admitted)
+
+
+@override_settings(MEMBERSHIP_CACHE='default')
+class WarmupTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        self.exam.lock_before = timezone.now() + datetime.timedelta(minutes=2)
+        self.exam.save()
+
+    def test_get_exams_to_warm(self):
+        """
+        Checks that only exams opening within the lead time are warmed.
+        """
+        now = timezone.now()
+        self.assertEqual(list(get_exams_to_warm(
+            now, datetime.timedelta(minutes=5))), [self.exam])
+        self.assertEqual(list(get_exams_to_warm(
+            now, datetime.timedelta(minutes=1))), [])
+
+    def test_warm_exam(self):
+        """
+        Checks that after warming, the data the exam page needs is served
+        from the cache without any queries.
+        """
+        self.users[1].timezone = 'Asia/Qatar'
+        self.users[1].save()
+
+        result = warm_exam(self.exam, 60)
+        self.assertEqual(result.timelines, 2)
+        self.assertEqual(result.users, 3)
+
+        with self.assertNumQueries(0):
+            admission.get_exam_gate(self.exam.pk)
+            get_cached_seats_left(self.exam)
+            for name in ['America/New_York', 'Asia/Qatar']:
+                with timezone.override(name):
+                    get_cached_exam_timeline(self.exam, CourseUser.NORMAL)
+            memberships = membership.get_cached_memberships(self.users[0].pk)
+        self.assertEqual(list(memberships), [self.course.code])
+
+    def test_warm_exam_survives_bookings(self):
+        """
+        Checks that once a booking bumps the seat version, the warmed exam
+        gate and exam slots are still used, and only the seat counts are
+        loaded again.
+        """
+        warm_exam(self.exam, 60)
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk, self.exam_slots[0].pk)
+        availability.bump_version(self.exam.pk)
+
+        with self.assertNumQueries(1):
+            admission.get_exam_gate(self.exam.pk)
+            with timezone.override('America/New_York'):
+                timeline = get_cached_exam_timeline(
+                    self.exam, CourseUser.NORMAL)
+        slot = timeline[0].slots[0]
+        self.assertEqual((slot.pk, slot.reg_count, slot.slots_left),
+            (self.exam_slots[0].pk, 1, 1))
+
+    def test_warm_exam_cache_command(self):
+        """
+        Checks that the warm_exam_cache command warms exams opening soon,
+        and reports what it warmed.
+        """
+        out = StringIO()
+        call_command('warm_exam_cache', stdout=out, stderr=StringIO())
+        self.assertIn("warmed 1 timelines and 3 users' memberships",
+            out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('warm_exam_cache', exam_ids=[self.exam.pk + 1],
+                stdout=StringIO(), stderr=StringIO())
+
+
+class AssignmentTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        # Users without exam registrations
+        for username, fields in [
+            ('ddd', {}),
+            ('eee', {'exam_slot_type': CourseUser.EXTENDED_TIME}),
+            ('fff', {'dropped': True}),
+            ('ggg', {'user_type': CourseUser.INSTRUCTOR}),
+        ]:
+            CourseUser.objects.create(
+                user=User.objects.create(username=username),
+                course=self.course,
+                **fields
+            )
+
+    def get_assigned(self):
+        return dict(ExamRegistration.objects
+            .filter(exam=self.exam, exam_slot__isnull=False)
+            .values_list('course_user__user__username', 'exam_slot'))
+
+    def test_dry_run(self):
+        """
+        Checks that a dry run plans the assignment without writing it or
+        locking the slots.
+        """
+        with mock.patch('django.db.models.query.QuerySet.select_for_update') \
+                as select_for_update:
+            plan = assign_unregistered(self.exam, dry_run=True)
+        select_for_update.assert_not_called()
+        self.assertEqual(len(plan.assignments), 4)
+        self.assertEqual(
+            [course_user.user.username for course_user in plan.unassigned],
+            ['eee'],
+        )
+        self.assertEqual(self.get_assigned(), {})
+        self.assertEqual(ExamRegistration.objects.count(), 3)
+
+    def test_assign_unregistered(self):
+        """
+        Checks that students are only assigned to exam slots of their type
+        with seats left in every time slot, and that the counters match
+        the registrations afterwards.
+        """
+        plan = assign_unregistered(self.exam)
+
+        self.assertEqual(self.get_assigned(), {
+            'aaa': self.exam_slots[0].pk,
+            'bbb': self.exam_slots[2].pk,
+            'ccc': self.exam_slots[0].pk,
+            'ddd': self.exam_slots[2].pk,
+        })
+        self.assertEqual(
+            [ts.reg_count for ts in TimeSlot.objects.order_by('pk')],
+            [2, 2, 2],
+        )
+        self.assertEqual(reconcile_exam(self.exam, dry_run=True), ([], []))
+        self.assertEqual(
+            ExamRegistration.history.filter(exam_slot__isnull=False).count(),
+            4,
+        )
+
+        # Everyone who can be assigned already is
+        plan = assign_unregistered(self.exam)
+        self.assertEqual(plan.assignments, [])
+
+    def test_exam_signups_assign(self):
+        """
+        Checks that instructors can preview and then make the assignment.
+        """
+        self.course_users[0].user_type = CourseUser.INSTRUCTOR
+        self.course_users[0].save()
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+        url = reverse('registration:exam-signups-assign',
+            args=[self.course.code, self.exam.pk])
+
+        response = self.client.get(url)
+        self.assertContains(response, "Assign 3 students")
+        self.assertEqual(self.get_assigned(), {})
+
+        response = self.client.post(url)
+        self.assertRedirects(response, reverse('registration:exam-signups',
+            args=[self.course.code, self.exam.pk]),
+            fetch_redirect_response=False)
+        self.assertEqual(len(self.get_assigned()), 3)
+
+
+class MoveRegistrationsTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+    def register(self, exam_reg, exam_slot):
+        ExamRegistration.update_slot(exam_reg.pk, exam_slot.pk)
+
+    def get_exam_slots(self):
+        return dict(ExamRegistration.objects
+            .values_list('course_user__user__username', 'exam_slot'))
+
+    def assertRegCounts(self, time_slot_reg_counts):
+        self.assertEqual(
+            [ts.reg_count for ts in TimeSlot.objects.order_by('pk')],
+            time_slot_reg_counts,
+        )
+        self.assertEqual(reconcile_exam(self.exam, dry_run=True), ([], []))
+
+    def test_move_registrations(self):
+        """
+        Checks that every registration of an exam slot is moved, with the
+        counters and history updated.
+        """
+        self.register(self.exam_registrations[0], self.exam_slots[2])
+        self.register(self.exam_registrations[1], self.exam_slots[2])
+
+        moved = ExamSlot.move_registrations(
+            self.exam_slots[2].pk, [self.exam_slots[0].pk])
+
+        self.assertEqual(moved, {self.exam_slots[0].pk: 2})
+        self.assertEqual(self.get_exam_slots(), {
+            'aaa': self.exam_slots[0].pk,
+            'bbb': self.exam_slots[0].pk,
+            'ccc': None,
+        })
+        self.assertRegCounts([2, 2, 0])
+        self.assertEqual(
+            ExamRegistration.history
+                .filter(exam_slot=self.exam_slots[0])
+                .count(),
+            2,
+        )
+
+    def test_move_some_registrations_to_several_targets(self):
+        """
+        Checks that only the given users are moved, and that targets are
+        filled in order, counting seats given back by the moved users.
+        """
+        for exam_reg in self.exam_registrations[:2]:
+            self.register(exam_reg, self.exam_slots[0])
+        self.register(self.exam_registrations[2], self.exam_slots[2])
+
+        # Only one seat is left in the third time slot
+        moved = ExamSlot.move_registrations(
+            self.exam_slots[0].pk,
+            [self.exam_slots[1].pk, self.exam_slots[2].pk],
+            course_user_pks=[self.course_users[0].pk],
+        )
+        self.assertEqual(moved, {
+            self.exam_slots[1].pk: 1,
+            self.exam_slots[2].pk: 0,
+        })
+        self.assertEqual(self.get_exam_slots(), {
+            'aaa': self.exam_slots[1].pk,
+            'bbb': self.exam_slots[0].pk,
+            'ccc': self.exam_slots[2].pk,
+        })
+        self.assertRegCounts([1, 2, 2])
+
+    def test_move_registrations_checks_capacity(self):
+        """
+        Checks that nothing is moved if the targets do not have enough
+        seats, unless forced.
+        """
+        for exam_reg in self.exam_registrations[:2]:
+            self.register(exam_reg, self.exam_slots[0])
+        self.register(self.exam_registrations[2], self.exam_slots[2])
+
+        with self.assertRaises(IntegrityError):
+            ExamSlot.move_registrations(
+                self.exam_slots[0].pk, [self.exam_slots[1].pk])
+        self.assertRegCounts([2, 2, 1])
+
+        ExamSlot.move_registrations(
+            self.exam_slots[0].pk, [self.exam_slots[1].pk], force=True)
+        self.assertRegCounts([0, 2, 3])
+
+    def test_move_registrations_needs_other_target(self):
+        """
+        Checks that moving registrations only to their own exam slot is
+        refused as such, even when forced.
+        """
+        self.register(self.exam_registrations[0], self.exam_slots[0])
+        with self.assertRaisesRegex(IntegrityError, "No target exam slots"):
+            ExamSlot.move_registrations(
+                self.exam_slots[0].pk, [self.exam_slots[0].pk], force=True)
+        self.assertRegCounts([1, 1, 0])
+
+    def test_move_registrations_skips_checked_in(self):
+        """
+        Checks that checked-in registrations are not moved.
+        """
+        self.register(self.exam_registrations[0], self.exam_slots[2])
+        self.register(self.exam_registrations[1], self.exam_slots[2])
+        ExamRegistration.objects \
+            .filter(pk=self.exam_registrations[0].pk) \
+            .update(checkin_time=timezone.now())
+
+        ExamSlot.move_registrations(
+            self.exam_slots[2].pk, [self.exam_slots[0].pk])
+        self.assertEqual(self.get_exam_slots()['aaa'], self.exam_slots[2].pk)
+        self.assertRegCounts([1, 1, 1])
+
+    def test_move_registrations_command(self):
+        """
+        Checks that the move_registrations command moves the registrations
+        of the given users.
+        """
+        self.register(self.exam_registrations[0], self.exam_slots[2])
+        self.register(self.exam_registrations[1], self.exam_slots[2])
+
+        out = StringIO()
+        call_command('move_registrations', str(self.exam_slots[2].pk),
+            '--to', str(self.exam_slots[0].pk), '--user', 'bbb', stdout=out)
+        self.assertIn("Moved 1 registrations to exam slot", out.getvalue())
+        self.assertEqual(self.get_exam_slots()['bbb'], self.exam_slots[0].pk)
+
+        with self.assertRaises(CommandError):
+            call_command('move_registrations', str(self.exam_slots[2].pk),
+                '--to', str(self.exam_slots[0].pk), '--user', 'zzz')
+
+
+class TimeSlotFormSetTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+
+    def make_formset(self, time_slots, new_times):
+        """
+        Returns a bound TimeSlotFormSet with the given stored time slots,
+        and new time slots with the given (start, end) times.
+        """
+        prefix = TimeSlotFormSet.get_default_prefix()
+        rows = [
+            (time_slot.pk, time_slot.start_time, time_slot.end_time)
+            for time_slot in time_slots
+        ] + [(None, start, end) for start, end in new_times]
+
+        data = {
+            prefix + '-TOTAL_FORMS': str(len(rows)),
+            prefix + '-INITIAL_FORMS': str(len(time_slots)),
+        }
+        for i, (pk, start, end) in enumerate(rows):
+            data.update({
+                '{}-{}-id'.format(prefix, i): pk or '',
+                '{}-{}-start_time'.format(prefix, i):
+                    timezone.localtime(start).strftime('%Y-%m-%d %H:%M:%S'),
+                '{}-{}-end_time'.format(prefix, i):
+                    timezone.localtime(end).strftime('%Y-%m-%d %H:%M:%S'),
+                '{}-{}-room'.format(prefix, i): '',
+                '{}-{}-capacity'.format(prefix, i): '2',
+            })
+        return TimeSlotFormSet(data, instance=self.exam,
+            queryset=TimeSlot.objects.filter(
+                pk__in=[time_slot.pk for time_slot in time_slots]))
+
+    def test_find_overlaps(self):
+        """
+        Checks that every interval overlapping an earlier one is found,
+        and that touching intervals do not overlap.
+        """
+        self.assertEqual(find_overlaps([
+            ('a', 0, 2), ('b', 1, 3), ('c', 3, 4), ('d', 2, 2), ('e', 4, 4),
+        ]), [('b', 'a'), ('d', 'b')])
+
+    def test_allows_adjacent_time_slots(self):
+        """
+        Checks that time slots that only touch are allowed.
+        """
+        hour = datetime.timedelta(hours=1)
+        formset = self.make_formset(self.time_slots, [
+            (self.times[3], self.times[3] + hour),
+            (self.times[3] + hour, self.times[3] + 2 * hour),
+        ])
+        self.assertTrue(formset.is_valid(), formset.errors)
+
+    def test_rejects_overlapping_new_time_slots(self):
+        """
+        Checks that overlaps between time slots that are not saved yet are
+        detected.
+        """
+        hour = datetime.timedelta(hours=1)
+        formset = self.make_formset(self.time_slots, [
+            (self.times[3], self.times[3] + 2 * hour),
+            (self.times[3] + hour, self.times[3] + 3 * hour),
+        ])
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(
+            [bool(form.errors) for form in formset.forms],
+            [False, False, False, True, True],
+        )
+
+    def test_rejects_overlap_with_stored_time_slot(self):
+        """
+        Checks that overlaps with stored time slots not in the formset are
+        detected, without one query per time slot.
+        """
+        minutes = datetime.timedelta(minutes=30)
+        formset = self.make_formset(self.time_slots[:1], [
+            (self.times[3], self.times[3] + minutes),
+            (self.times[1] + minutes, self.times[2] + minutes),
+        ])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(formset.is_valid())
+        self.assertEqual(
+            [bool(form.errors) for form in formset.forms],
+            [False, False, True],
+        )
+        self.assertFalse([
+            query for query in queries
+            if '"end_time" >' in query['sql']
+        ])
+
+
+class SlotGeneratorTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        self.spec_data = {
+            'days': ['2018-07-05', '2018-07-04'],
+            'day_start': '09:00',
+            'day_end': '13:30',
+            'time_zone': 'America/New_York',
+            'rooms': [
+                {'name': 'GHC 5205', 'capacity': 30},
+                {'name': 'GHC 5208', 'capacity': 40},
+            ],
+            'slot_minutes': 60,
+            'exam_slots': 2,
+        }
+
+    def test_parse_schedule_spec(self):
+        """
+        Checks that invalid specs are rejected with a ValueError.
+        """
+        spec = parse_schedule_spec(self.spec_data)
+        self.assertEqual(spec.days, [
+            datetime.date(2018, 7, 4), datetime.date(2018, 7, 5),
+        ])
+        self.assertEqual(spec.extended_time_multiplier, 1.5)
+
+        for key, value in [
+            ('days', []),
+            ('days', ['2018-07-04', '2018-07-04']),
+            ('day_end', '08:00'),
+            ('time_zone', 'Mars/Olympus_Mons'),
+            ('rooms', [{'name': 'GHC 5205', 'capacity': 0}]),
+            ('slot_minutes', None),
+            ('extended_time_multiplier', 0.5),
+        ]:
+            with self.assertRaises(ValueError):
+                parse_schedule_spec(dict(self.spec_data, **{key: value}))
+
+    def test_create_schedule(self):
+        """
+        Checks that the time slots and exam slots of a spec are created,
+        with each exam slot taking consecutive time slots in one room.
+        """
+        spec = parse_schedule_spec(self.spec_data)
+        schedule = create_schedule(self.exam, spec)
+
+        # 4 time slots in each of 2 rooms on each of 2 days
+        self.assertEqual(len(schedule.time_slots), 16)
+        self.assertEqual(self.exam.time_slot_set.count(), 16)
+        self.assertEqual(
+            TimeSlot.history.filter(exam=self.exam).count(), 16)
+        self.assertEqual(
+            self.exam.time_slot_set.order_by('start_time').first().start_time,
+            dateparse.parse_datetime('2018-07-04T13:00Z'),
+        )
+
+        # 3 normal exam slots of 2 time slots, and 2 extended time exam
+        # slots of 3 time slots, in each room on each day
+        exam_slots = self.exam.exam_slot_set \
+            .prefetch_related('time_slots') \
+            .select_related('start_time_slot')
+        self.assertEqual(
+            sorted(exam_slot.exam_slot_type for exam_slot in exam_slots),
+            [CourseUser.EXTENDED_TIME] * 8 + [CourseUser.NORMAL] * 12,
+        )
+        for exam_slot in exam_slots:
+            time_slots = sorted(exam_slot.time_slots.all(),
+                key=lambda time_slot: time_slot.start_time)
+            self.assertEqual(time_slots[0], exam_slot.start_time_slot)
+            self.assertEqual(len(time_slots),
+                2 if exam_slot.exam_slot_type == CourseUser.NORMAL else 3)
+            for time_slot, next_time_slot in zip(time_slots, time_slots[1:]):
+                self.assertEqual(time_slot.end_time, next_time_slot.start_time)
+                self.assertEqual(time_slot.room, next_time_slot.room)
+
+    def test_create_schedule_rejects_overlaps(self):
+        """
+        Checks that nothing is created if the new time slots overlap
+        existing ones, and that a dry run creates nothing.
+        """
+        spec = parse_schedule_spec(self.spec_data)
+        create_schedule(self.exam, spec, dry_run=True)
+        self.assertEqual(self.exam.time_slot_set.count(), 0)
+        self.assertEqual(Room.objects.count(), 0)
+
+        create_schedule(self.exam, spec)
+        spec = parse_schedule_spec(dict(self.spec_data,
+            day_start='09:30', days=['2018-07-05']))
+        with self.assertRaises(ValueError):
+            create_schedule(self.exam, spec)
+        self.assertEqual(self.exam.time_slot_set.count(), 16)
+
+
+class SharedChoicesTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        # Time slot of another exam, which should not be a choice
+        self.other_exam = Exam.objects.create(
+            course=self.course,
+            name="Midterm Exam",
+        )
+        self.other_time_slot = TimeSlot.objects.create(
+            exam=self.other_exam,
+            capacity=2,
+            start_time=self.times[0],
+            end_time=self.times[1],
+        )
+
+    def add_exam_slots(self, count):
+        for _ in range(count):
+            exam_slot = ExamSlot.objects.create(
+                exam=self.exam,
+                start_time_slot=self.time_slots[0],
+                exam_slot_type=CourseUser.EXTENDED_TIME,
+            )
+            exam_slot.time_slots.add(*self.time_slots)
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return len(queries)
+
+    def test_exam_slot_formset_loads_choices_once(self):
+        """
+        Checks that rendering the exam slot formset takes the same number
+        of queries however many exam slots there are, and only offers the
+        time slots of the exam.
+        """
+        def render():
+            formset = ExamSlotFormSet(instance=self.exam)
+            return str(formset) + str(formset.empty_form)
+
+        html = render()
+        self.assertIn('value="{}"'.format(self.time_slots[0].pk), html)
+        self.assertNotIn('value="{}"'.format(self.other_time_slot.pk), html)
+
+        num_queries = self.count_queries(render)
+        self.add_exam_slots(10)
+        self.assertEqual(self.count_queries(render), num_queries)
+
+    def test_exam_slot_formset_validates_shared_choices(self):
+        """
+        Checks that the exam slot formset saves the chosen time slots, and
+        rejects time slots of another exam.
+        """
+        prefix = ExamSlotFormSet.get_default_prefix()
+
+        def make_data(time_slot_pks):
+            data = {
+                prefix + '-TOTAL_FORMS': str(len(self.exam_slots)),
+                prefix + '-INITIAL_FORMS': str(len(self.exam_slots)),
+            }
+            for i, exam_slot in enumerate(self.exam_slots):
+                data.update({
+                    '{}-{}-id'.format(prefix, i): exam_slot.pk,
+                    '{}-{}-exam_slot_type'.format(prefix, i):
+                        exam_slot.exam_slot_type,
+                    '{}-{}-time_slots'.format(prefix, i): [
+                        time_slot.pk
+                        for time_slot in exam_slot.time_slots.all()
+                    ],
+                })
+            data['{}-2-time_slots'.format(prefix)] = time_slot_pks
+            return data
+
+        formset = ExamSlotFormSet(
+            make_data([self.other_time_slot.pk]), instance=self.exam)
+        self.assertFalse(formset.is_valid())
+        self.assertIn('time_slots', formset.forms[2].errors)
+
+        formset = ExamSlotFormSet(make_data([
+            self.time_slots[1].pk, self.time_slots[2].pk,
+        ]), instance=self.exam)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(
+            set(self.exam_slots[2].time_slots.all()),
+            set(self.time_slots[1:]),
+        )
+
+    def test_admin_pages_load_choices_once(self):
+        """
+        Checks that the admin pages with inlines of exam slots, time slots
+        and registrations take the same number of queries however many
+        rows there are.
+        """
+        User.objects.filter(pk=self.users[0].pk) \
+            .update(is_staff=True, is_superuser=True)
+        self.client.defaults['REMOTE_USER'] = 'aaa@andrew.cmu.edu'
+
+        exam_url = reverse('admin:registration_exam_change',
+            args=[self.exam.pk])
+        course_user_url = reverse('admin:registration_courseuser_change',
+            args=[self.course_users[0].pk])
+
+        def count_get_queries(url):
+            # Get the page once first, so that logging in is not counted
+            self.assertEqual(self.client.get(url).status_code, 200)
+            return self.count_queries(lambda: self.client.get(url))
+
+        exam_queries = count_get_queries(exam_url)
+        course_user_queries = count_get_queries(course_user_url)
+
+        self.add_exam_slots(5)
+        for _ in range(5):
+            TimeSlot.objects.create(
+                exam=self.exam,
+                capacity=2,
+                start_time=self.times[3],
+                end_time=self.times[3] + datetime.timedelta(hours=1),
+                room=Room.objects.create(course=self.course,
+                    name='Room {}'.format(Room.objects.count()),
+                    capacity=2),
+            )
+        for i in range(5):
+            ExamRegistration.objects.create(
+                exam=Exam.objects.create(course=self.course,
+                    name="Quiz {}".format(i)),
+                course_user=self.course_users[0],
+            )
+
+        self.assertEqual(count_get_queries(exam_url), exam_queries)
+        self.assertEqual(count_get_queries(course_user_url),
+            course_user_queries)
+
+
+class HistoryPolicyTests(TransactionTestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+    def test_counter_saves_skip_history(self):
+        """
+        Checks that saves of only the reg_count counters are not recorded,
+        and that other saves still are.
+        """
+        time_slot_history = TimeSlot.history.count()
+        exam_slot_history = ExamSlot.history.count()
+
+        self.time_slots[0].update_reg_count()
+        self.exam_slots[0].update_reg_count()
+        self.assertEqual(TimeSlot.history.count(), time_slot_history)
+        self.assertEqual(ExamSlot.history.count(), exam_slot_history)
+
+        self.time_slots[0].capacity = 3
+        self.time_slots[0].save(update_fields=['capacity', 'reg_count'])
+        self.assertEqual(TimeSlot.history.count(), time_slot_history + 1)
+
+    def test_registration_history_written_after_commit(self):
+        """
+        Checks that registration history is written with one insert once
+        the transaction commits, and not at all if it rolls back.
+        """
+        history = ExamRegistration.history.count()
+        exam_regs = self.exam_registrations[:2]
+
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for exam_reg in exam_regs:
+                    exam_reg.exam_slot = self.exam_slots[0]
+                    exam_reg.save(update_fields=['exam_slot'])
+                self.assertEqual(ExamRegistration.history.count(), history)
+        self.assertEqual(ExamRegistration.history.count(), history + 2)
+        self.assertEqual(len([
+            query for query in queries
+            if query['sql'].startswith(
+                'INSERT INTO "registration_historicalexamregistration"')
+        ]), 1)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                exam_regs[0].save(update_fields=['exam_slot'])
+                raise IntegrityError
+        self.assertEqual(ExamRegistration.history.count(), history + 2)
+
+        with transaction.atomic():
+            exam_regs[0].save(update_fields=['exam_slot'])
+        self.assertEqual(ExamRegistration.history.count(), history + 3)
+
+    def test_savepoint_history_written_right_away(self):
+        """
+        Checks that history of saves inside a savepoint is written right
+        away, so that it is rolled back along with the savepoint.
+        """
+        history = ExamRegistration.history.count()
+        exam_reg = self.exam_registrations[0]
+
+        with transaction.atomic():
+            with transaction.atomic():
+                exam_reg.save(update_fields=['exam_slot'])
+                self.assertEqual(ExamRegistration.history.count(),
+                    history + 1)
+            try:
+                with transaction.atomic():
+                    exam_reg.save(update_fields=['exam_slot'])
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+        self.assertEqual(ExamRegistration.history.count(), history + 1)
+
+    @override_settings(HISTORY_DEFER_WRITES=False)
+    def test_defer_writes_setting(self):
+        """
+        Checks that history is written with each save when deferring is
+        turned off.
+        """
+        history = ExamRegistration.history.count()
+        with transaction.atomic():
+            self.exam_registrations[0].save(update_fields=['exam_slot'])
+            self.assertEqual(ExamRegistration.history.count(), history + 1)
+
+
+class HistoryArchiveTests(TestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def get_history(self, course):
+        """Returns every history record of a course, as tuples."""
+        return {
+            history_model._meta.label_lower: sorted(records.values_list())
+            for history_model, records in get_course_history(course.pk)
+        }
+
+    def test_compact_history(self):
+        """
+        Checks that runs of changes to only reg_count are compacted to
+        their last record, and that other changes are kept.
+        """
+        time_slot = self.time_slots[0]
+        for reg_count in [1, 2, 3]:
+            time_slot.reg_count = reg_count
+            TimeSlot.history.bulk_history_create([time_slot], update=True)
+        time_slot.capacity = 5
+        TimeSlot.history.bulk_history_create([time_slot], update=True)
+        time_slot.reg_count = 4
+        TimeSlot.history.bulk_history_create([time_slot], update=True)
+
+        self.assertEqual(compact_history(self.course, dry_run=True)
+            ['registration.historicaltimeslot'], 2)
+        self.assertEqual(TimeSlot.history.filter(id=time_slot.pk).count(), 6)
+
+        compact_history(self.course)
+        self.assertEqual(
+            list(TimeSlot.history
+                .filter(id=time_slot.pk)
+                .order_by('history_date', 'history_id')
+                .values_list('reg_count', 'capacity')),
+            [(0, 2), (3, 2), (3, 5), (4, 5)],
+        )
+
+    def test_archive_and_restore(self):
+        """
+        Checks that archiving moves the history of only the course to files
+        partitioned by month, and that restoring brings it back unchanged.
+        """
+        other_course = Course.objects.create(code='15213-f18', name="ICS")
+        Exam.objects.create(course=other_course, name="Final Exam")
+        other_history = self.get_history(other_course)
+
+        ExamRegistration.history \
+            .filter(id=self.exam_registrations[0].pk) \
+            .update(history_date=self.times[0])
+        history = self.get_history(self.course)
+        self.assertTrue(history['registration.historicalexamregistration'])
+
+        call_command('history_archive', 'archive', self.course.code,
+            '--root', self.root.name, stdout=StringIO())
+        self.assertFalse(any(self.get_history(self.course).values()))
+        self.assertEqual(self.get_history(other_course), other_history)
+
+        directory = os.path.join(self.root.name, self.course.code,
+            'registration.historicalexamregistration')
+        self.assertIn('2018-07.jsonl.gz', os.listdir(directory))
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        # Restoring twice restores each record once
+        for _ in range(2):
+            call_command('history_archive', 'restore', self.course.code,
+                '--root', self.root.name, stdout=StringIO())
+            self.assertEqual(self.get_history(self.course), history)
+
+    def test_archive_leaves_out_access_tokens(self):
+        """
+        Checks that GitHub access tokens are not written to the archive,
+        and are blank in restored records.
+        """
+        GithubToken.objects.create(
+            course_user=self.course_users[0],
+            github_login='aaa',
+            token_type='bearer',
+            access_token='secret-token',
+        )
+        call_command('history_archive', 'archive', self.course.code,
+            '--root', self.root.name, stdout=StringIO())
+        directory = os.path.join(self.root.name, self.course.code,
+            'registration.historicalgithubtoken')
+        for name in os.listdir(directory):
+            with gzip.open(os.path.join(directory, name), 'rt') as f:
+                self.assertNotIn('secret-token', f.read())
+
+        call_command('history_archive', 'restore', self.course.code,
+            '--root', self.root.name, stdout=StringIO())
+        self.assertEqual(
+            list(GithubToken.history.values_list('github_login',
+                'access_token')),
+            [('aaa', '')],
+        )
+
+    def test_archive_refuses_unfinished_course(self):
+        """
+        Checks that the history of a course with time slots that have not
+        ended is only archived with --force, and that a dry run changes
+        nothing.
+        """
+        TimeSlot.objects.filter(pk=self.time_slots[2].pk) \
+            .update(end_time=timezone.now() + datetime.timedelta(days=1))
+        history = self.get_history(self.course)
+
+        with self.assertRaises(CommandError):
+            call_command('history_archive', 'archive', self.course.code,
+                '--root', self.root.name, stdout=StringIO())
+
+        call_command('history_archive', 'archive', self.course.code,
+            '--root', self.root.name, '--force', '--dry-run',
+            stdout=StringIO())
+        self.assertEqual(self.get_history(self.course), history)
+        self.assertEqual(os.listdir(self.root.name), [])
+
+        with self.assertRaises(CommandError):
+            call_command('history_archive', 'restore', 'no-such-course',
+                '--root', self.root.name, stdout=StringIO())
+
+
+class CourseArchiveTests(TransactionTestCase):
+    def setUp(self):
+        make_exam(self)
+        make_time_slots(self)
+        make_exam_slots(self)
+        make_registered_users(self)
+
+        ExamRegistration.update_slot(
+            self.exam_registrations[0].pk, self.exam_slots[0].pk)
+        self.course_users[1].user_type = CourseUser.INSTRUCTOR
+        self.course_users[1].save()
+
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def get_tables(self):
+        """Returns the rows of the course, minus the archive timestamp."""
+        snapshot = build_snapshot(self.course, None)
+        del snapshot['archived_at']
+        return snapshot
+
+    def archive(self):
+        with override_settings(COURSE_ARCHIVE_ROOT=self.root.name):
+            call_command('course_archive', 'archive', self.course.code,
+                stdout=StringIO())
+
+    def test_archive_and_restore(self):
+        """
+        Checks that archiving removes every row of the course and nothing
+        else, and that restoring brings the same rows back.
+        """
+        other_course = Course.objects.create(code='15213-f18', name="ICS")
+        Exam.objects.create(course=other_course, name="Final Exam")
+        tables = self.get_tables()
+        history = ExamRegistration.history.count()
+
+        self.archive()
+        self.assertFalse(any(
+            table['rows'] for table in self.get_tables()['tables'].values()))
+        self.assertEqual(ExamRegistration.history.count(), history)
+        self.assertEqual(User.objects.count(), len(self.users))
+        self.assertTrue(Exam.objects.filter(course=other_course).exists())
+
+        # Restore, with a user that was deleted since
+        self.users[2].delete()
+        call_command('course_archive', 'restore', self.course.code,
+            '--root', self.root.name, stdout=StringIO())
+        self.assertEqual(os.listdir(self.root.name), [])
+
+        # The user is created again, with a new pk
+        restored = self.get_tables()
+        for snapshot in [tables, restored]:
+            usernames = {row[0]: row[1] for row in snapshot['users']['rows']}
+            for row in snapshot['users']['rows']:
+                row[0] = None
+            for row in snapshot['tables']['registration.courseuser']['rows']:
+                row[1] = usernames[row[1]]
+        self.assertEqual(restored, tables)
+
+    def test_archived_course_view(self):
+        """
+        Checks that an archived course can be browsed by its instructors
+        without any queries, and not by its students.
+        """
+        self.archive()
+        url = reverse('registration:archived-course-detail',
+            args=[self.course.code])
+
+        with override_settings(COURSE_ARCHIVE_ROOT=self.root.name):
+            response = self.client.get(url, REMOTE_USER='aaa@andrew.cmu.edu')
+            self.assertEqual(response.status_code, 403)
+
+            self.client.defaults['REMOTE_USER'] = 'bbb@andrew.cmu.edu'
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, self.exam.name)
+            self.assertContains(response, 'aaa')
+            self.assertFalse([
+                query for query in queries
+                if 'registration_exam' in query['sql'] or
+                    'registration_course"' in query['sql']
+            ])
+
+            response = self.client.get(
+                reverse('registration:archived-course-detail',
+                    args=['no-such-course']))
+            self.assertEqual(response.status_code, 404)
+
+    def test_archive_drops_github_tokens(self):
+        """
+        Checks that the GitHub tokens of a course are deleted, and are not
+        written to its snapshot.
+        """
+        GithubToken.objects.create(
+            course_user=self.course_users[0],
+            github_login='aaa',
+            token_type='bearer',
+            access_token='secret-token',
+        )
+        self.archive()
+        self.assertFalse(GithubToken.objects.exists())
+        path = os.path.join(self.root.name, self.course.code + '.json.gz')
+        with gzip.open(path, 'rt') as f:
+            self.assertNotIn('secret-token', f.read())
+
+        call_command('course_archive', 'restore', self.course.code,
+            '--root', self.root.name, stdout=StringIO())
+        self.assertEqual(CourseUser.objects.count(), len(self.course_users))
+
+    def test_archive_refuses_archived_code(self):
+        """
+        Checks that a course is not archived over the snapshot of an
+        earlier course with the same code.
+        """
+        self.archive()
+        path = os.path.join(self.root.name, self.course.code + '.json.gz')
+        with open(path, 'rb') as f:
+            snapshot = f.read()
+
+        course = Course.objects.create(code=self.course.code, name="Again")
+        with self.assertRaises(CommandError):
+            self.archive()
+        self.assertTrue(Course.objects.filter(pk=course.pk).exists())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), snapshot)
+
+    def test_archive_failure_leaves_no_snapshot(self):
+        """
+        Checks that no snapshot is left behind if the course cannot be
+        deleted.
+        """
+        with mock.patch('django.db.models.query.QuerySet._raw_delete',
+                side_effect=OperationalError("database is locked")):
+            with self.assertRaises(OperationalError):
+                self.archive()
+        self.assertEqual(os.listdir(self.root.name), [])
+        self.assertTrue(Course.objects.filter(pk=self.course.pk).exists())
+
+    def test_archive_refuses_unfinished_course(self):
+        """
+        Checks that a course with time slots that have not ended is only
+        archived with --force.
+        """
+        TimeSlot.objects.filter(pk=self.time_slots[2].pk) \
+            .update(end_time=timezone.now() + datetime.timedelta(days=1))
+        with self.assertRaises(CommandError):
+            self.archive()
+        self.assertTrue(Course.objects.filter(pk=self.course.pk).exists())
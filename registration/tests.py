@@ -1,7 +1,10 @@
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
+from . import membership, timezones
+from .instrumentation import QueryBudgetExceeded, view_stats
 from .models import User, Course, CourseUser
 
 
@@ -27,6 +30,45 @@ class UserModelTests(TestCase):
         user.clean()
 
 
+class TimezoneTests(TestCase):
+
+    def test_get_timezone(self):
+        """
+        get_timezone() loads each time zone once, and returns None for
+        unknown time zones.
+        """
+        tz = timezones.get_timezone('Asia/Qatar')
+        self.assertEqual(tz.zone, 'Asia/Qatar')
+        self.assertIs(timezones.get_timezone('Asia/Qatar'), tz)
+        self.assertIsNone(timezones.get_timezone('America/Pittsburgh'))
+
+    def test_timezone_choices(self):
+        """
+        Time zone choices start with the CMU campuses, and include every
+        common time zone exactly once besides those.
+        """
+        choices = timezones.get_timezone_choices()
+        self.assertEqual(choices[0][0], 'CMU Campuses')
+
+        names = [tz for _, group in choices[1:] for tz, _ in group]
+        self.assertIn('UTC', names)
+        self.assertIn('America/New_York', names)
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_middleware_activates_user_timezone(self):
+        """
+        Requests are processed in the time zone of the user.
+        """
+        User.objects.create(username='tester', timezone='Asia/Qatar')
+        response = self.client.get(reverse('registration:profile'),
+            REMOTE_USER='tester@andrew.cmu.edu',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(timezone.get_current_timezone_name(), 'Asia/Qatar')
+        self.assertContains(response,
+            '<option value="Asia/Qatar" selected>Qatar (Asia/Qatar)</option>')
+
+
 class LoginTests(TestCase):
     def test_not_logged_in(self):
         """
@@ -156,3 +198,142 @@ class IndexViewTests(TestCase):
         self.assertContains(response,
             "Introduction to Computer Systems (Summer 2018)")
 
+
+@override_settings(MEMBERSHIP_CACHE='default')
+class MembershipTests(TestCase):
+    def setUp(self):
+        membership.get_cache().clear()
+        self.user = User.objects.create(username='tester')
+        self.client.defaults['REMOTE_USER'] = 'tester@andrew.cmu.edu'
+
+        self.course = Course.objects.create(
+            code='15101-m18',
+            name='Introduction to Computer Systems (Summer 2018)',
+        )
+        self.course_user = CourseUser.objects.create(
+            user=self.user,
+            course=self.course,
+            user_type=CourseUser.STUDENT,
+        )
+
+    def test_memberships_are_cached(self):
+        """
+        Memberships are loaded in one query, and cached until a course
+        user of the user changes.
+        """
+        with self.assertNumQueries(1):
+            memberships = membership.get_cached_memberships(self.user.pk)
+        self.assertEqual(memberships, {'15101-m18': self.course_user})
+
+        with self.assertNumQueries(0):
+            memberships = membership.get_cached_memberships(self.user.pk)
+        self.assertEqual(
+            memberships['15101-m18'].course.name, self.course.name)
+
+        self.course_user.user_type = CourseUser.INSTRUCTOR
+        self.course_user.save()
+        with self.assertNumQueries(1):
+            memberships = membership.get_cached_memberships(self.user.pk)
+        self.assertTrue(memberships['15101-m18'].is_instructor())
+
+        self.course.name = 'Renamed'
+        self.course.save()
+        memberships = membership.get_cached_memberships(self.user.pk)
+        self.assertEqual(memberships['15101-m18'].course.name, 'Renamed')
+
+        self.course_user.delete()
+        self.assertEqual(membership.get_cached_memberships(self.user.pk), {})
+
+    @override_settings(MEMBERSHIP_CACHE=None)
+    def test_memberships_not_cached_by_default(self):
+        """
+        Without MEMBERSHIP_CACHE, memberships are loaded once per request,
+        so changes made by other processes are seen right away.
+        """
+        with self.assertNumQueries(1):
+            membership.get_cached_memberships(self.user.pk)
+        CourseUser.objects.filter(pk=self.course_user.pk) \
+            .update(user_type=CourseUser.INSTRUCTOR)
+        with self.assertNumQueries(1):
+            memberships = membership.get_cached_memberships(self.user.pk)
+        self.assertTrue(memberships['15101-m18'].is_instructor())
+
+    def test_course_auth(self):
+        """
+        Course pages are only shown to users enrolled in the course, and
+        instructor pages only to instructors.
+        """
+        course_url = reverse('registration:course-detail',
+            args=['15101-m18'])
+        users_url = reverse('registration:course-users',
+            args=['15101-m18'])
+
+        self.assertEqual(self.client.get(course_url).status_code, 200)
+        self.assertEqual(self.client.get(users_url).status_code, 403)
+
+        self.course_user.user_type = CourseUser.INSTRUCTOR
+        self.course_user.save()
+        self.assertEqual(self.client.get(users_url).status_code, 200)
+
+        self.course_user.delete()
+        self.assertEqual(self.client.get(course_url).status_code, 403)
+        self.assertEqual(self.client.get(reverse(
+            'registration:course-detail', args=['nonexistent'])
+        ).status_code, 404)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        view_stats.clear()
+        self.user = User.objects.create(username='tester')
+        self.client.defaults['REMOTE_USER'] = 'tester@andrew.cmu.edu'
+
+    def test_requests_are_recorded(self):
+        """
+        Requests are summarized by view name, along with their queries and
+        response size.
+        """
+        response = self.client.get(reverse('registration:index'))
+        self.assertEqual(response.status_code, 200)
+
+        summary = view_stats.summary()
+        self.assertEqual(summary['index']['requests'], 1)
+        self.assertGreater(summary['index']['queries_max'], 0)
+        self.assertEqual(summary['index']['size_mean'], len(response.content))
+        self.assertEqual(summary['index']['over_budget'], 0)
+
+    def test_query_budget(self):
+        """
+        Going over a query budget raises an error when configured to, and
+        is otherwise only counted.
+        """
+        from . import views
+        index_budget = views.index.query_budget
+        views.index.query_budget = 0
+        try:
+            with override_settings(QUERY_BUDGET_ACTION='raise'):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(reverse('registration:index'))
+
+            with override_settings(QUERY_BUDGET_ACTION='warn'):
+                with self.assertLogs('registration.instrumentation',
+                        'WARNING'):
+                    response = self.client.get(reverse('registration:index'))
+                self.assertEqual(response.status_code, 200)
+        finally:
+            views.index.query_budget = index_budget
+
+        self.assertEqual(view_stats.summary()['index']['over_budget'], 2)
+
+    def test_summary_requires_superuser(self):
+        """
+        Only superusers can see the instrumentation summary.
+        """
+        url = reverse('registration:instrumentation-summary')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.user.is_superuser = True
+        self.user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('instrumentation-summary', response.json()['views'])
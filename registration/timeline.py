@@ -0,0 +1,185 @@
+from collections import namedtuple
+from itertools import groupby
+
+from django.db import models
+from django.utils import timezone
+
+from . import availability
+from .models import ExamSlot
+
+
+# Everything needed to render an exam slot, computed exactly once
+ExamSlotInfo = namedtuple('ExamSlotInfo', [
+    'pk',
+    'title',
+    'start_time',
+    'end_time',
+    'room',
+    'exam_slot_type',
+    'exam_slot_type_display',
+    'capacity',
+    'reg_count',
+    'slots_left',
+])
+
+# The slots starting on a given day
+ExamDay = namedtuple('ExamDay', ['day', 'slots'])
+
+
+def make_exam_slot_info(exam_slot):
+    """
+    Computes the rendered attributes of an exam slot. The exam slot should
+    have start_time_slot and its room selected, and time_slots prefetched.
+    """
+    time_slots = exam_slot.time_slots.all()
+    room = exam_slot.start_time_slot.room
+
+    return ExamSlotInfo(
+        pk=exam_slot.pk,
+        title=str(exam_slot),
+        start_time=exam_slot.start_time_slot.start_time,
+        end_time=max(time_slot.end_time for time_slot in time_slots),
+        room=str(room) if room is not None else '',
+        exam_slot_type=exam_slot.exam_slot_type,
+        exam_slot_type_display=exam_slot.exam_slot_type_display(),
+        capacity=min(time_slot.capacity for time_slot in time_slots),
+        reg_count=exam_slot.reg_count,
+        slots_left=min(
+            time_slot.capacity - time_slot.reg_count
+            for time_slot in time_slots
+        ),
+    )
+
+
+def get_exam_slot_infos(exam_slots):
+    """
+    Returns a list of ExamSlotInfo for the exam slots in a queryset, using
+    a fixed number of queries.
+    """
+    exam_slots = exam_slots \
+        .select_related('start_time_slot') \
+        .select_related('start_time_slot__room') \
+        .prefetch_related('time_slots')
+
+    return [
+        make_exam_slot_info(exam_slot)
+        for exam_slot in exam_slots
+        if exam_slot.time_slots.all()
+    ]
+
+
+def group_by_day(slots, get_start_time=lambda slot: slot.start_time):
+    """
+    Groups slots sorted by start time into a tuple of ExamDay, one for each
+    day (in the current time zone) that a slot starts on.
+    """
+    def get_day(slot):
+        return timezone.localtime(get_start_time(slot)).date()
+
+    return tuple(
+        ExamDay(day=day, slots=tuple(slots))
+        for day, slots in groupby(slots, key=get_day)
+    )
+
+
+def build_exam_timeline(exam, exam_slot_type=None):
+    """
+    Returns the exam slots of an exam as a tuple of ExamDay, one for each
+    day (in the current time zone) that an exam slot starts on. If
+    exam_slot_type is given, only exam slots of that type are included.
+    """
+    exam_slots = ExamSlot.objects.filter(exam=exam)
+    if exam_slot_type is not None:
+        exam_slots = exam_slots.filter(exam_slot_type=exam_slot_type)
+
+    slot_infos = sorted(
+        get_exam_slot_infos(exam_slots),
+        key=lambda slot: slot.start_time,
+    )
+    return group_by_day(slot_infos)
+
+
+def get_slot_counts(exam):
+    """
+    Returns a dict mapping the pk of each exam slot of an exam to its
+    registration count and number of seats left, using a single query.
+    """
+    exam_slots = exam.exam_slot_set \
+        .annotate(slots_left=models.Min(
+            models.F('time_slots__capacity') -
+            models.F('time_slots__reg_count')
+        )) \
+        .order_by() \
+        .values_list('pk', 'reg_count', 'slots_left')
+
+    return {
+        pk: (reg_count, slots_left)
+        for pk, reg_count, slots_left in exam_slots
+        if slots_left is not None
+    }
+
+
+def get_seats_left(exam):
+    """
+    Returns a dict mapping the pk of each exam slot of an exam to the number
+    of seats left in it, using a single query.
+    """
+    return {
+        pk: slots_left
+        for pk, (_, slots_left) in get_slot_counts(exam).items()
+    }
+
+
+def with_slot_counts(timeline, slot_counts):
+    """
+    Returns a timeline with the registration counts and seats left of its
+    slots replaced by those in slot_counts, as returned by
+    get_slot_counts().
+    """
+    def update(slot):
+        if slot.pk not in slot_counts:
+            return slot
+        reg_count, slots_left = slot_counts[slot.pk]
+        return slot._replace(reg_count=reg_count, slots_left=slots_left)
+
+    return tuple(
+        day._replace(slots=tuple(update(slot) for slot in day.slots))
+        for day in timeline
+    )
+
+
+def get_cached_slot_counts(exam):
+    """
+    Returns get_slot_counts(exam), cached until the seat counts of the exam
+    change.
+    """
+    return availability.get_or_compute(
+        exam.pk, 'slot_counts',
+        lambda: get_slot_counts(exam),
+    )
+
+
+def get_cached_exam_timeline(exam, exam_slot_type=None):
+    """
+    Returns build_exam_timeline(exam, exam_slot_type). The slots are cached
+    until the exam or its slots are edited, and their counts until the seat
+    counts of the exam change, so a booking only refreshes the counts.
+    """
+    timeline = availability.get_or_compute(
+        exam.pk, 'timeline',
+        lambda: build_exam_timeline(exam, exam_slot_type),
+        exam_slot_type, timezone.get_current_timezone_name(),
+        layout=True,
+    )
+    return with_slot_counts(timeline, get_cached_slot_counts(exam))
+
+
+def get_cached_seats_left(exam):
+    """
+    Returns get_seats_left(exam), cached until the seat counts of the exam
+    change.
+    """
+    return {
+        pk: slots_left
+        for pk, (_, slots_left) in get_cached_slot_counts(exam).items()
+    }
@@ -0,0 +1,68 @@
+"""
+Catalogue of the time zones users can choose from. The grouped choices and
+the tzinfo objects are built once per process and shared by the profile
+form, the time zone middleware and User validation.
+"""
+import functools
+
+import pytz
+
+
+# Time zone used when a user has not chosen a valid one
+DEFAULT_TIMEZONE = 'America/New_York'
+
+# Hardcode list of CMU timezones
+CMU_TIMEZONES = [
+    ('America/New_York', 'Pittsburgh (America/New_York)'),
+    ('Asia/Qatar', 'Qatar (Asia/Qatar)'),
+    ('America/Los_Angeles', 'Silicon Valley (America/Los_Angeles)'),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone_choices():
+    """
+    Returns the time zone choices for a select field, grouped into CMU
+    campuses, time zones by country, and all other time zones.
+    """
+    # Get timezones by country
+    tz_timezones = [
+        (
+            "{} ({})".format(pytz.country_names[code], code),
+            [(tz, tz) for tz in tzlist],
+        )
+        for (code, tzlist) in pytz.country_timezones.items()
+    ]
+    tz_timezones.sort()
+
+    # Get all other timezones (ex. UTC)
+    other_timezone_set = set(pytz.common_timezones)
+    for (code, tzlist) in pytz.country_timezones.items():
+        other_timezone_set -= set(tzlist)
+    other_timezones = [('Other timezones', [
+        (tz, tz) for tz in sorted(other_timezone_set)
+    ])]
+
+    return tuple(
+        [('CMU Campuses', CMU_TIMEZONES)] + tz_timezones + other_timezones
+    )
+
+
+def is_valid_timezone(name):
+    """Returns whether name is the name of a time zone."""
+    return name in pytz.all_timezones_set
+
+
+@functools.lru_cache(maxsize=None)
+def _get_timezone(name):
+    return pytz.timezone(name)
+
+
+def get_timezone(name):
+    """
+    Returns the tzinfo for a time zone name, or None if there is no such
+    time zone. Each time zone is only loaded once.
+    """
+    if not is_valid_timezone(name):
+        return None
+    return _get_timezone(name)
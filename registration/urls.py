@@ -6,12 +6,16 @@ app_name = 'registration'
 urlpatterns = [
     path('', views.index, name='index'),
     path('profile/', views.profile, name='profile'),
+    path('instrumentation/',
+        views.instrumentation_summary, name='instrumentation-summary'),
     path('courses/<course_code>/',
         views.course_detail, name='course-detail'),
     path('courses/<course_code>/edit/',
         views.course_edit, name='course-edit'),
     path('courses/<course_code>/sudo/',
         views.course_sudo, name='course-sudo'),
+    path('archive/<course_code>/',
+        views.archived_course_detail, name='archived-course-detail'),
 
     # GitHub authorization
     path('courses/<course_code>/github/landing/',
@@ -38,6 +42,8 @@ urlpatterns = [
     # Exams
     path('courses/<course_code>/exams/<int:exam_id>/',
         views.exam_detail, name='exam-detail'),
+    path('courses/<course_code>/exams/<int:exam_id>/seats/',
+        views.exam_detail_seats, name='exam-detail-seats'),
     path('courses/<course_code>/exams/<int:exam_id>/edit/',
         views.exam_edit, name='exam-edit'),
     path('courses/<course_code>/exams/<int:exam_id>/signups/',
@@ -46,6 +52,10 @@ urlpatterns = [
         views.exam_signups_csv, name='exam-signups-csv'),
     path('courses/<course_code>/exams/<int:exam_id>/signups/counts/',
         views.exam_signups_counts, name='exam-signups-counts'),
+    path('courses/<course_code>/exams/<int:exam_id>/signups/counts/json/',
+        views.exam_signups_counts_json, name='exam-signups-counts-json'),
+    path('courses/<course_code>/exams/<int:exam_id>/signups/assign/',
+        views.exam_signups_assign, name='exam-signups-assign'),
     path('courses/<course_code>/exams/<int:exam_id>/signups/<username>/',
         views.exam_signups_detail, name='exam-signups-detail'),
     path('courses/<course_code>/exams/<int:exam_id>/signups/<username>/checkin',
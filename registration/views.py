@@ -1,18 +1,20 @@
-import codecs
 import csv
+import hashlib
 from datetime import timedelta
-from itertools import chain
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
-from django.db import transaction, IntegrityError, models
+from django.db import IntegrityError, models
 from django.db.models.functions import TruncDay
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import (
+    Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+)
 from django.shortcuts import get_object_or_404, render, reverse
 from django.utils import timezone
-from django.utils.http import is_safe_url
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import is_safe_url, quote_etag
 from django.utils.text import slugify
 from django.views import generic
 from django.views.decorators.http import (
@@ -30,7 +32,26 @@ from .forms import (
     ExamCheckinForm, ExamEditSignupForm,
 )
 from .models import (
-    Course, CourseUser, Exam, ExamRegistration, GithubToken, User, ExamSlot
+    Course, CourseUser, Exam, ExamRegistration, GithubToken, User, ExamSlot,
+    TimeSlot,
+)
+from . import availability
+from .admission import (
+    get_exam_gate, get_lock_warning, release, sign_ticket, try_admit,
+    unsign_ticket,
+)
+from .assignment import assign_unregistered
+from .counts import (
+    get_signup_counts, group_counts_by_day, signup_counts_to_json
+)
+from .course_archive import load_archived_course
+from .instrumentation import query_budget, view_stats
+from .membership import get_membership, get_memberships
+from .retry import TransactionConflict, retry_counters, run_in_transaction
+from .roster import import_roster_from_csv_file
+from .schedule import load_schedule
+from .timeline import (
+    get_cached_exam_timeline, get_cached_seats_left, get_exam_slot_infos
 )
 
 
@@ -46,7 +67,8 @@ oauth.register(
 )
 
 
-def course_auth(request, course_code, instructor=False, use_sudo=True):
+def course_auth(request, course_code, instructor=False, use_sudo=True,
+        warn_dropped=True):
     """
     Checks whether a user is enrolled in the course. If so, a 2-tuple
     (course, course_user) is returned, and otherwise, a PermissionDenied
@@ -54,37 +76,35 @@ def course_auth(request, course_code, instructor=False, use_sudo=True):
 
     If instructor is True, then only instructors are permitted to access
     the course. If use_sudo is True, then the sudo user will be used if
-    activated in the session.
+    activated in the session. If warn_dropped is True, a warning message is
+    shown to users who have dropped the course.
     """
-    course = get_object_or_404(Course, code=course_code)
-
     # Get course user for request user
-    request.course_user = CourseUser.objects.get(
-        course=course,
-        user=request.user.id,
-    )
+    request.course_user = get_membership(request, course_code)
+    if request.course_user is None:
+        get_object_or_404(Course, code=course_code)
+        raise PermissionDenied("You are not enrolled in this course.")
+    course = request.course_user.course
 
     # Try to use sudo
     sudo = request.session.get('sudo_user', None)
     if (use_sudo and sudo is not None and
             sudo['course_code'] == course_code):
-        query = {'course': course, 'pk': sudo['pk']}
         request.sudo_enabled = True
+        try:
+            course_user = CourseUser.objects.get(course=course, pk=sudo['pk'])
+        except CourseUser.DoesNotExist:
+            raise PermissionDenied("You are not enrolled in this course.")
+        course_user.course = course
     else:
-        query = {'course': course, 'user': request.user.id}
+        course_user = request.course_user
 
     # Limit to instructors if necessary
-    if instructor:
-        query['user_type'] = CourseUser.INSTRUCTOR
-
-    # Look up CourseUser in database
-    try:
-        course_user = CourseUser.objects.get(**query)
-    except CourseUser.DoesNotExist:
+    if instructor and not course_user.is_instructor():
         raise PermissionDenied("You are not enrolled in this course.")
 
     # Warm if user is marked as dropped
-    if course_user.dropped:
+    if warn_dropped and course_user.dropped:
         messages.warning(request,
             "You may no longer update your information, since you have "
             "dropped this course. "
@@ -94,6 +114,7 @@ def course_auth(request, course_code, instructor=False, use_sudo=True):
     return course, course_user
 
 
+@query_budget(6)
 @require_safe
 @login_required
 def index(request):
@@ -101,12 +122,33 @@ def index(request):
     Displays the home page, with all courses the user is enrolled in. If
     the user is not authenticated, displays an error message.
     """
-    user = get_object_or_404(User, pk=request.user.id)
-    course_user_list = user.course_user_set.all() \
-            .select_related('course') \
-            .prefetch_related('course__exam_set')
+    course_user_list = sorted(
+        get_memberships(request).values(),
+        key=lambda course_user: course_user.pk,
+    )
+    schedule = load_schedule(course_user_list)
     return render(request, 'registration/index.html', {
         'course_user_list': course_user_list,
+        'schedule_list': [
+            (course_user, schedule[course_user.pk])
+            for course_user in course_user_list
+        ],
+    })
+
+
+@require_safe
+@login_required
+def instrumentation_summary(request):
+    """
+    Returns a summary of the recent requests to each view handled by this
+    process, and counters of transaction retries, as JSON. Only available
+    to superusers.
+    """
+    if not request.user.is_superuser:
+        raise PermissionDenied("Only superusers may view instrumentation.")
+    return JsonResponse({
+        'views': view_stats.summary(),
+        'transactions': retry_counters.summary(),
     })
 
 
@@ -158,25 +200,14 @@ def profile(request):
     })
 
 
+@query_budget(12)
 @require_safe
 @login_required
 def course_detail(request, course_code):
     course, my_course_user = course_auth(request, course_code)
 
-    # Get list of (exam, exam_reg)
-    def get_exam_reg(exam):
-        try:
-            return ExamRegistration.objects.get(
-                exam=exam,
-                course_user=my_course_user,
-            )
-        except ExamRegistration.DoesNotExist:
-            return None
-
-    exam_list = [
-        (exam, get_exam_reg(exam))
-        for exam in course.exam_set.all()
-    ]
+    # Get list of exams, with registered start times
+    exam_list = load_schedule([my_course_user])[my_course_user.pk]
 
     return render(request, 'registration/course_detail.html', {
         'course': course,
@@ -185,6 +216,31 @@ def course_detail(request, course_code):
     })
 
 
+@query_budget(4)
+@require_safe
+@login_required
+def archived_course_detail(request, course_code):
+    """
+    Displays an archived course, with the exam slots and registrations of
+    each exam, read from its snapshot rather than the database. Only
+    available to staff and the instructors of the course.
+    """
+    try:
+        course = load_archived_course(course_code,
+            settings.COURSE_ARCHIVE_ROOT)
+    except ValueError:
+        raise Http404("No archived course {}".format(course_code))
+
+    if not request.user.is_staff and \
+            request.user.username not in course.instructors:
+        raise PermissionDenied(
+            "Only instructors may view archived courses.")
+
+    return render(request, 'registration/archived_course.html', {
+        'course': course,
+    })
+
+
 @require_http_methods(['GET', 'HEAD', 'POST'])
 @login_required
 def course_edit(request, course_code):
@@ -494,92 +550,6 @@ def course_users_create(request, course_code):
     })
 
 
-def import_roster_row(course, row):
-    """
-    Imports a CSV row from a roster. The row should be represented as a
-    dictionary, with the columns having been already mapped to the
-    appropriate keys by a DictReader. A ValueError will be raised if
-    invalid data is encountered, and an IntegrityError may be raised by
-    the database (though this is not expected).
-
-    The function will create a User and CourseUser from the row's data.
-    When dealing with users that already exists, the current behavior is to
-    preserve rather than overwrite any existing data.
-    """
-    # Parse username
-    if 'username' in row and row['username']:
-        username = row['username']
-
-    elif 'email' in row and row['email']:
-        if not row['email'].endswith(settings.ANDREW_EMAIL_SUFFIX):
-            raise ValueError("Invalid email: " + row['email'])
-        username = row['email'][:-len(settings.ANDREW_EMAIL_SUFFIX)]
-
-    else:
-        raise ValueError("Neither username nor email present in row")
-
-    # Create User, or get if already exists
-    extra_keys = ['first_name', 'last_name']
-    extra_dict = {k: row[k] for k in extra_keys if k in row and row[k]}
-
-    user, created_user = User.objects.get_or_create(
-        username=username,
-        defaults=extra_dict,
-    )
-
-    if created_user:
-        user.configure_new()
-
-    # Create CourseUser, or get if already exists
-    extra_keys = ['section', 'lecture']
-    extra_dict = {k: row[k] for k in extra_keys if k in row and row[k]}
-
-    course_user, created = CourseUser.objects.get_or_create(
-        user=user,
-        course=course,
-        defaults=extra_dict,
-    )
-
-    return created
-
-
-def import_roster_rows(course, rows):
-    created_count = 0
-    skipped_count = 0
-
-    with transaction.atomic():
-        for row in rows:
-            created = import_roster_row(course, row)
-            if created:
-                created_count += 1
-            else:
-                skipped_count += 1
-
-    return (created_count, skipped_count)
-
-
-def import_roster_from_csv_file(course, f):
-    """
-    Imports an entire course roster from a file. The roster is parsed as
-    a CSV file in the Autolab format. The import is processed as a
-    transaction for speed, and so that any errors will cause the entire
-    import to fail.
-    """
-    # Column headers for Autolab CSV roster import
-    AUTOLAB_FIELDNAMES = [
-        'semester', 'email', 'last_name', 'first_name', 'school', 'major',
-        'year', 'grading_policy', 'lecture', 'section',
-    ]
-
-    with f:
-        text_file = codecs.iterdecode(f, 'utf-8')
-        reader = csv.DictReader(
-            text_file,
-            fieldnames=AUTOLAB_FIELDNAMES,
-        )
-        return import_roster_rows(course, reader)
-
-
 @require_http_methods(['GET', 'HEAD', 'POST'])
 @login_required
 def course_users_import(request, course_code):
@@ -601,7 +571,7 @@ def course_users_import(request, course_code):
                     "Failed to import roster: {}"
                 ).format(e))
 
-            except IntegrityError as e:
+            except (IntegrityError, TransactionConflict) as e:
                 messages.error(request, (
                     "A database error occurred: {}"
                 ).format(e))
@@ -675,11 +645,34 @@ def course_users_edit(request, course_code, course_user_id):
     })
 
 
+@query_budget(30)
 @require_http_methods(['GET', 'HEAD', 'POST'])
 @login_required
 def exam_detail(request, course_code, exam_id):
     request_time = timezone.now()
     course, my_course_user = course_auth(request, course_code)
+
+    # With admission control, turn away changes while registration is
+    # closed before loading anything, using the cached exam gate. Like
+    # forced updates, this goes by the real user, not the sudo user
+    gate = None
+    if request.method == 'POST' and not request.course_user.is_instructor():
+        gate = get_exam_gate(exam_id)
+        if (gate is None or gate.course_id != course.pk or
+                gate.admission_limit is None):
+            gate = None
+
+    if gate is not None:
+        lock_warning = get_lock_warning(gate, request_time)
+        if lock_warning is not None:
+            messages.error(request, (
+                "Error: Your exam registration was not updated: {}"
+            ).format(lock_warning))
+            return HttpResponseRedirect(reverse(
+                'registration:exam-detail',
+                args=[course.code, exam_id],
+            ))
+
     exam = get_object_or_404(
         Exam,
         pk=exam_id,
@@ -706,11 +699,35 @@ def exam_detail(request, course_code, exam_id):
             exam_slot = exam_reg.exam_slot
             exam_slot_pk = exam_slot.pk if exam_slot is not None else None
 
+            # With admission control, queue the change if too many are
+            # already running
+            if gate is not None:
+                admission = try_admit(exam.pk, gate.admission_limit,
+                    unsign_ticket(exam.pk, request.user.id,
+                        request.POST.get('admission_ticket')))
+                if not admission.admitted:
+                    response = render(request,
+                        'registration/exam_queued.html', {
+                            'course': course,
+                            'exam': exam,
+                            'admission': admission,
+                            'signed_ticket': sign_ticket(
+                                exam.pk, request.user.id, admission.ticket),
+                            'post_data': [
+                                (key, value)
+                                for key, value in request.POST.items()
+                                if key not in (
+                                    'csrfmiddlewaretoken', 'admission_ticket')
+                            ],
+                        }, status=503)
+                    response['Retry-After'] = str(admission.retry_after)
+                    return response
+
             try:
                 warnings = ExamRegistration.update_slot(
                     exam_reg.pk, exam_slot_pk,
                     request_time=request_time, force=force_update)
-            except IntegrityError as e:
+            except (IntegrityError, TransactionConflict) as e:
                 messages.error(request, (
                     "Error: Your exam registration was not updated: {}"
                 ).format(e))
@@ -729,6 +746,9 @@ def exam_detail(request, course_code, exam_id):
                     'registration:exam-detail',
                     args=[exam.course.code, exam.id],
                 ))
+            finally:
+                if gate is not None:
+                    release(exam.pk, admission.place)
 
         else:
             messages.error(request,
@@ -742,17 +762,20 @@ def exam_detail(request, course_code, exam_id):
 
     # Reload exam_reg and related items
     exam_reg.refresh_from_db()
-    exam_slots = exam.exam_slot_set \
-        .filter(exam_slot_type=my_course_user.exam_slot_type) \
-        .annotate(day=TruncDay('start_time_slot__start_time')) \
-        .select_related('start_time_slot') \
-        .select_related('start_time_slot__room') \
-        .prefetch_related('time_slots') \
-        .prefetch_related('time_slots__exam_slot_set')
+    timeline = get_cached_exam_timeline(exam, my_course_user.exam_slot_type)
+
+    # Find currently registered slot
+    current_slot = None
+    if exam_reg.exam_slot_id is not None:
+        slots = {slot.pk: slot for day in timeline for slot in day.slots}
+        current_slot = slots.get(exam_reg.exam_slot_id)
+        if current_slot is None:
+            current_slot = next(iter(get_exam_slot_infos(
+                ExamSlot.objects.filter(pk=exam_reg.exam_slot_id))), None)
 
     # Currently selected slot is wrong type
-    wrong_type_slot = (exam_reg.exam_slot and
-            exam_reg.exam_slot.exam_slot_type !=
+    wrong_type_slot = (current_slot is not None and
+            current_slot.exam_slot_type !=
             my_course_user.exam_slot_type)
 
     # Determine id of selected slot
@@ -769,13 +792,40 @@ def exam_detail(request, course_code, exam_id):
         'my_course_user': my_course_user,
         'exam': exam,
         'exam_reg': exam_reg,
-        'exam_slots': exam_slots,
+        'timeline': timeline,
+        'current_slot': current_slot,
         'selected_slot': selected_slot,
         'wrong_type_slot': wrong_type_slot,
         'request_time': request_time,
     })
 
 
+@query_budget(8)
+@require_safe
+@login_required
+def exam_detail_seats(request, course_code, exam_id):
+    """
+    Returns the number of seats left in each exam slot of an exam as JSON,
+    which the exam page polls to keep its seat counts live. An ETag is
+    sent, so polls that find no changes get an empty 304 response.
+    """
+    course, _ = course_auth(request, course_code, warn_dropped=False)
+    exam = get_object_or_404(
+        Exam,
+        pk=exam_id,
+        course=course,
+    )
+
+    response = JsonResponse({
+        'exam_slots': get_cached_seats_left(exam),
+    })
+    patch_cache_control(response, private=True, no_cache=True)
+
+    etag = quote_etag(hashlib.md5(response.content).hexdigest())
+    response['ETag'] = etag
+    return get_conditional_response(request, etag=etag, response=response)
+
+
 @require_http_methods(['GET', 'HEAD', 'POST'])
 @login_required
 def exam_edit(request, course_code, exam_id):
@@ -804,6 +854,12 @@ def exam_edit(request, course_code, exam_id):
             form.save()
             timeslot_formset.save()
             examslot_formset.save()
+
+            # Editing exam slots may change which time slots they take
+            # seats in, so recount the seats taken in each time slot
+            TimeSlot.repair_reg_counts(exam)
+            availability.invalidate_layout(exam.pk)
+
             messages.success(request,
                 "The exam was updated successfully.",
             )
@@ -844,6 +900,7 @@ def exam_edit(request, course_code, exam_id):
     })
 
 
+@query_budget(16)
 @require_safe
 @login_required
 def exam_signups(request, course_code, exam_id):
@@ -886,9 +943,9 @@ def exam_signups(request, course_code, exam_id):
     })
 
 
-@require_safe
+@require_http_methods(['GET', 'HEAD', 'POST'])
 @login_required
-def exam_signups_csv(request, course_code, exam_id):
+def exam_signups_assign(request, course_code, exam_id):
     course, _ = course_auth(request, course_code, instructor=True)
     exam = get_object_or_404(
         Exam,
@@ -896,62 +953,134 @@ def exam_signups_csv(request, course_code, exam_id):
         course=course,
     )
 
-    # Compute registered users
-    exam_slot_query = (exam.exam_slot_set
-            .select_related('start_time_slot')
-            .prefetch_related('time_slots')
-            .prefetch_related('exam_registration_set')
-            .prefetch_related('exam_registration_set__course_user')
-            .prefetch_related('exam_registration_set__course_user__user'))
-    registered_users_rows = (
-        {
-            'user.username': exam_reg.course_user.user.username,
-            'user.first_name': exam_reg.course_user.user.first_name,
-            'user.last_name': exam_reg.course_user.user.last_name,
-            'user.slot_type': exam_reg.course_user.exam_slot_type_display(),
-            'exam_slot.slot_type': exam_slot.exam_slot_type_display(),
-            'exam_slot.start_time': exam_slot.get_start_time() \
+    if request.method == 'POST':
+        try:
+            plan = assign_unregistered(exam)
+        except (IntegrityError, TransactionConflict) as e:
+            messages.error(request, (
+                "Error: No students were assigned: {}"
+            ).format(e))
+        else:
+            messages.success(request, (
+                "{} unregistered students were assigned to exam slots."
+            ).format(len(plan.assignments)))
+            if plan.unassigned:
+                messages.warning(request, (
+                    "{} students could not be assigned, since no exam "
+                    "slot of their type has a seat left: {}"
+                ).format(len(plan.unassigned), ', '.join(
+                    course_user.user.username
+                    for course_user in plan.unassigned
+                )))
+            return HttpResponseRedirect(reverse(
+                'registration:exam-signups',
+                args=[course.code, exam.id],
+            ))
+
+    # Preview the assignment without making it
+    plan = assign_unregistered(exam, dry_run=True)
+
+    return render(request, 'registration/exam_signups_assign.html', {
+        'course': course,
+        'exam': exam,
+        'plan': plan,
+    })
+
+
+class Echo:
+    """
+    A pseudo-buffer whose write method returns the value written, so that
+    a csv writer can be used to produce the lines of a streaming response.
+    """
+    def write(self, value):
+        return value
+
+
+def exam_signups_csv_rows(course, exam):
+    """
+    Yields a row dictionary for every registered and unregistered user of
+    an exam. The values of each exam slot are computed only once, and rows
+    are read with projected queries through iterator(), so memory use does
+    not grow with the number of registrations.
+    """
+    slot_type_names = dict(CourseUser.EXAM_SLOT_TYPE)
+
+    def slot_type_display(slot_type):
+        return slot_type_names.get(slot_type, "Unknown ({})".format(slot_type))
+
+    # Compute values for each exam slot
+    slots = {}
+    for slot in get_exam_slot_infos(exam.exam_slot_set.all()):
+        slots[slot.pk] = {
+            'exam_slot.slot_type': slot.exam_slot_type_display,
+            'exam_slot.start_time': slot.start_time \
                     .strftime('%Y-%m-%d %H:%M:%S %Z%z'),
-            'exam_slot.end_time': exam_slot.get_end_time() \
+            'exam_slot.end_time': slot.end_time \
                     .strftime('%Y-%m-%d %H:%M:%S %Z%z'),
-            'exam_slot.room': exam_slot.start_time_slot.room,
+            'exam_slot.room': slot.room,
         }
-        for exam_slot in exam_slot_query
-        for exam_reg in exam_slot.exam_registration_set.all()
-    )
 
-    # Compute unregistered users
+    # Registered users
+    registered_users = (exam.exam_registration_set
+            .filter(exam_slot__isnull=False)
+            .order_by(
+                'exam_slot__start_time_slot__start_time',
+                'exam_slot__start_time_slot__room',
+                'exam_slot__exam_slot_type',
+                'exam_slot',
+                'course_user__user__username',
+            )
+            .values_list(
+                'exam_slot',
+                'course_user__user__username',
+                'course_user__user__first_name',
+                'course_user__user__last_name',
+                'course_user__exam_slot_type',
+            ))
+    for (exam_slot_pk, username, first_name, last_name,
+            slot_type) in registered_users.iterator():
+        row = {
+            'user.username': username,
+            'user.first_name': first_name,
+            'user.last_name': last_name,
+            'user.slot_type': slot_type_display(slot_type),
+        }
+        row.update(slots.get(exam_slot_pk, {}))
+        yield row
+
+    # Unregistered users
     no_reg_q = ~models.Q(exam_registration_set__exam=exam)
     null_reg_q = models.Q(exam_registration_set__exam=exam,
             exam_registration_set__exam_slot=None)
-    unregistered_users_query = course.course_user_set \
-            .filter(no_reg_q | null_reg_q) \
-            .select_related('user')
-    unregistered_users_rows = (
-        {
-            'user.username': course_user.user.username,
-            'user.first_name': course_user.user.first_name,
-            'user.last_name': course_user.user.last_name,
-            'user.slot_type': course_user.exam_slot_type_display(),
-            'exam_slot.slot_type': None,
-            'exam_slot.start_time': None,
-            'exam_slot.end_time': None,
-            'exam_slot.room': None,
+    unregistered_users = (course.course_user_set
+            .filter(no_reg_q | null_reg_q)
+            .values_list(
+                'user__username',
+                'user__first_name',
+                'user__last_name',
+                'exam_slot_type',
+            ))
+    for (username, first_name, last_name,
+            slot_type) in unregistered_users.iterator():
+        yield {
+            'user.username': username,
+            'user.first_name': first_name,
+            'user.last_name': last_name,
+            'user.slot_type': slot_type_display(slot_type),
         }
-        for course_user in unregistered_users_query
-    )
 
-    # Prepare response
-    filename = 'examreg_{}_{}_{}.csv'.format(
-        slugify(exam.course.code),
-        slugify(exam.name),
-        timezone.now().strftime('%Y%m%d-%H%M%S'),
-    )
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=' + filename
+@query_budget(8)
+@require_safe
+@login_required
+def exam_signups_csv(request, course_code, exam_id):
+    course, _ = course_auth(request, course_code, instructor=True)
+    exam = get_object_or_404(
+        Exam,
+        pk=exam_id,
+        course=course,
+    )
 
-    # Write CSV rows
     fieldnames = [
         'user.username',
         'user.first_name',
@@ -962,14 +1091,27 @@ def exam_signups_csv(request, course_code, exam_id):
         'exam_slot.end_time',
         'exam_slot.room'
     ]
-    writer = csv.DictWriter(response, fieldnames=fieldnames)
-    writer.writeheader()
-    for row in chain(registered_users_rows, unregistered_users_rows):
-        writer.writerow(row)
+    writer = csv.DictWriter(Echo(), fieldnames=fieldnames)
+
+    def stream_csv():
+        # Send the header before running any queries
+        yield writer.writerow(dict(zip(fieldnames, fieldnames)))
+        for row in exam_signups_csv_rows(course, exam):
+            yield writer.writerow(row)
+
+    # Prepare response
+    filename = 'examreg_{}_{}_{}.csv'.format(
+        slugify(exam.course.code),
+        slugify(exam.name),
+        timezone.now().strftime('%Y%m%d-%H%M%S'),
+    )
 
+    response = StreamingHttpResponse(stream_csv(), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=' + filename
     return response
 
 
+@query_budget(14)
 @require_safe
 @login_required
 def exam_signups_counts(request, course_code, exam_id):
@@ -980,49 +1122,47 @@ def exam_signups_counts(request, course_code, exam_id):
         course=course,
     )
 
-    # Compute time slots, exam slots
-    time_slots = exam.time_slot_set \
-            .annotate(day=TruncDay('start_time')) \
-            .prefetch_related('exam_slot_set')
-    exam_slots = exam.exam_slot_set \
-            .annotate(day=TruncDay('start_time_slot__start_time')) \
-            .select_related('start_time_slot') \
-            .prefetch_related('time_slots') \
-            .prefetch_related('time_slots__exam_slot_set')
+    counts = get_signup_counts(exam)
+    time_slot_days, exam_slot_days = group_counts_by_day(counts)
 
-    # Compute unregistered users
-    num_course_users = course.course_user_set \
-            .count()
-    num_registered = exam.exam_registration_set \
-            .exclude(exam_slot__isnull=True) \
-            .count()
-    num_unregistered = num_course_users - num_registered
-
-    # Compute unregistered students
-    num_course_users_students = course.course_user_set \
-            .filter(user_type=CourseUser.STUDENT) \
-            .count()
-    num_registered_students = exam.exam_registration_set \
-            .filter(course_user__user_type=CourseUser.STUDENT) \
-            .exclude(exam_slot__isnull=True) \
-            .count()
-    num_unregistered_students = \
-            num_course_users_students - num_registered_students
+    # Check for consistency issues with reg_count, which are fixed by the
+    # reconcile_counts command rather than here
+    drifted_exam_slots = [
+        exam_slot for exam_slot in counts.exam_slots
+        if exam_slot.slot.reg_count != exam_slot.registered
+    ]
+    drifted_time_slots = [
+        time_slot for time_slot in counts.time_slots
+        if time_slot.reg_count != time_slot.registered
+    ]
 
     return render(request, 'registration/exam_signups_counts.html', {
         'course': course,
         'exam': exam,
-        'time_slots': time_slots,
-        'exam_slots': exam_slots,
+        'counts': counts,
+        'students': counts.by_user_type[CourseUser.STUDENT],
+        'time_slot_days': time_slot_days,
+        'exam_slot_days': exam_slot_days,
+        'drifted_exam_slots': drifted_exam_slots,
+        'drifted_time_slots': drifted_time_slots,
+    })
 
-        'num_course_users': num_course_users,
-        'num_registered': num_registered,
-        'num_unregistered': num_unregistered,
 
-        'num_course_users_students': num_course_users_students,
-        'num_registered_students': num_registered_students,
-        'num_unregistered_students': num_unregistered_students,
-    })
+@query_budget(14)
+@require_safe
+@login_required
+def exam_signups_counts_json(request, course_code, exam_id):
+    """
+    Returns the signup counts of an exam as JSON, for use by dashboards.
+    """
+    course, _ = course_auth(request, course_code, instructor=True)
+    exam = get_object_or_404(
+        Exam,
+        pk=exam_id,
+        course=course,
+    )
+
+    return JsonResponse(signup_counts_to_json(get_signup_counts(exam)))
 
 
 @require_http_methods(['GET', 'HEAD', 'POST'])
@@ -1111,11 +1251,16 @@ def exam_signups_checkin(request, course_code, exam_id, username):
         exam_reg = form.save(commit=False)
         exam_reg.checkin_user = my_course_user
         exam_reg.checkin_time = timezone.now()
-        exam_reg.save()
-
-        messages.success(request,
-            "The user was checked in successfully.",
-        )
+        try:
+            run_in_transaction(exam_reg.save, name='exam_signups_checkin')
+        except TransactionConflict as e:
+            messages.error(request, (
+                "Error: The user was not checked in: {}"
+            ).format(e))
+        else:
+            messages.success(request,
+                "The user was checked in successfully.",
+            )
 
     else:
         messages.error(request,
@@ -1151,11 +1296,16 @@ def exam_signups_checkout(request, course_code, exam_id, username):
     # Don't need an actual form; just update data
     exam_reg.checkout_user = my_course_user
     exam_reg.checkout_time = timezone.now()
-    exam_reg.save()
-
-    messages.success(request,
-        "The user was checked out successfully.",
-    )
+    try:
+        run_in_transaction(exam_reg.save, name='exam_signups_checkout')
+    except TransactionConflict as e:
+        messages.error(request, (
+            "Error: The user was not checked out: {}"
+        ).format(e))
+    else:
+        messages.success(request,
+            "The user was checked out successfully.",
+        )
 
     return HttpResponseRedirect(reverse(
         'registration:exam-signups-detail',
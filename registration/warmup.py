@@ -0,0 +1,83 @@
+"""
+Warms the caches used by the exam page ahead of registration opening, so
+that the first wave of students after lock_before is served from cached
+data: the exam gate used for admission control, the seats left in each
+exam slot, the timeline for each exam slot type and time zone of the
+course's users, and the users' memberships, if MEMBERSHIP_CACHE is set.
+
+Warmed values are keyed by the current availability and membership
+versions, so any change made after warming still invalidates them. The
+exam gate and the exam slots of the timelines are keyed by the layout
+version, which bookings do not bump, so they stay warm once registration
+opens; the seat counts are keyed by the seat version, so they only save
+queries until the first booking, after which they are loaded again with
+one query.
+"""
+import time
+from collections import namedtuple
+
+from django.utils import timezone
+
+from . import availability, membership
+from .admission import get_exam_gate
+from .models import CourseUser, Exam
+from .timeline import get_cached_exam_timeline, get_cached_slot_counts
+from .timezones import DEFAULT_TIMEZONE, get_timezone
+
+
+# What was warmed for an exam, and how long it took in seconds
+WarmupResult = namedtuple('WarmupResult', [
+    'exam', 'timelines', 'users', 'elapsed',
+])
+
+
+def get_exams_to_warm(now, lead_time):
+    """
+    Returns the exams whose registration opens within lead_time (a
+    timedelta) after now.
+    """
+    return Exam.objects \
+        .filter(lock_before__gt=now, lock_before__lte=now + lead_time) \
+        .select_related('course') \
+        .order_by('lock_before')
+
+
+def warm_exam(exam, timeout):
+    """
+    Computes and caches everything the exam page needs for an exam, for
+    timeout seconds. Returns a WarmupResult.
+    """
+    start = time.perf_counter()
+
+    course_users = CourseUser.objects.filter(course=exam.course_id)
+    exam_slot_types = set(course_users
+        .values_list('exam_slot_type', flat=True)
+        .distinct())
+    timezone_names = set(course_users
+        .values_list('user__timezone', flat=True)
+        .distinct())
+
+    # Time zones are resolved the same way as by TimezoneMiddleware
+    timezones = {
+        get_timezone(name) or get_timezone(DEFAULT_TIMEZONE)
+        for name in timezone_names
+    }
+
+    timelines = 0
+    with availability.warming(timeout):
+        get_exam_gate(exam.pk)
+        get_cached_slot_counts(exam)
+        for tz in timezones:
+            with timezone.override(tz):
+                for exam_slot_type in exam_slot_types:
+                    get_cached_exam_timeline(exam, exam_slot_type)
+                    timelines += 1
+
+    users = membership.warm_memberships(exam.course, timeout)
+
+    return WarmupResult(
+        exam=exam,
+        timelines=timelines,
+        users=users,
+        elapsed=time.perf_counter() - start,
+    )